@@ -7,11 +7,14 @@ archerite
 Copyright Deca Technologies 2013 All Rights Reserved.
 """
 from datetime import datetime
+import Queue
 import re
 import socket
+import threading
+import time
 import zlib
 
-from celery import chord
+from celery import group
 
 import bernhard
 
@@ -22,6 +25,7 @@ from purpurite import dbutil
 from purpurite import redisutil
 from purpurite import onyxutil
 from purpurite import config
+from purpurite import tracing
 from purpurite.riemann import log
 
 from xenotime import nodetasks
@@ -36,9 +40,47 @@ SHIFTS_EXPIRE_TIME = 60 * 50
 NOT_LOADED = 0
 FETCHING = 1
 FETCHED = 2
+# marks a listed file that hasn't been listed unchanged twice yet
+PENDING = "?"
+# file names looked up per query when finding known measurement files
+KNOWN_FILES_BATCH_SIZE = 500
+# seconds to trust a count of live routing workers
+WORKER_COUNT_TTL = 30
+# completed jobs averaged for a design's per-unit routing time
+ROUTING_HISTORY_JOBS = 10
+# seconds between checks on a job's routing
+WATCH_INTERVAL = 5
+# fraction of workranges routed before stragglers are re-run
+SPECULATE_FRACTION = 0.75
+# a workrange straggles once it runs this many times longer than the
+# per-unit time of the routed ones predicts
+STRAGGLER_FACTOR = 2.0
+# never call a workrange a straggler before this many seconds
+MIN_STRAGGLER_SECONDS = 30
+# give up on a job's routing after this many seconds, before its
+# results expire
+ROUTING_TIMEOUT = 60 * 45
+# the broker queue routing and GDS tasks wait in for the workers
+ROUTING_QUEUE = "celery"
+# route the workranges of jobs launched together for one design in
+# route_batch tasks, see launch_batch_routing
+BATCH_SHARED_DESIGNS = True
+# most panels' workranges routed by one route_batch task
+BATCH_MAX_PANELS = 8
+# files prefetch_files fetches from the shares at the same time
+PREFETCH_THREADS = 4
+
 riemann = bernhard.Client(host=config.RIEMANN_HOST, port=config.RIEMANN_PORT)
 
 
+class MissingUnitCountException(Exception):
+    """
+    The unit count of a job's measurement file isn't in redis, so its
+    workranges can't be planned.
+    """
+    pass
+
+
 @celery.task(name="archerite.contasks.process_new_measurements",
              timelimit=10)
 @log
@@ -46,38 +88,129 @@ def process_new_measurements(watch_id):
     """
     Process new measurement files in the watch_id Watch directory.
 
-    Acquire a measurement scan lock, otherwise return. Create a database
-    session and get the Watch object. Try to get files in the measurement
-    location, otherwise release the lock. If the file already exists as
-    measurement in the database continue, otherwise if it matches the
-    MEASUREMENT_FILE_FORM regex process the new measurement file, add
-    a new job and release the lock.
+    Acquire the watch's measurement scan lock, otherwise return None.
+    Create a database session and get the Watch object. Try to list the
+    measurement location with file sizes and modified times, otherwise
+    release the lock and return None. Diff the listing against the
+    watch's last listing in redis. A file is new once it is listed with
+    the same size and modified time twice in a row, so files still
+    being copied in are left until they settle. Look up which of the
+    new files matching the MEASUREMENT_FILE_FORM regex are already
+    measurements in batched queries and add the rest with their jobs
+    in one commit. Renew the lock before each file and give up if it
+    was lost, and only commit while the lock's fencing token is the
+    newest to write. Delay prefetch_files for the new measurement files
+    with jobs. Save the listing, release the lock and return how many
+    listed files changed.
     """
     riemann.send({"host": config.HOST,
                   "service": "contasks.process_new_measurements",
                   "description": str(watch_id)})
-    if redisutil.acquire_lock(SCAN_LOCK_NAME, LOCK_TIME):
-        print("Scanning for new measurements...")
-        db = dbutil.create_db_session()
-        db.commit()
-        watch = db.query(model.Watch).filter_by(id=watch_id).first()
+    lock_name = "{0}.{1}".format(SCAN_LOCK_NAME, watch_id)
+    token = redisutil.acquire_lock(lock_name, LOCK_TIME)
+    if not token:
+        print("Scan of watch {0} skipped, already scanning".format(watch_id))
+        return None
+    print("Scanning for new measurements...")
+    db = dbutil.create_db_session()
+    db.commit()
+    watch = db.query(model.Watch).filter_by(id=watch_id).first()
+    try:
+        listing = shareutil.listing_in_location(watch.measurement_location)
+    except shareutil.RemoteNameException:
+        db.close()
+        redisutil.release_lock(lock_name, token)
+        return None
+    r = redisutil.redis_connect()
+    listing_key = redisutil.watch_listing_key(watch)
+    snapshot = r.hgetall(listing_key)
+    updates, settled = diff_listing(snapshot, listing)
+    removed = [file_name for file_name in snapshot
+               if file_name not in listing]
+    file_names = sorted(file_name for file_name in settled
+                        if MEASUREMENT_FILE_FORM.match(file_name))
+    known = known_file_names(db, watch, file_names)
+    new_files = []
+    for file_name in file_names:
+        if file_name in known:
+            continue
+        if not redisutil.renew_lock(lock_name, token, LOCK_TIME):
+            print("Lost the scan lock of watch {0}".format(watch_id))
+            db.rollback()
+            db.close()
+            return None
+        measurement_file = process_new_file(db, watch, file_name)
+        new_files.append(measurement_file)
         try:
-            file_names = shareutil.file_names_in_location(
-                watch.measurement_location)
-        except shareutil.RemoteNameException:
-            redisutil.release_lock(SCAN_LOCK_NAME)
-            return
-        for file_name in file_names:
-            if db.query(model.MeasurementFile)\
-                 .filter_by(watch=watch,
-                            file_name=file_name)\
-                 .first():
-                continue
-            if MEASUREMENT_FILE_FORM.match(file_name):
-                measurement_file = process_new_file(db, watch, file_name)
-                add_job_for_file(db, measurement_file)
+            add_job_for_file(db, measurement_file)
+        except Exception as e:
+            print("Could not add a job for {0}: {1}".format(file_name, e))
+            measurement_file.valid = False
+    if not dbutil.check_fence(db, lock_name, token):
+        print("Scan of watch {0} superseded".format(watch_id))
+        db.rollback()
         db.close()
-        redisutil.release_lock(SCAN_LOCK_NAME)
+        return None
+    db.commit()
+    new_ids = [measurement_file.id for measurement_file in new_files
+               if measurement_file.valid]
+    db.close()
+    if new_ids:
+        prefetch_files.delay(new_ids)
+    pipe = r.pipeline()
+    if updates:
+        pipe.hmset(listing_key, updates)
+    if removed:
+        pipe.hdel(listing_key, *removed)
+    pipe.execute()
+    redisutil.release_lock(lock_name, token)
+    return len(updates) + len(removed)
+
+
+def known_file_names(db, watch, file_names):
+    """
+    Returns the set of file_names already saved as MeasurementFiles of
+    watch.
+
+    Query the names KNOWN_FILES_BATCH_SIZE at a time, so a scan costs
+    one query per batch of new names rather than one per file.
+    """
+    known = set()
+    for i in range(0, len(file_names), KNOWN_FILES_BATCH_SIZE):
+        batch = file_names[i:i + KNOWN_FILES_BATCH_SIZE]
+        rows = db.query(model.MeasurementFile.file_name).filter(
+            model.MeasurementFile.watch_id == watch.id,
+            model.MeasurementFile.file_name.in_(batch))
+        known.update(file_name for (file_name,) in rows)
+    return known
+
+
+def diff_listing(snapshot, listing):
+    """
+    Returns (updates, settled) for a new listing of a watch.
+
+    snapshot maps file names to their "size mtime" stamp from the last
+    listing, ending in PENDING until the file has been listed twice
+    unchanged. updates maps the file names whose entries change to
+    their new entry and settled lists the files that have just settled.
+    Files changed after they settled were already processed, so only
+    their stamp is updated.
+    """
+    updates = {}
+    settled = []
+    for file_name, (size, mtime) in listing.items():
+        stamp = "{0} {1!r}".format(size, mtime)
+        entry = snapshot.get(file_name)
+        if entry == stamp:
+            continue
+        if entry == stamp + PENDING:
+            updates[file_name] = stamp
+            settled.append(file_name)
+        elif entry is None or entry.endswith(PENDING):
+            updates[file_name] = stamp + PENDING
+        else:
+            updates[file_name] = stamp
+    return updates, settled
 
 
 @celery.task(name="archerite.contasks.queue_new_jobs",
@@ -87,52 +220,144 @@ def queue_new_jobs():
     """
     Queue any new stepwise tasks for new Jobs.
 
-    Acquire a job lock, otherwise return. Set the launched_job variable
-    to False. Create a database session and get all Job objects with
-    the status LAUNCHED. If the onyx file status is NOT_LOADED then
-    delay the fetch_onyx_file task. Otherwise if the measurement file
-    status is NOT_LOADED then delay the fetch_shifts_file task.
-    Otherwise if launched_jobs is False, no jobs have been launched
-    yet so reexpire_shifts and change the job status to QUEUED. If there
-    is routing required for the onyx file then delay the launch_routing
-    task. Otherwise delay the create_gds task and set launched_job to
-    True. Commit and close the database and release the job lock.
-    """
-    if redisutil.acquire_lock(JOB_LOCK_NAME, LOCK_TIME):
+    Acquire a job lock, otherwise return. Create a database session and
+    record the lock's fencing token, returning if a newer holder already
+    ran, before any task is delayed. Get all Job objects with the status
+    LAUNCHED and look up their file statuses in one round trip. If the
+    onyx file status is NOT_LOADED then delay the fetch_onyx_file task,
+    once per onyx file. Otherwise if the measurement file status is
+    NOT_LOADED then delay the fetch_shifts_file task. A job is ready
+    once both statuses are FETCHED; one still FETCHING, as
+    prefetch_files leaves them, is waited for without another fetch.
+    Admit ready jobs in priority order while the routing queue has room
+    for their tasks, see admit_jobs. For each admitted job
+    reexpire_shifts and change the job status to QUEUED. If there is no
+    routing required for the onyx file delay the create_gds task. Delay
+    the launch_routing task for the others, or with BATCH_SHARED_DESIGNS
+    the launch_batch_routing task for each design with several admitted
+    jobs. Commit and close the database and release the job lock.
+    """
+    token = redisutil.acquire_lock(JOB_LOCK_NAME, LOCK_TIME)
+    if token:
         print("Launching new jobs...")
-        launched_job = False
         db = dbutil.create_db_session()
         db.commit()
+        if not dbutil.check_fence(db, JOB_LOCK_NAME, token):
+            print("Job queueing superseded")
+            db.rollback()
+            db.close()
+            return
         new_jobs = db.query(model.Job).filter_by(
             status=model.Job.STATUS_LAUNCHED).all()
         riemann.send({"host": config.HOST,
                       "service": "contasks.queue_new_jobs",
                       "description": str(["start", str(new_jobs)])})
-        for job in new_jobs:
-            if redisutil.onyx_file_status(job.onyx_file) == NOT_LOADED:
+        ready = []
+        fetching = set()
+        for job, (onyx_status, requires_routing, state) in zip(
+                new_jobs, redisutil.job_file_states(new_jobs)):
+            if onyx_status == NOT_LOADED:
                 job.sub_status = model.Job.SUBSTATUS_FETCHING_ONYX_FILE
-                fetch_onyx_file.delay(job)
-            elif (redisutil.measurement_file_status(job.measurement_file) ==
-                  NOT_LOADED):
+                if job.onyx_file not in fetching:
+                    fetching.add(job.onyx_file)
+                    fetch_onyx_file.delay(job)
+            elif onyx_status != FETCHED:
+                job.sub_status = model.Job.SUBSTATUS_FETCHING_ONYX_FILE
+            elif state[0] == NOT_LOADED:
                 job.sub_status = model.Job.SUBSTATUS_FETCHING_MEASUREMENTS
                 fetch_shifts_file.delay(job.measurement_file.id)
-            elif not launched_job:
-                reexpire_shifts(job.measurement_file)
-                job.status = model.Job.STATUS_QUEUED
-                work = 2
-                if redisutil.onyx_file_requires_routing(job.onyx_file):
-                    launch_routing.delay(job.id)
-                    count = int(redisutil.measurement_file_count(
-                        job.measurement_file))
-                    workranges = onyxutil.workranges_for_units(count)
-                    work += len(workranges)
-                else:
-                    nodetasks.create_gds.delay(job_id=job.id, gds_only=True)
-                job.work_items = work
-                launched_job = True
+            elif state[0] != FETCHED:
+                job.sub_status = model.Job.SUBSTATUS_FETCHING_MEASUREMENTS
+            else:
+                ready.append((job, requires_routing, state))
+        designs = {}
+        for job, workranges in admit_jobs(db, ready):
+            reexpire_shifts(job.measurement_file)
+            job.status = model.Job.STATUS_QUEUED
+            if workranges is not None:
+                designs.setdefault(job.onyx_file, []).append(
+                    (job.id, workranges))
+            else:
+                nodetasks.create_gds.delay(job_id=job.id, gds_only=True)
+            job.work_items = 2 + len(workranges or [])
+        for planned in designs.values():
+            if BATCH_SHARED_DESIGNS and len(planned) > 1:
+                launch_batch_routing.delay(planned)
+            else:
+                for job_id, workranges in planned:
+                    launch_routing.delay(job_id, workranges)
         db.commit()
         db.close()
-        redisutil.release_lock(JOB_LOCK_NAME)
+        redisutil.release_lock(JOB_LOCK_NAME, token)
+
+
+def admit_jobs(db, ready):
+    """
+    Returns (job, workranges) for each job of ready to launch now,
+    workranges being None for jobs that don't need routing.
+
+    ready holds (job, requires routing, measurement file state) for jobs
+    whose files are loaded. Take them oldest design first, keeping the
+    jobs of a design together, and plan each one's workranges. A job
+    needs a task per workrange or one create_gds task. Admit jobs while
+    the tasks waiting in ROUTING_QUEUE number fewer than the live
+    routing workers, so they always have a round of work queued but
+    later jobs don't wait behind a deep queue. The first job is admitted
+    whenever the queue is below that. With BATCH_SHARED_DESIGNS the rest
+    of the ready jobs of an admitted design are admitted with it,
+    however deep the queue, so launch_batch_routing routes them
+    together. A job whose unit count is missing is left LAUNCHED for a
+    later tick. Without a worker count or queue depth admit one job, as
+    each tick used to.
+    """
+    if not ready:
+        return []
+    design_age = {}
+    for job, requires_routing, state in ready:
+        age = design_age.get(job.onyx_file)
+        if age is None or job.launched_time < age:
+            design_age[job.onyx_file] = job.launched_time
+    ready = sorted(ready, key=lambda item: (design_age[item[0].onyx_file],
+                                            item[0].onyx_file,
+                                            item[0].launched_time,
+                                            item[0].id))
+    workers = live_worker_count()
+    depth = routing_queue_depth()
+    if workers is None or depth is None:
+        workers, depth = 1, 0
+    admitted = []
+    for job, requires_routing, state in ready:
+        if depth >= workers and not (
+                BATCH_SHARED_DESIGNS and admitted and
+                admitted[-1][0].onyx_file == job.onyx_file):
+            break
+        workranges = None
+        if requires_routing:
+            try:
+                workranges = plan_workranges(db, job, state)
+            except MissingUnitCountException as e:
+                print(e)
+                continue
+        admitted.append((job, workranges))
+        depth += len(workranges) if workranges is not None else 1
+    if admitted:
+        print("Admitted {0} of {1} ready jobs".format(len(admitted),
+                                                      len(ready)))
+    return admitted
+
+
+def routing_queue_depth():
+    """
+    Returns the number of tasks waiting in ROUTING_QUEUE on the broker,
+    or None when the broker can't be asked.
+    """
+    try:
+        with celery.connection() as connection:
+            return connection.default_channel.queue_declare(
+                queue=ROUTING_QUEUE).message_count
+    except Exception as e:
+        print("Could not read the routing queue depth: {0}".format(e))
+        return None
 
 
 @celery.task(name="archerite.contasks.fetch_onyx_file",
@@ -143,31 +368,20 @@ def fetch_onyx_file(job):
     Get the onyx design file data and set redis keys in preparation for
     launching routing.
 
-    Create a redis connection. If the onyx_file_status_key doesn't
-    exist then set it to FETCHING and continue otherwise return.
-    Create a database connnection and get the design file data using
-    that connenction. Set the onyx_file_key to the design file data.
-    Set the onyx_file_requires_routing_key to whether the design
-    requires routing. Set the onyx_file_status_key to FETCHED.
+    Load the job's onyx file with load_onyx_file. If the file doesn't
+    match the job's checksum it changed since the checksum was taken,
+    so compute the checksum again and leave the fetch to the next
+    queue_new_jobs, which sees the onyx file NOT_LOADED again. If there
+    is another error retry.
     """
     try:
-        r = redisutil.redis_connect()
-        onyx_file_name = job.onyx_file
-        checksum = job.onyx_file_checksum
-        status_key = redisutil.onyx_file_status_key(onyx_file_name)
-        if r.setnx(status_key, FETCHING):
-            print("Fetching Onyx file {0}...".format(onyx_file_name))
-            db = dbutil.create_db_session()
-            data = shareutil.data_for_design_file(db,
-                                                  onyx_file_name,
-                                                  checksum=checksum)
-            key = redisutil.onyx_file_key(onyx_file_name)
-            r.set(key, data)
-            design = onyxutil.design_from_data(design_file_data=data)
-            r.set(redisutil.onyx_file_requires_routing_key(onyx_file_name),
-                  onyxutil.requires_autorouting(design))
-            r.set(status_key, FETCHED)
-            db.close()
+        load_onyx_file(job.onyx_file, job.onyx_file_checksum, job.id)
+    except shareutil.ChecksumFailed as e:
+        print(e)
+        db, job = dbutil.get_db_job(job.id)
+        shareutil.set_checksum(db, job)
+        db.commit()
+        db.close()
     except Exception as e:
         riemann.send({"host": config.HOST,
                       "service": "contasks.fetch_onyx_file",
@@ -177,6 +391,54 @@ def fetch_onyx_file(job):
         fetch_onyx_file.retry(job)
 
 
+def load_onyx_file(onyx_file_name, checksum, job_id=None):
+    """
+    Fetch an onyx design file into redis unless it is already fetched
+    or being fetched. Returns True if this call fetched it.
+
+    Create a redis connection. If the onyx_file_status_key doesn't
+    exist then set it to FETCHING and continue otherwise return.
+    Create a database connnection and stream the design file data
+    using that connenction into the onyx_file_key, a chunk at a time.
+    Set the onyx_file_requires_routing_key to whether the design
+    requires routing, scanning the chunks as they are copied without
+    parsing them or reading the design back. Set the
+    onyx_file_status_key to FETCHED in the same MULTI transaction. If
+    fetching fails delete the onyx_file_status_key, so the file can be
+    fetched again, and re-raise.
+    """
+    r = redisutil.redis_connect()
+    status_key = redisutil.onyx_file_status_key(onyx_file_name)
+    if not r.setnx(status_key, FETCHING):
+        return False
+    print("Fetching Onyx file {0}...".format(onyx_file_name))
+    db = dbutil.create_db_session()
+    try:
+        key = redisutil.onyx_file_key(onyx_file_name)
+        writer = redisutil.RedisWriter(key)
+        scanner = onyxutil.AutoroutingScanner(writer)
+        with tracing.span("fetch_onyx", job_id) as fields:
+            try:
+                shareutil.copy_design_file(db, onyx_file_name, scanner,
+                                           checksum=checksum)
+                writer.close()
+            except Exception:
+                writer.discard()
+                raise
+            fields["bytes"] = writer.size
+        redisutil.set_values(
+            [(redisutil.onyx_file_requires_routing_key(onyx_file_name),
+              int(scanner.requires_routing)),
+             (status_key, FETCHED)],
+            transaction=True)
+    except Exception:
+        r.delete(status_key)
+        raise
+    finally:
+        db.close()
+    return True
+
+
 @celery.task(name="archerite.contasks.fetch_shifts_file",
              default_retry_delay=30)
 @log
@@ -185,59 +447,139 @@ def fetch_shifts_file(measurement_file_id):
     Use the MeasurementFile object and data to get the Shifts and
     add them to redis.
 
+    Load the measurement file with load_shifts_file. If there is an
+    error retry.
+    """
+    try:
+        load_shifts_file(measurement_file_id)
+    except Exception as e:
+        riemann.send({"host": config.HOST,
+                      "service": "contasks.fetch_shifts_file",
+                      "state": "failed",
+                      "description":
+                      "measurement_file_id: %s" % measurement_file_id})
+        fetch_shifts_file.retry(measurement_file_id)
+
+
+def load_shifts_file(measurement_file_id):
+    """
+    Fetch and parse a measurement file into redis unless it is already
+    fetched or being fetched. Returns True if this call fetched it.
+
     Create a database session. Get the first MeasurementFile object.
     Create a redis connection. If the measurement_file_status_key
-    doesn't exist then set it to FETCHING and continue otherwise
-    return. Get the data for the measurement file. Get the Shifts
-    using the MeasurementFile and data.
+    doesn't exist then set it to FETCHING and continue otherwise return.
+    Get the data for the measurement file. Get the Shifts using the
+    MeasurementFile and data. Publish the serialized Shifts under their
+    digest with the count and in spec flags and the FETCHED status, see
+    redisutil.publish_shifts. The text format is parsed only here;
+    workers read the serialized Shifts. If fetching fails delete the
+    measurement_file_status_key, so the file can be fetched again, and
+    re-raise.
     """
+    db = dbutil.create_db_session()
     try:
-        db = dbutil.create_db_session()
         measurement_file = db.query(model.MeasurementFile)\
                              .filter_by(id=measurement_file_id).first()
         r = redisutil.redis_connect()
         status_key = redisutil.measurement_file_status_key(measurement_file)
-        if r.setnx(status_key, FETCHING):
-            print("Fetching measurements file {0}_{1}_{2}...".format(
-                measurement_file.design_number, measurement_file.design_rev,
-                measurement_file.panel_id))
-            data = shareutil.data_for_measurement_file(measurement_file)
-            shifts = onyxutil.shifts_from_data(measurement_file.design_number,
-                                               measurement_file.design_rev,
-                                               measurement_file.panel_id,
-                                               data)
-            count_key = redisutil.measurement_file_count_key(measurement_file)
-            r.set(count_key, number_units_shifts(shifts))
-            r.expire(count_key, SHIFTS_EXPIRE_TIME)
-            key = redisutil.measurement_file_key(measurement_file)
-            r.set(key, data)
-            r.expire(key, SHIFTS_EXPIRE_TIME)
-            r.set(status_key, FETCHED)
-            r.expire(status_key, SHIFTS_EXPIRE_TIME)
-            riemann.send({"host": config.HOST,
-                          "service": "contasks.fetch_shifts_file",
-                          "description": str(["set", {"key", key}])})
-            db.close()
-    except Exception as e:
+        if not r.setnx(status_key, FETCHING):
+            return False
+        print("Fetching measurements file {0}_{1}_{2}...".format(
+            measurement_file.design_number, measurement_file.design_rev,
+            measurement_file.panel_id))
+        try:
+            with tracing.span("fetch_shifts",
+                              measurement_file=measurement_file_id) as fields:
+                data = shareutil.data_for_measurement_file(measurement_file)
+                fields["bytes"] = len(data)
+            with tracing.span("parse_shifts",
+                              measurement_file=measurement_file_id):
+                shifts = onyxutil.shifts_from_data(
+                    measurement_file.design_number,
+                    measurement_file.design_rev,
+                    measurement_file.panel_id,
+                    data)
+            in_spec = "".join("1" if unit.inSpec else "0"
+                              for unit in shifts.units)
+            digest = redisutil.publish_shifts(
+                measurement_file, shifts.SerializeToString(),
+                number_units_shifts(shifts), in_spec, FETCHED,
+                SHIFTS_EXPIRE_TIME)
+        except Exception:
+            r.delete(status_key)
+            raise
+        key = redisutil.shifts_key(digest)
         riemann.send({"host": config.HOST,
                       "service": "contasks.fetch_shifts_file",
-                      "state": "failed",
-                      "description":
-                      "measurement_file_id: %s" % measurement_file_id})
-        fetch_shifts_file.retry(measurement_file_id)
+                      "description": str(["set", {"key", key}])})
+        return True
+    finally:
+        db.close()
+
+
+@celery.task(name="archerite.contasks.prefetch_files")
+@log
+def prefetch_files(measurement_file_ids):
+    """
+    Fetch the files of newly found measurements before their jobs come
+    up for launch.
+
+    Create a database session and get the onyx files and checksums of
+    the measurement files' jobs. Load each onyx file once and then each
+    measurement file with PREFETCH_THREADS loaders working through them
+    together. A file that fails to load is printed and left for
+    queue_new_jobs to fetch when its job comes up. Delay
+    queue_new_jobs when done, so the jobs are admitted without waiting
+    for the next tick.
+    """
+    db = dbutil.create_db_session()
+    designs = db.query(model.Job.onyx_file, model.Job.onyx_file_checksum)\
+                .filter(model.Job.measurement_file_id.in_(
+                    measurement_file_ids))\
+                .distinct().all()
+    db.close()
+    queue = Queue.Queue()
+    for onyx_file_name, checksum in designs:
+        queue.put((load_onyx_file, (onyx_file_name, checksum)))
+    for measurement_file_id in measurement_file_ids:
+        queue.put((load_shifts_file, (measurement_file_id, )))
+    fetched = []
+
+    def loader():
+        while True:
+            try:
+                load, args = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if load(*args):
+                    fetched.append(args[0])
+            except Exception as e:
+                print("Could not prefetch {0}: {1}".format(args[0], e))
+
+    threads = [threading.Thread(target=loader)
+               for i in range(max(1, min(PREFETCH_THREADS, queue.qsize())))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("Prefetched {0} files".format(len(fetched)))
+    queue_new_jobs.delay()
 
 
 @celery.task(name="archerite.contasks.launch_routing",
              default_retry_delay=2)
 @log
-def launch_routing(job_id):
+def launch_routing(job_id, workranges=None):
     """
-    Launch routing and create_gds subtasks for job_id Job.
+    Launch routing subtasks for job_id Job and watch them.
 
     Create a database session. Get the first Job object filtered by
-    job_id. Get the count, range 2-tuples and create routing subtasks.
-    Create a celery chord of the list of routing tasks and a create_gds
-    subtask. If there is an error retry twice. Commit and close the
+    job_id. Plan the workranges if they weren't given and launch a
+    routing subtask for each. Start watch_routing to re-run stragglers
+    and launch create_gds when every workrange is routed. If there is an
+    error or the unit count is missing retry twice. Commit and close the
     database session.
     """
     db, job = dbutil.get_db_job(job_id)
@@ -249,14 +591,16 @@ def launch_routing(job_id):
         riemann.send({"host": config.HOST,
                       "service": "contasks.launch_routing",
                       "state": "start"})
-        count = int(redisutil.measurement_file_count(job.measurement_file))
-        workranges = onyxutil.workranges_for_units(count)
+        if workranges is None:
+            with tracing.span("plan_workranges", job.id):
+                workranges = plan_workranges(db, job)
         routing = [nodetasks.route.subtask([job.id, workrange])
                    for workrange in workranges]
-        create_gds = nodetasks.create_gds.subtask([job.id, len(workranges)])
         print("Launched {0} routing jobs".format(len(routing)))
-        chord(routing)(create_gds)
-    except TypeError as exc:
+        group(routing).apply_async()
+        watch_routing.apply_async([job.id, workranges, time.time()],
+                                  countdown=WATCH_INTERVAL)
+    except (TypeError, MissingUnitCountException) as exc:
         riemann.send({"host": config.HOST,
                       "service": "contasks.launch_routing",
                       "state": "failed",
@@ -266,23 +610,292 @@ def launch_routing(job_id):
     db.close()
 
 
+@celery.task(name="archerite.contasks.launch_batch_routing")
+@log
+def launch_batch_routing(planned):
+    """
+    Launch routing subtasks for several jobs of one design and watch
+    them.
+
+    planned holds (job_id, workranges) for each job. Pack the
+    workranges of all the jobs into route_batch subtasks, see
+    batch_workranges, so each worker routes workranges of several
+    panels with the design loaded once. Start watch_routing for each
+    job, which re-runs its stragglers on their own and launches its
+    create_gds when all of its workranges are routed.
+    """
+    riemann.send({"host": config.HOST,
+                  "service": "contasks.launch_batch_routing",
+                  "state": "start"})
+    batches = batch_workranges(planned, live_worker_count())
+    print("Launched {0} routing batches for {1} jobs".format(len(batches),
+                                                             len(planned)))
+    group(nodetasks.route_batch.subtask([batch])
+          for batch in batches).apply_async()
+    for job_id, workranges in planned:
+        watch_routing.apply_async([job_id, workranges, time.time()],
+                                  countdown=WATCH_INTERVAL)
+
+
+def batch_workranges(planned, workers=None):
+    """
+    Returns the (job_id, workrange) items of planned packed into
+    batches.
+
+    Items are taken workrange by workrange across the jobs, so a batch
+    holds the same unit range of several panels. Batches take up to
+    BATCH_MAX_PANELS items but are kept small enough that there is a
+    batch for each of workers when there are enough items.
+    """
+    items = []
+    for i in range(max(len(workranges) for job_id, workranges in planned)):
+        for job_id, workranges in planned:
+            if i < len(workranges):
+                items.append((job_id, workranges[i]))
+    size = min(max(len(items) // max(workers or 1, 1), 1), BATCH_MAX_PANELS)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+@celery.task(name="archerite.contasks.watch_routing")
+@log
+def watch_routing(job_id, workranges, launched_time, splits=None,
+                  copies=None):
+    """
+    Launch create_gds for job_id Job once all its workranges are routed.
+
+    workranges are the ranges launch_routing started, splits maps a
+    straggling workrange's index to the halves it was split into and
+    copies lists the indices of workranges re-run whole. Get the
+    progress of every workrange and its halves. A workrange is routed
+    when its own results exist or both its halves are routed. If all
+    are routed delay create_gds with the results of each, taking a
+    workrange's own results over its halves'. If routing has run longer
+    than ROUTING_TIMEOUT mark the job as an error and report the
+    failure to riemann and the trace. Otherwise, once
+    SPECULATE_FRACTION of the workranges are routed, split or re-run
+    the stragglers on idle workers, whichever copy finishes first wins.
+    Check again in WATCH_INTERVAL seconds.
+    """
+    splits = splits or {}
+    copies = copies or []
+    db, job = dbutil.get_db_job(job_id)
+    if not job:
+        return
+    pieces = list(workranges)
+    for halves in splits.values():
+        pieces.extend(halves)
+    progress = dict(zip([piece[0] for piece in pieces],
+                        redisutil.routing_progress(job, pieces)))
+
+    def routed(workrange):
+        if progress[workrange[0]][2]:
+            return True
+        halves = splits.get(workrange[0])
+        return bool(halves) and all(routed(half) for half in halves)
+
+    def result_keys(workrange):
+        if progress[workrange[0]][2]:
+            return [redisutil.routing_results_key(job, workrange)]
+        return [key for half in splits[workrange[0]]
+                for key in result_keys(half)]
+
+    done = [workrange for workrange in workranges if routed(workrange)]
+    if len(done) == len(workranges):
+        keys = [key for workrange in workranges
+                for key in result_keys(workrange)]
+        job.work_items_done = len(workranges)
+        db.commit()
+        db.close()
+        print("Routed {0} workranges in {1} pieces".format(len(workranges),
+                                                           len(keys)))
+        tracing.record({"stage": "routing", "job": job_id,
+                        "host": config.HOST, "start": launched_time,
+                        "seconds": time.time() - launched_time,
+                        "workranges": len(workranges),
+                        "splits": len(splits), "copies": len(copies)})
+        nodetasks.create_gds.delay(keys, job_id, len(keys))
+        return
+    if time.time() - launched_time > ROUTING_TIMEOUT:
+        print("Routing job {0} timed out".format(job_id))
+        job.status = model.Job.STATUS_ERROR
+        db.commit()
+        db.close()
+        riemann.send({"host": config.HOST,
+                      "service": "contasks.watch_routing",
+                      "state": "failed",
+                      "description": "job {0} timed out with {1} of {2} "
+                                     "workranges routed".format(
+                                         job_id, len(done), len(workranges))})
+        tracing.record({"stage": "routing", "job": job_id,
+                        "host": config.HOST, "start": launched_time,
+                        "seconds": time.time() - launched_time,
+                        "workranges": len(workranges), "routed": len(done),
+                        "splits": len(splits), "copies": len(copies),
+                        "error": "timeout"})
+        return
+    if len(done) >= SPECULATE_FRACTION * len(workranges):
+        for workrange in stragglers(pieces, progress, splits, copies,
+                                    launched_time):
+            if (workrange[2] - workrange[1] + 1 >=
+                    2 * onyxutil.MIN_BLOCK_SIZE):
+                halves = onyxutil.split_workrange(workrange)
+                splits[workrange[0]] = halves
+                print("Splitting straggling workrange {0}".format(
+                    workrange[0]))
+                for half in halves:
+                    nodetasks.route.delay(job_id, half)
+            else:
+                copies.append(workrange[0])
+                print("Re-running straggling workrange {0}".format(
+                    workrange[0]))
+                nodetasks.route.delay(job_id, workrange)
+    db.close()
+    watch_routing.apply_async([job_id, workranges, launched_time, splits,
+                               copies], countdown=WATCH_INTERVAL)
+
+
+def stragglers(pieces, progress, splits, copies, launched_time):
+    """
+    Returns the straggling workranges to split or re-run, at most one
+    per worker not busy with a running or waiting workrange.
+
+    A workrange straggles when it has been routing STRAGGLER_FACTOR
+    times longer than the median per-unit time of the routed workranges
+    predicts, and at least MIN_STRAGGLER_SECONDS. A workrange that never
+    started, e.g. because its task was lost, is timed from
+    launched_time instead; halves are only timed once started, as when
+    they were launched isn't kept. Workranges already split or re-run,
+    and halves of routed workranges, are left alone.
+    """
+    rates = sorted(progress[piece[0]][1] / (piece[2] - piece[1] + 1)
+                   for piece in pieces
+                   if progress[piece[0]][2] and progress[piece[0]][1])
+    if not rates:
+        return []
+    rate = rates[len(rates) // 2]
+    now = time.time()
+    running = []
+    busy = 0
+    for piece in pieces:
+        started, seconds, done = progress[piece[0]]
+        if done or any(progress.get(index, (None, None, False))[2]
+                       for index in onyxutil.workrange_ancestors(piece)):
+            continue
+        busy += 1
+        if piece[0] in splits or piece[0] in copies:
+            continue
+        if started:
+            elapsed = now - started
+        elif not onyxutil.workrange_ancestors(piece):
+            elapsed = now - launched_time
+        else:
+            continue
+        expected = rate * (piece[2] - piece[1] + 1)
+        if elapsed > max(STRAGGLER_FACTOR * expected, MIN_STRAGGLER_SECONDS):
+            running.append((elapsed / expected, piece))
+    workers = live_worker_count()
+    idle = workers - busy if workers else 1
+    running.sort(reverse=True)
+    return [piece for ratio, piece in running[:max(idle, 0)]]
+
+
+# last count of live routing workers and when it was taken
+worker_count = None
+worker_count_time = 0
+
+
+def live_worker_count():
+    """
+    Returns the number of worker processes taking routing tasks, or
+    None when no worker answers.
+
+    Ask the workers for their queues and pool sizes and add up the
+    pools of those consuming the default queue. The count is reused
+    for WORKER_COUNT_TTL seconds since asking waits for replies.
+    """
+    global worker_count, worker_count_time
+    if time.time() - worker_count_time < WORKER_COUNT_TTL:
+        return worker_count
+    try:
+        inspect = celery.control.inspect(timeout=1.0)
+        queues = inspect.active_queues() or {}
+        stats = inspect.stats() or {}
+    except Exception as e:
+        print("Could not count workers: {0}".format(e))
+        queues, stats = {}, {}
+    count = 0
+    for host, host_queues in queues.items():
+        if any(queue["name"] == ROUTING_QUEUE for queue in host_queues):
+            pool = stats.get(host, {}).get("pool", {})
+            count += pool.get("max-concurrency", 1)
+    worker_count = count or None
+    worker_count_time = time.time()
+    return worker_count
+
+
+def unit_routing_seconds(db, onyx_file):
+    """
+    Returns the average seconds zinc spent routing a unit of onyx_file
+    over its last ROUTING_HISTORY_JOBS completed jobs, or None if it
+    has no routing history.
+    """
+    jobs = db.query(model.Job).filter(
+        model.Job.onyx_file == onyx_file,
+        model.Job.status == model.Job.STATUS_COMPLETE,
+        model.Job.routing_time != None,
+        model.Job.unit_count > 0)\
+        .order_by(model.Job.finished_time.desc())\
+        .limit(ROUTING_HISTORY_JOBS).all()
+    if not jobs:
+        return None
+    return (sum(job.routing_time for job in jobs) /
+            sum(job.unit_count for job in jobs))
+
+
+def plan_workranges(db, job, state=None):
+    """
+    Returns the workranges to route job's units in.
+
+    Size the ranges from the unit count, the live routing workers and
+    the design's routing history, and balance them by unit cost when
+    the in spec flags of the units are known. state is the measurement
+    file state when the caller already has it. Raise a
+    MissingUnitCountException if the unit count key is missing or
+    expired rather than plan no workranges.
+    """
+    status, count, in_spec = (state or
+                              redisutil.measurement_file_state(
+                                  job.measurement_file))
+    if count is None:
+        raise MissingUnitCountException(
+            "No unit count for job {0}".format(job.id))
+    block_count = onyxutil.workrange_count(
+        count, live_worker_count(), unit_routing_seconds(db, job.onyx_file))
+    costs = None
+    if in_spec and len(in_spec) == count:
+        costs = onyxutil.unit_costs(in_spec)
+    return onyxutil.workranges_for_units(count, block_count, costs)
+
+
 @log
 def reexpire_shifts(measurement_file):
     """
     Extend the expire time on redis keys related to the measurement
     file by SHIFTS_EXPIRE_TIME seconds.
 
-    Create a redis connection. Get the status, count and data keys.
-    Change the expire time using SHIFTS_EXPIRE_TIME.
+    Get the digest of the Shifts, then change the expire time of the
+    status, count, in spec, digest and Shifts keys to
+    SHIFTS_EXPIRE_TIME in one pipeline.
     """
     print("Re-expiring measurement files...")
-    r = redisutil.redis_connect()
-    statuskey = redisutil.measurement_file_status_key(measurement_file)
-    countkey = redisutil.measurement_file_count_key(measurement_file)
-    datakey = redisutil.measurement_file_key(measurement_file)
-    r.expire(statuskey, SHIFTS_EXPIRE_TIME)
-    r.expire(countkey, SHIFTS_EXPIRE_TIME)
-    r.expire(datakey, SHIFTS_EXPIRE_TIME)
+    keys = [redisutil.measurement_file_status_key(measurement_file),
+            redisutil.measurement_file_count_key(measurement_file),
+            redisutil.measurement_file_in_spec_key(measurement_file),
+            redisutil.measurement_file_digest_key(measurement_file)]
+    digest, count = redisutil.measurement_file_shifts(measurement_file)
+    if digest:
+        keys.append(redisutil.shifts_key(digest))
+    redisutil.expire_keys(keys, SHIFTS_EXPIRE_TIME)
 
 
 @log
@@ -303,8 +916,8 @@ def process_new_file(db, watch, file_name):
     MEASUREMENT_FILE_FORM regex. Create a MeasurementFile object.
     Assign the watch, file name, design number, design revision and
     panel_id. Set the status to DISCOVERED and found_time to now.
-    Add it to the database and commit it. Return the MeasurementFile
-    object.
+    Add it to the database session for the caller to commit. Return
+    the MeasurementFile object.
     """
     design_num, design_rev, panel_id =\
         MEASUREMENT_FILE_FORM.match(file_name).groups()
@@ -318,7 +931,6 @@ def process_new_file(db, watch, file_name):
     measurement_file.status = "DISCOVERED"
     measurement_file.found_time = datetime.now()
     db.add(measurement_file)
-    db.commit()
     riemann.send({"host": config.HOST,
                   "service": "contasks.process_new_file",
                   "description": str({"measurement_file":
@@ -331,11 +943,11 @@ def process_new_file(db, watch, file_name):
 @log
 def add_job_for_file(db, measurement_file):
     """
-    Create, save and commit a new job using the measurement_file data.
+    Create and save a new job using the measurement_file data.
 
     Create a Job object. Assign the measurement_file and onyx_file.
     Assign the status to "LAUNCHED" and the launched_time to now. Add
-    it and commmit it to the database.
+    it to the database session for the caller to commit.
     """
     job = model.Job()
     job.measurement_file = measurement_file
@@ -345,7 +957,6 @@ def add_job_for_file(db, measurement_file):
     job.launched_time = datetime.now()
     shareutil.set_checksum(db, job)
     db.add(job)
-    db.commit()
     return job
 
 
@@ -9,6 +9,8 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 
 import time
 
+import bernhard
+
 from purpurite import model
 from purpurite import dbutil
 
@@ -18,20 +20,67 @@ from purpurite.riemann import log
 from contasks import process_new_measurements, queue_new_jobs
 
 
+# seconds between scans of a watch that is changing
+MIN_SCAN_INTERVAL = 1
+# longest a quiet watch goes between scans
+MAX_SCAN_INTERVAL = 30
+# seconds to wait for a scan's result before giving it up as lost
+SCAN_RESULT_TIMEOUT = 4 * MAX_SCAN_INTERVAL
+
+
+riemann = bernhard.Client(host=config.RIEMANN_HOST, port=config.RIEMANN_PORT)
 scan_results = {}
+scan_intervals = {}
+next_scans = {}
+
+
+def next_interval(interval, changed):
+    """
+    Returns the seconds to wait before scanning a watch again.
+
+    Scan again after MIN_SCAN_INTERVAL when the last scan saw changes,
+    otherwise double the wait up to MAX_SCAN_INTERVAL. Keep the wait
+    when the scan didn't run, e.g. because the share was unreachable.
+    """
+    if changed is None:
+        return interval
+    if changed:
+        return MIN_SCAN_INTERVAL
+    return min(interval * 2, MAX_SCAN_INTERVAL)
 
 
 @log
 def scan_watches(db):
     """
     Create new measurement workflow for watches.
-    Loop through the watches and if there are any
-    new measurement files begin to process them.
+    Loop through the watches. When a watch's last scan has finished,
+    back off or speed up its scans by how many of its files changed.
+    A scan with no result after SCAN_RESULT_TIMEOUT, e.g. because its
+    worker died or the result expired, is given up as one that didn't
+    run. Scan each watch that isn't being scanned and is due, so new
+    measurement files begin to be processed.
     """
     global scan_results
+    now = time.time()
     watches = db.query(model.Watch).all()
     for watch in watches:
-        scan_results[watch.id] = process_new_measurements.delay(watch.id)
+        if watch.id in scan_results:
+            result, scan_time = scan_results[watch.id]
+            if result.ready():
+                changed = result.result if result.successful() else None
+            elif now - scan_time > SCAN_RESULT_TIMEOUT:
+                print("Scan of watch {0} timed out".format(watch.id))
+                changed = None
+            else:
+                continue
+            del scan_results[watch.id]
+            interval = next_interval(
+                scan_intervals.get(watch.id, MIN_SCAN_INTERVAL), changed)
+            scan_intervals[watch.id] = interval
+            next_scans[watch.id] = now + interval
+        if now >= next_scans.get(watch.id, 0):
+            scan_results[watch.id] = (
+                process_new_measurements.delay(watch.id), now)
 
 
 @log
@@ -0,0 +1,118 @@
+"""
+Benchmark finding new measurement files in a large watch directory.
+
+Fills a scratch database with --files historical measurement files for
+one watch, then finds the --new files added to its directory listing
+and saves them, once with a query and commit per file and once with the
+batched lookup and single commit process_new_measurements uses:
+
+    python bench_measurement_dedup.py --files 20000 --new 50
+
+Pass --database to run against a scratch MySQL database rather than an
+in-memory SQLite one; its tables are created if they don't exist.
+"""
+import argparse
+from datetime import datetime
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from purpurite import model
+from archerite import contasks
+
+
+FILE_NAME_FORM = "D000001_A_P{0:07d}.onyxshifts"
+
+
+def new_measurement_file(watch, file_name):
+    design_num, design_rev, panel_id =\
+        contasks.MEASUREMENT_FILE_FORM.match(file_name).groups()
+    return model.MeasurementFile(watch=watch, file_name=file_name,
+                                 design_number=design_num,
+                                 design_rev=design_rev, panel_id=panel_id,
+                                 valid=True, status="DISCOVERED",
+                                 found_time=datetime.now())
+
+
+def setup(db, files):
+    location = model.NetworkLocation(server_ip="127.0.0.1",
+                                     share_name="bench", path="bench")
+    watch = model.Watch(measurement_location=location,
+                        panel_gds_location=location)
+    db.add(watch)
+    db.add_all(new_measurement_file(watch, FILE_NAME_FORM.format(i))
+               for i in range(files))
+    db.commit()
+    return watch
+
+
+def per_file(db, watch, file_names):
+    """
+    Query each listed file and commit each new one, as the scan used to.
+    """
+    for file_name in file_names:
+        if db.query(model.MeasurementFile)\
+             .filter_by(watch=watch,
+                        file_name=file_name)\
+             .first():
+            continue
+        db.add(new_measurement_file(watch, file_name))
+        db.commit()
+
+
+def batched(db, watch, file_names):
+    """
+    Look up the listed files in batches and commit the new ones once.
+    """
+    known = contasks.known_file_names(db, watch, file_names)
+    for file_name in file_names:
+        if file_name not in known:
+            db.add(new_measurement_file(watch, file_name))
+    db.commit()
+
+
+def remove_new(db, watch, files):
+    db.query(model.MeasurementFile).filter(
+        model.MeasurementFile.watch_id == watch.id,
+        model.MeasurementFile.file_name >= FILE_NAME_FORM.format(files))\
+        .delete(synchronize_session=False)
+    db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--files", type=int, default=20000,
+                        help="measurement files already in the database")
+    parser.add_argument("--new", type=int, default=50,
+                        help="new files in the directory listing")
+    parser.add_argument("--database", default="sqlite://")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database)
+    model.Base.metadata.create_all(engine)
+    queries = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(*args):
+        queries[0] += 1
+
+    db = sessionmaker(bind=engine)()
+    watch = setup(db, args.files)
+    file_names = [FILE_NAME_FORM.format(i)
+                  for i in range(args.files + args.new)]
+    print("{0} listed files, {1} new".format(len(file_names), args.new))
+    print("{0:>8} {1:>9} {2:>9}".format("method", "queries", "seconds"))
+    for method in (per_file, batched):
+        queries[0] = 0
+        start = time.time()
+        method(db, watch, file_names)
+        elapsed = time.time() - start
+        print("{0:>8} {1:>9} {2:>9.3f}".format(method.__name__, queries[0],
+                                               elapsed))
+        remove_new(db, watch, args.files)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
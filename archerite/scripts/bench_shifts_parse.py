@@ -0,0 +1,97 @@
+"""
+Benchmark reading a panel's shifts in the text and serialized formats.
+
+Builds Shifts for panels of --units units (default 1k, 10k and 50k),
+each unit with --dies die shifts, and times the text format parse the
+controller does once per .onyxshifts file against reading the
+serialized Shifts stored in redis, by parsing them and by the panel ID
+and unit count scan the workers use:
+
+    python bench_shifts_parse.py --units 1000 10000 50000 --dies 4
+
+Each time is the best of --repeat runs.
+"""
+import argparse
+import time
+
+from google.protobuf import text_format
+from painite import zinc_pb2
+
+from purpurite import onyxutil
+
+
+PANEL_ID = "P0000001"
+
+
+def make_shifts(units, dies):
+    shifts = zinc_pb2.Shifts()
+    shifts.designNumber = "D000001"
+    shifts.designRevision = "A"
+    shifts.panelID = PANEL_ID
+    shifts.globalOffset.x = 0.5
+    shifts.globalOffset.y = -0.25
+    for number in range(units + 2):
+        unit = shifts.units.add() if number < units else\
+            shifts.referenceUnits.add()
+        unit.number = number
+        unit.center.x = (number % 100) * 12.5
+        unit.center.y = (number // 100) * 12.5
+        unit.inSpec = number % 17 != 0
+        for i in range(dies):
+            die = unit.die.add()
+            die.name = "DIE{0}".format(i)
+            die.nominalXY.x = i * 1.25
+            die.nominalXY.y = i * -1.25
+            die.shift.x = 0.001 * (number % 7)
+            die.shift.y = -0.001 * (number % 5)
+            die.theta = 0.0001 * i
+    return shifts
+
+
+def parse_text(text_data, shifts_data):
+    return onyxutil.shifts_from_data("D000001", "A", PANEL_ID, text_data)
+
+
+def parse_binary(text_data, shifts_data):
+    return onyxutil.shifts_from_binary_data("D000001", "A", PANEL_ID,
+                                            shifts_data)
+
+
+def scan_binary(text_data, shifts_data):
+    return (onyxutil.shifts_data_panel_id(shifts_data),
+            onyxutil.shifts_data_unit_count(shifts_data))
+
+
+def best_time(method, text_data, shifts_data, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        method(text_data, shifts_data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--units", type=int, nargs="+",
+                        default=[1000, 10000, 50000])
+    parser.add_argument("--dies", type=int, default=4,
+                        help="die shifts per unit")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print("{0:>7} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+        "units", "text MB", "binary MB", "text", "parse", "scan"))
+    for units in args.units:
+        shifts = make_shifts(units, args.dies)
+        text_data = text_format.MessageToString(shifts)
+        shifts_data = shifts.SerializeToString()
+        times = [best_time(method, text_data, shifts_data, args.repeat)
+                 for method in (parse_text, parse_binary, scan_binary)]
+        print("{0:>7} {1:>10.2f} {2:>10.2f} {3:>9.3f}s {4:>9.3f}s {5:>9.3f}s"
+              .format(units, len(text_data) / 1048576.0,
+                      len(shifts_data) / 1048576.0, *times))
+
+
+if __name__ == "__main__":
+    main()
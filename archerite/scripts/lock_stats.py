@@ -0,0 +1,25 @@
+"""
+Print how often each redis lock was acquired, contended and lost.
+
+A contended lock is a measurement scan or job queue run that was
+skipped because the last one still held the lock; a lost lock is one
+that was held past its lock time and expired.
+
+    python lock_stats.py
+"""
+from purpurite import redisutil
+
+
+def main():
+    stats = redisutil.lock_stats()
+    print("{0:<32} {1:>9} {2:>9} {3:>6} {4:>8}".format(
+        "lock", "acquired", "contended", "lost", "skipped"))
+    for lock_name, counts in sorted(stats.items()):
+        attempts = counts["acquired"] + counts["contended"]
+        print("{0:<32} {1:>9} {2:>9} {3:>6} {4:>7.1f}%".format(
+            lock_name, counts["acquired"], counts["contended"],
+            counts["lost"], 100.0 * counts["contended"] / max(attempts, 1)))
+
+
+if __name__ == "__main__":
+    main()
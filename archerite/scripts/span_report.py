@@ -0,0 +1,66 @@
+"""
+Summarise the timing spans recorded by purpurite.tracing.
+
+Copy the span files from the controller and worker nodes (TRACE_PATH in
+purpurite.config) and run:
+
+    python span_report.py spans-*.jsonl
+
+to print the latency of every stage, or add --histogram to also draw
+each stage's latency histogram. --job limits the report to one job.
+"""
+import argparse
+
+from purpurite import tracing
+
+
+def bucket_label(i):
+    if i == len(tracing.HISTOGRAM_BUCKETS):
+        return "> {0}".format(format_seconds(tracing.HISTOGRAM_BUCKETS[-1]))
+    return "<= {0}".format(format_seconds(tracing.HISTOGRAM_BUCKETS[i]))
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return "{0:.0f}ms".format(seconds * 1000)
+    return "{0:.1f}s".format(seconds)
+
+
+def print_histogram(summary, width=50):
+    counts = summary["histogram"]
+    used = [i for i, count in enumerate(counts) if count]
+    peak = max(counts)
+    for i in range(used[0], used[-1] + 1):
+        print("    {0:>10} {1:>7} {2}".format(
+            bucket_label(i), counts[i],
+            "#" * int(round(width * counts[i] / float(peak)))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--job", type=int, help="only report this job")
+    parser.add_argument("--histogram", action="store_true",
+                        help="draw each stage's latency histogram")
+    args = parser.parse_args()
+    spans = tracing.load_spans(args.paths)
+    if args.job:
+        spans = (span for span in spans if span.get("job") == args.job)
+    summaries = tracing.stage_histograms(spans)
+    print("{0:<16} {1:>7} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}".format(
+        "stage", "count", "errors", "total", "p50", "p90", "p99", "max"))
+    for stage, summary in sorted(summaries.items(),
+                                 key=lambda item: -item[1]["total"]):
+        print("{0:<16} {1:>7} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}"
+              .format(stage, summary["count"], summary["errors"],
+                      format_seconds(summary["total"]),
+                      format_seconds(summary["p50"]),
+                      format_seconds(summary["p90"]),
+                      format_seconds(summary["p99"]),
+                      format_seconds(summary["max"])))
+        if args.histogram:
+            print_histogram(summary)
+
+
+if __name__ == "__main__":
+    main()
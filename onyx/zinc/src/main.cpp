@@ -7,6 +7,8 @@
 //
 
 #include <stdio.h>
+#include <stdint.h>
+#include <unistd.h>
 #include <iostream>
 #include <fstream>
 #include <string>
@@ -29,7 +31,8 @@ enum optionIndex
   ONYX_FILE,
   SHIFTS_FILE,
   WAIT_START,
-  DEBUG_LAYER
+  DEBUG_LAYER,
+  SERVE_MODE
 };
 
 // Helper for checking a CLI argument exists
@@ -66,6 +69,8 @@ const option::Descriptor usage[] =
       "  --pause, -p \tWaits for a key-press before running"},
   {DEBUG_LAYER, 0, "l", "pause", Arg::Required,
       "  --debuglayer, -l \tWrites additional debug info to a GDS layer"},
+  {SERVE_MODE, 0, "w", "serve", Arg::None,
+      "  --serve, -w \tProcess length-prefixed WorkItems from stdin until EOF"},
   {0, 0, 0, 0, 0, 0}
 };
 
@@ -79,6 +84,7 @@ struct RunOptions
   bool hasInputFile;
   bool debug;
   bool waitStart;
+  bool serveMode;
   std::string outputFile;
   std::string inputFile;
   std::string onyxFile;
@@ -94,6 +100,7 @@ struct RunOptions
     hasInputFile = false;
     debug = false;
     waitStart = false;
+    serveMode = false;
     outputDebugLayer = false;
   }
 };
@@ -131,6 +138,10 @@ RunOptions parseOptions(int argc, char* argv[])
   if (options[WAIT_START])
     runOptions.waitStart = true;
 
+  // check for serve mode
+  if (options[SERVE_MODE])
+    runOptions.serveMode = true;
+
   // if in manual mode, expect onyx file and shifts file
   if (options[MANUAL_MODE])
   {
@@ -468,6 +479,93 @@ bool runManualMode(const RunOptions& options)
   return true;
 }
 
+/*
+ * Reads exactly length bytes from a file descriptor
+ *
+ * @param fd File descriptor to read from
+ * @param buffer Buffer to fill
+ * @param length Number of bytes to read
+ * @return true on success, false on EOF or error
+ */
+bool readFully(int fd, char* buffer, size_t length)
+{
+  while (length > 0)
+  {
+    ssize_t count = read(fd, buffer, length);
+    if (count <= 0)
+      return false;
+    buffer += count;
+    length -= count;
+  }
+  return true;
+}
+
+/*
+ * Writes exactly length bytes to a file descriptor
+ *
+ * @param fd File descriptor to write to
+ * @param buffer Data to write
+ * @param length Number of bytes to write
+ * @return true on success, false on error
+ */
+bool writeFully(int fd, const char* buffer, size_t length)
+{
+  while (length > 0)
+  {
+    ssize_t count = write(fd, buffer, length);
+    if (count <= 0)
+      return false;
+    buffer += count;
+    length -= count;
+  }
+  return true;
+}
+
+/*
+ * Processes WorkItems until stdin is closed. Each WorkItem and
+ * WorkResult is framed by its length as a 4-byte big-endian integer.
+ * stdout is reserved for the frames, so anything else printed goes
+ * to stderr.
+ *
+ * @param options RunOptions parsed from CLI
+ * @return true when stdin was closed cleanly, false on error
+ */
+bool runServeMode(const RunOptions& options)
+{
+  int frameOutput = dup(STDOUT_FILENO);
+  dup2(STDERR_FILENO, STDOUT_FILENO);
+
+  std::string buffer;
+  while (true)
+  {
+    unsigned char header[4];
+    if (!readFully(STDIN_FILENO, (char*)header, 4))
+      return true;
+    uint32_t length = (header[0] << 24) | (header[1] << 16) |
+      (header[2] << 8) | header[3];
+    buffer.resize(length);
+    if (length && !readFully(STDIN_FILENO, &buffer[0], length))
+      return false;
+
+    zinc::WorkItem workItem;
+    zinc::WorkResult workResult;
+    if (workItem.ParseFromString(buffer))
+      processWorkItem(workItem, workResult, options.debug);
+    else
+      createErrorWorkResult(workResult, "Could not parse WorkItem");
+
+    workResult.SerializeToString(&buffer);
+    length = buffer.size();
+    header[0] = (length >> 24) & 0xff;
+    header[1] = (length >> 16) & 0xff;
+    header[2] = (length >> 8) & 0xff;
+    header[3] = length & 0xff;
+    if (!writeFully(frameOutput, (const char*)header, 4) ||
+        !writeFully(frameOutput, buffer.data(), length))
+      return false;
+  }
+}
+
 int main(int argc, char* argv[])
 {
   // verify that the version of Google protobuf in the zinc.pb.h header
@@ -491,6 +589,12 @@ int main(int argc, char* argv[])
     if (!runManualMode(options))
       return 1;
   }
+  else if (options.serveMode)
+  {
+    // long-lived worker fed by xenotime over pipes
+    if (!runServeMode(options))
+      return 1;
+  }
   else
   {
     // create WorkResult first so we can send errors if necessary
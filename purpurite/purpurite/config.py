@@ -32,7 +32,10 @@ CELERY_ROUTES = {
     'archerite.contasks.queue_new_jobs': {'queue': 'controller'},
     'archerite.contasks.fetch_onyx_file': {'queue': 'controller'},
     'archerite.contasks.fetch_shifts_file': {'queue': 'controller'},
+    'archerite.contasks.prefetch_files': {'queue': 'controller'},
     'archerite.contasks.launch_routing': {'queue': 'controller'},
+    'archerite.contasks.launch_batch_routing': {'queue': 'controller'},
+    'archerite.contasks.watch_routing': {'queue': 'controller'},
     'archerite.contasks.output_files': {'queue': 'controller'}
 }
 
@@ -40,10 +43,19 @@ CELERY_ROUTES = {
 REDIS_HOST = "10.78.56.3"
 REDIS_PORT = 6379
 REDIS_DB = 0
+# Connections each process keeps open to redis
+REDIS_MAX_CONNECTIONS = 32
+# Seconds to wait on a redis socket, long enough for GDS results
+REDIS_SOCKET_TIMEOUT = 120
+# Seconds between pings of the pooled redis connections
+REDIS_HEALTH_CHECK_INTERVAL = 30
 
 # Riemann connection info
 RIEMANN_HOST = "10.78.56.4"
 RIEMANN_PORT = 5555
 
+# JSON lines file each node appends timing spans to, None to disable
+TRACE_PATH = "/var/tmp/archerite_spans.jsonl"
+
 HOST = socket.gethostbyname(socket.gethostname())
 
@@ -30,6 +30,32 @@ def create_db_session():
     session = sessionmaker(bind=engine)()
     return session
 
+
+def check_fence(db, lock_name, fence):
+    """
+    Record fence as the newest holder of lock_name to write.
+
+    Call before committing work done under the lock. The UPDATE only
+    matches when fence is newer than the recorded one and holds the row
+    until commit, so a holder whose lock expired while it was paused
+    can't commit over the next holder's work. Returns False when a
+    newer holder already wrote, and the caller should roll back. The
+    lock_fences table is created by migrations/lock_fences.sql.
+    """
+    updated = db.query(model.LockFence)\
+                .filter(model.LockFence.name == lock_name,
+                        model.LockFence.fence < fence)\
+                .update({model.LockFence.fence: fence},
+                        synchronize_session=False)
+    if updated:
+        return True
+    if db.query(model.LockFence).filter_by(name=lock_name).first():
+        return False
+    db.add(model.LockFence(name=lock_name, fence=fence))
+    db.flush()
+    return True
+
+
 def get_db_job(job_id, status=None, sub_status=None):
     db = create_db_session()
     job = db.query(model.Job).filter_by(id=job_id).first()
@@ -0,0 +1,3 @@
+-- Adds jobs.routing_time, see model.Job.
+-- Run once against databases created before the column was added.
+ALTER TABLE jobs ADD COLUMN routing_time FLOAT NULL;
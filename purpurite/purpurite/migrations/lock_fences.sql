@@ -0,0 +1,9 @@
+-- Creates lock_fences, see model.LockFence and dbutil.check_fence.
+-- Run once before deploying controllers that check fences. InnoDB is
+-- needed for check_fence's UPDATE to hold the row until commit; lock
+-- names are ASCII, and latin1 keeps the key within InnoDB's index limit.
+CREATE TABLE IF NOT EXISTS lock_fences (
+    name VARCHAR(256) NOT NULL,
+    fence INTEGER NULL,
+    PRIMARY KEY (name)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
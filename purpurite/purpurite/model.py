@@ -115,6 +115,23 @@ class Job(Base):
     unit_count = Column(Integer)
     units_good = Column(Integer)
     final_yield = Column(Float)
+    # total seconds spent routing the job's units, summed over workranges;
+    # existing databases need migrations/job_routing_time.sql
+    routing_time = Column(Float)
+
+
+class LockFence(Base):
+    """
+    The newest fencing token to have written under a redis lock.
+
+    Existing databases need migrations/lock_fences.sql before
+    dbutil.check_fence runs.
+    """
+
+    __tablename__ = 'lock_fences'
+
+    name = Column(String(256), primary_key=True)
+    fence = Column(Integer)
 
 
 def job_status_to_string(status):
@@ -9,11 +9,33 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 
 from painite import zinc_pb2
 from google.protobuf import text_format
-import tempfile
+import math
 
 
 # The size of the range used to block onyx work.
 WORK_BLOCK_SIZE = 400
+# The smallest range worth a routing task of its own.
+MIN_BLOCK_SIZE = 25
+# Longest a routing task should take when there is routing history, so
+# one slow range doesn't hold up the whole job.
+TARGET_BLOCK_SECONDS = 120
+# Routing cost of an out of spec unit relative to an in spec unit.
+OUT_OF_SPEC_UNIT_COST = 0.2
+
+# Protobuf wire types used when building work items by hand.
+WIRETYPE_VARINT = 0
+WIRETYPE_FIXED64 = 1
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_FIXED32 = 5
+
+# Field numbers used when scanning serialized messages.
+WORK_RESULT_ROUTING_RESULTS_FIELD = 4
+ROUTING_RESULTS_ROUTED_UNITS_FIELD = 3
+ROUTED_UNIT_ROUTING_GOOD_FIELD = 3
+DESIGN_LAYERS_FIELD = 7
+SHIFTS_PANEL_ID_FIELD = 3
+SHIFTS_UNITS_FIELD = 4
+LAYER_ROUTE_DEFINITIONS_FIELD = 6
 
 
 class DesignDataMisMatchException(Exception):
@@ -60,17 +82,89 @@ def shifts_from_data(design_number, design_rev, panel_id, shift_file_data):
     """
     Returns a Shifts protobuf object merged with the data.
 
-    Create a Shifts protobuf object merge it with shift_file_data. If
-    the panel_id doesn't match raise a ShiftDataMisMatchException,
-    otherwise return the shifts protobuf object.
+    Create a Shifts protobuf object merge it with shift_file_data, the
+    text format of a .onyxshifts file. If the panel_id doesn't match
+    raise a ShiftDataMisMatchException, otherwise return the shifts
+    protobuf object.
     """
     shifts = zinc_pb2.Shifts()
     text_format.Merge(shift_file_data, shifts)
-    if panel_id.lower() != shifts.panelID.lower():
+    check_shifts_panel_id(design_number, design_rev, panel_id,
+                          shifts.panelID)
+    return shifts
+
+
+def shifts_from_binary_data(design_number, design_rev, panel_id,
+                            shifts_data):
+    """
+    Returns a Shifts protobuf object parsed from serialized Shifts.
+
+    Like shifts_from_data, for the shifts as they are stored in redis.
+    """
+    shifts = zinc_pb2.Shifts()
+    shifts.ParseFromString(shifts_data)
+    check_shifts_panel_id(design_number, design_rev, panel_id,
+                          shifts.panelID)
+    return shifts
+
+
+def check_shifts_panel_id(design_number, design_rev, panel_id,
+                          shifts_panel_id):
+    """
+    Raise a ShiftDataMisMatchException if the panel ID of the shifts
+    doesn't match panel_id.
+    """
+    if panel_id.lower() != shifts_panel_id.lower():
         raise ShiftDataMisMatchException(
             "Panel ID {0} in shift file does not match {1}_{2}_{3}!".format(
-                shifts.panelID, design_number, design_rev, panel_id))
-    return shifts
+                shifts_panel_id, design_number, design_rev, panel_id))
+
+
+def shifts_data_panel_id(shifts_data):
+    """
+    Returns the panelID of serialized Shifts without parsing them.
+    """
+    for field_number, wire_type, start, end in iter_fields(shifts_data):
+        if field_number == SHIFTS_PANEL_ID_FIELD:
+            return shifts_data[start:end].decode("utf-8")
+    raise ShiftDataMisMatchException("Shifts have no panel ID!")
+
+
+def sliced_shifts_data(shifts_data, start, end):
+    """
+    Returns serialized Shifts holding only units start to end of
+    shifts_data.
+
+    Every other field, the reference units and global offset included,
+    is kept as it is. The fields are copied from the wire format in
+    order without parsing the Shifts.
+    """
+    spans = []
+    index = 0
+    field_start = 0
+    for field_number, wire_type, value_start, field_end in iter_fields(
+            shifts_data):
+        keep = True
+        if field_number == SHIFTS_UNITS_FIELD:
+            keep = start <= index <= end
+            index += 1
+        if keep:
+            if spans and spans[-1][1] == field_start:
+                spans[-1] = (spans[-1][0], field_end)
+            else:
+                spans.append((field_start, field_end))
+        field_start = field_end
+    return b"".join(shifts_data[span_start:span_end]
+                    for span_start, span_end in spans)
+
+
+def shifts_data_unit_count(shifts_data):
+    """
+    Returns the number of units in serialized Shifts without parsing
+    them.
+    """
+    return sum(1 for field in iter_fields(shifts_data)
+               if field[0] == SHIFTS_UNITS_FIELD)
 
 
 def requires_autorouting(design):
@@ -85,24 +179,240 @@ def requires_autorouting(design):
     return False
 
 
-def workranges_for_units(num_units):
+class AutoroutingScanner(object):
+    """
+    File-like object scanning a serialized Design written to it a chunk
+    at a time for route definitions, as requires_autorouting checks the
+    parsed Design, and writing the chunks on to fileobj if given.
+
+    Only the keys and lengths of fields are decoded. Values other than
+    the layers are skipped as they pass, so no more than a partial key
+    or length is held between chunks. requires_routing is True once a
+    layer with route definitions has been written.
     """
-    Return a list of unit ranges.
 
-    Create a list of 2-tuples of ranges between 0 and num_units - 1.
-    The chunk size is configured using WORK_BLOCK_SIZE.
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.requires_routing = False
+        self.pending = b""
+        self.skip = 0
+        # bytes left of the layer being scanned, None outside of one
+        self.layer_left = None
+
+    def write(self, data):
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        if not self.requires_routing:
+            self.scan(self.pending + data if self.pending else data)
+
+    def scan(self, data):
+        pos = 0
+        while pos < len(data):
+            if self.skip:
+                skipped = min(self.skip, len(data) - pos)
+                self.skip -= skipped
+                self.consume(skipped)
+                pos += skipped
+                continue
+            if self.layer_left == 0:
+                self.layer_left = None
+            header = decode_partial_field_header(data, pos)
+            if header is None:
+                break
+            field_number, wire_type, size, value_pos = header
+            self.consume(value_pos - pos)
+            pos = value_pos
+            if self.layer_left is not None:
+                if field_number == LAYER_ROUTE_DEFINITIONS_FIELD:
+                    self.requires_routing = True
+                    return
+                self.skip = size
+            elif (field_number == DESIGN_LAYERS_FIELD and
+                    wire_type == WIRETYPE_LENGTH_DELIMITED):
+                self.layer_left = size
+            else:
+                self.skip = size
+        self.pending = data[pos:]
+
+    def consume(self, size):
+        if self.layer_left is not None:
+            self.layer_left -= size
+
+
+def decode_partial_varint(data, pos):
+    """
+    Like decode_varint, but return None if data ends inside the varint.
+    """
+    value = 0
+    shift = 0
+    while pos < len(data):
+        byte = ord(data[pos:pos + 1])
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    return None
+
+
+def decode_partial_field_header(data, pos):
+    """
+    Return (field_number, wire_type, value size, value position) for the
+    field at pos in data, or None if data ends before its value. A
+    varint value is read as part of the header and has size 0.
     """
+    key = decode_partial_varint(data, pos)
+    if key is None:
+        return None
+    key, pos = key
+    field_number, wire_type = key >> 3, key & 0x7
+    if wire_type == WIRETYPE_VARINT:
+        value = decode_partial_varint(data, pos)
+        if value is None:
+            return None
+        return field_number, wire_type, 0, value[1]
+    elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+        length = decode_partial_varint(data, pos)
+        if length is None:
+            return None
+        return field_number, wire_type, length[0], length[1]
+    elif wire_type == WIRETYPE_FIXED64:
+        return field_number, wire_type, 8, pos
+    elif wire_type == WIRETYPE_FIXED32:
+        return field_number, wire_type, 4, pos
+    raise ValueError("Unsupported wire type {0}!".format(wire_type))
+
+
+def workrange_count(num_units, workers=None, unit_seconds=None):
+    """
+    Returns how many ranges to split num_units into.
+
+    With a per-unit routing time from earlier jobs, use one range per
+    worker unless that makes a range take longer than
+    TARGET_BLOCK_SECONDS, then use as many full rounds of ranges across
+    the workers as needed. Without one, use WORK_BLOCK_SIZE ranges
+    rounded up to full rounds across the workers. Never make ranges
+    smaller than MIN_BLOCK_SIZE units.
+    """
+    if num_units <= 0:
+        return 0
+    workers = max(workers or 1, 1)
+    if unit_seconds:
+        block_seconds = num_units * unit_seconds / workers
+        rounds = max(int(math.ceil(block_seconds / TARGET_BLOCK_SECONDS)), 1)
+    else:
+        blocks = int(math.ceil(float(num_units) / WORK_BLOCK_SIZE))
+        rounds = int(math.ceil(float(blocks) / workers))
+    max_blocks = max(num_units // MIN_BLOCK_SIZE, 1)
+    return min(rounds * workers, max_blocks)
+
+
+def unit_costs(in_spec):
+    """
+    Returns the relative routing cost of each unit.
+
+    in_spec is a string with a '1' for each in spec unit and a '0' for
+    each out of spec unit, in Shifts order.
+    """
+    return [1.0 if flag == '1' else OUT_OF_SPEC_UNIT_COST
+            for flag in in_spec]
+
+
+def even_ranges(num_units, block_count):
+    """
+    Returns (start, end) ranges splitting num_units into block_count
+    ranges whose sizes differ by at most one.
+    """
+    size, extra = divmod(num_units, block_count)
+    ranges = []
+    start = 0
+    for i in range(block_count):
+        end = start + size + (1 if i < extra else 0) - 1
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def cost_ranges(costs, block_count):
+    """
+    Returns (start, end) ranges splitting units into block_count ranges
+    of about the same total cost.
+
+    A range is closed once the running cost reaches its share of the
+    total, or when every remaining unit is needed for a range of its
+    own.
+    """
+    total = float(sum(costs))
+    if not total:
+        return even_ranges(len(costs), block_count)
     ranges = []
     start = 0
-    i = 0
-    while start < num_units:
-        end = min(start + WORK_BLOCK_SIZE - 1, num_units - 1)
-        ranges.append((i, start, end))
-        start += WORK_BLOCK_SIZE
-        i += 1
+    cost = 0.0
+    for i, unit_cost in enumerate(costs):
+        cost += unit_cost
+        blocks_left = block_count - len(ranges)
+        if blocks_left <= 1:
+            break
+        if (cost >= total * (len(ranges) + 1) / block_count or
+                len(costs) - i - 1 < blocks_left):
+            ranges.append((start, i))
+            start = i + 1
+    ranges.append((start, len(costs) - 1))
     return ranges
 
 
+def workranges_for_units(num_units, block_count=None, costs=None):
+    """
+    Return a list of unit ranges.
+
+    Create a list of (index, start, end) 3-tuples of ranges between 0
+    and num_units - 1. Without a block_count the chunk size is
+    configured using WORK_BLOCK_SIZE. Otherwise split into block_count
+    ranges, balancing the per-unit costs when they are given and unit
+    counts when they aren't.
+    """
+    if not block_count:
+        ranges = []
+        start = 0
+        i = 0
+        while start < num_units:
+            end = min(start + WORK_BLOCK_SIZE - 1, num_units - 1)
+            ranges.append((i, start, end))
+            start += WORK_BLOCK_SIZE
+            i += 1
+        return ranges
+    block_count = min(block_count, num_units)
+    if block_count <= 0:
+        return []
+    if costs is not None and len(costs) == num_units:
+        spans = cost_ranges(costs, block_count)
+    else:
+        spans = even_ranges(num_units, block_count)
+    return [(i, start, end) for i, (start, end) in enumerate(spans)]
+
+
+def split_workrange(workrange):
+    """
+    Returns the two halves of an (index, start, end) workrange.
+
+    The halves are indexed "<index>.0" and "<index>.1" so their routing
+    results are kept apart from the whole range's.
+    """
+    index, start, end = workrange
+    middle = (start + end) // 2
+    return [("{0}.0".format(index), start, middle),
+            ("{0}.1".format(index), middle + 1, end)]
+
+
+def workrange_ancestors(workrange):
+    """
+    Returns the indices of the workranges a split workrange came from,
+    outermost first.
+    """
+    parts = str(workrange[0]).split(".")
+    return [".".join(parts[:i]) for i in range(1, len(parts))]
+
+
 def error_work_result(work_type, error_msg):
     """
     Return an error WorkResult protobuf object.
@@ -135,6 +445,153 @@ def zinc_routing_work_item(design, shifts, start, end):
     return work_item
 
 
+def encode_varint(value):
+    """
+    Return the protobuf base 128 varint encoding of a non-negative int.
+    """
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(0x80 | (value & 0x7f))
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varint(data, pos):
+    """
+    Return the varint in data at pos and the position after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos:pos + 1])
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def iter_fields(data, start=0, end=None):
+    """
+    Yield (field_number, wire_type, start, end) for each field of a
+    serialized protobuf message.
+
+    Only the keys and lengths are decoded, nested messages are skipped
+    over. For length-delimited fields start and end bound the value
+    without its length prefix.
+    """
+    pos = start
+    if end is None:
+        end = len(data)
+    while pos < end:
+        key, pos = decode_varint(data, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        value_start = pos
+        if wire_type == WIRETYPE_VARINT:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+            length, value_start = decode_varint(data, pos)
+            pos = value_start + length
+        elif wire_type == WIRETYPE_FIXED64:
+            pos += 8
+        elif wire_type == WIRETYPE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError("Unsupported wire type {0}!".format(wire_type))
+        yield field_number, wire_type, value_start, pos
+
+
+def field_key(field_number, wire_type):
+    """
+    Return the encoded key of a protobuf field.
+    """
+    return encode_varint((field_number << 3) | wire_type)
+
+
+def length_delimited_prefix(field_number, length):
+    """
+    Return the key and length prefix of a length-delimited protobuf field.
+    """
+    return field_key(field_number, WIRETYPE_LENGTH_DELIMITED) +\
+        encode_varint(length)
+
+
+def string_field(field_number, value):
+    """
+    Return an encoded protobuf string field.
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return length_delimited_prefix(field_number, len(value)) + value
+
+
+def varint_field(field_number, value):
+    """
+    Return an encoded protobuf varint field.
+    """
+    return field_key(field_number, WIRETYPE_VARINT) + encode_varint(value)
+
+
+def work_item_data(work_type, field_number, body):
+    """
+    Return a WorkItem as a list of byte strings given the work type, the
+    field number of the sub work item and its body as a list of byte
+    strings.
+    """
+    length = sum(len(chunk) for chunk in body)
+    return [varint_field(1, work_type) +
+            length_delimited_prefix(field_number, length)] + body
+
+
+def zinc_routing_work_item_data(design_data, shifts_data, panel_id,
+                                start, end, slice_shifts=False):
+    """
+    Return a routing WorkItem serialized as a list of byte strings.
+
+    The WorkItem wire format is built directly and the serialized
+    design and shifts are spliced in as length-delimited fields, so the
+    design is never copied into a message or encoded again. Joining the
+    list gives the bytes zinc_routing_work_item would serialize to.
+
+    With slice_shifts only the units start to end of the shifts are
+    sent, see sliced_shifts_data, and the work range is moved to start
+    at 0 to match. zinc copies each Unit with its number into the
+    RoutedUnit, so the results map back to the panel the same way.
+    """
+    if slice_shifts:
+        shifts_data = sliced_shifts_data(shifts_data, start, end)
+        start, end = 0, end - start
+    work_range = varint_field(1, start) + varint_field(2, end)
+    body = [string_field(1, panel_id) +
+            length_delimited_prefix(2, len(design_data)),
+            design_data,
+            length_delimited_prefix(3, len(shifts_data)),
+            shifts_data,
+            length_delimited_prefix(4, len(work_range)) + work_range]
+    return work_item_data(zinc_pb2.ROUTING, 2, body)
+
+
+def zinc_create_gds_work_item_data(design_data, shifts_data, panel_id,
+                                   routed_units_data=()):
+    """
+    Return a Create GDS WorkItem serialized as a list of byte strings.
+
+    Like zinc_routing_work_item_data the serialized design, shifts and
+    each serialized RoutedUnit in routed_units_data are spliced in
+    without being parsed.
+    """
+    body = [string_field(1, panel_id) +
+            length_delimited_prefix(2, len(design_data)),
+            design_data,
+            length_delimited_prefix(3, len(shifts_data)),
+            shifts_data]
+    for routed_unit_data in routed_units_data:
+        body.append(length_delimited_prefix(4, len(routed_unit_data)))
+        body.append(routed_unit_data)
+    return work_item_data(zinc_pb2.CREATE_GDS, 3, body)
+
+
 def zinc_create_gds_work_item(design, shifts):
     """
     Return a Create GDS WorkItem protobuf object.
@@ -162,6 +619,32 @@ def zinc_routed_units_from_result_data(result_data):
     return result.routingWorkResults.routedUnits
 
 
+def zinc_routed_units_data_from_result_data(result_data):
+    """
+    Return the serialized routed units in serialized WorkResult data.
+
+    The WorkResult is scanned rather than parsed, so each RoutedUnit is
+    returned as the bytes it was encoded with.
+    """
+    for field_number, wire_type, start, end in iter_fields(result_data):
+        if field_number == WORK_RESULT_ROUTING_RESULTS_FIELD:
+            return [result_data[unit_start:unit_end]
+                    for number, wire, unit_start, unit_end
+                    in iter_fields(result_data, start, end)
+                    if number == ROUTING_RESULTS_ROUTED_UNITS_FIELD]
+    return []
+
+
+def routed_unit_good(routed_unit_data):
+    """
+    Return True if a serialized RoutedUnit was routed successfully.
+    """
+    for field_number, wire_type, start, end in iter_fields(routed_unit_data):
+        if field_number == ROUTED_UNIT_ROUTING_GOOD_FIELD:
+            return decode_varint(routed_unit_data, start)[0] != 0
+    return False
+
+
 def zinc_work_result_from_data(data):
     """
     Return a WorkResult protobuf object using zinc data.
@@ -173,18 +656,6 @@ def zinc_work_result_from_data(data):
     return result
 
 
-def tmpfile_for_workitem(work_item):
-    """
-    Create a temp file containing work_item.
-
-    Serialize and write work_item to a tempfile and return it.
-    """
-    handle, path = tempfile.mkstemp()
-    with open(path, 'wb') as file:
-        file.write(work_item.SerializeToString())
-    return path
-
-
 def work_result_from_data(data):
     """
     Return a work result containing data.
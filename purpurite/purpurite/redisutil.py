@@ -7,39 +7,290 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 """
 
 
+import hashlib
+import os
+import time
+
 import redis
 import config
 
 
+# Store a routing result unless another copy of the workrange already
+# did, and record how long zinc took for the one that won.
+STORE_ROUTING_RESULT_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('HSET', KEYS[2], 'seconds', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# Take a lock unless it is held, setting it to a new fencing token from
+# the lock's counter, and count whether it was acquired or contended.
+ACQUIRE_LOCK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[3], ARGV[2] .. '.contended', 1)
+    return false
+end
+local fence = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], fence, 'PX', ARGV[1])
+redis.call('HINCRBY', KEYS[3], ARGV[2] .. '.acquired', 1)
+return fence
+"""
+
+# Delete a lock only while it still holds the caller's token.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+redis.call('HINCRBY', KEYS[2], ARGV[2] .. '.lost', 1)
+return 0
+"""
+
+# Extend a lock only while it still holds the caller's token.
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+redis.call('HINCRBY', KEYS[2], ARGV[3] .. '.lost', 1)
+return 0
+"""
+
+# hash of lock acquired, contended and lost counts
+LOCK_STATS_KEY = "locks.stats"
+# seconds a RedisWriter's partial key outlives its last write, so a
+# crashed copy doesn't leave it behind
+PARTIAL_EXPIRE_TIME = 60 * 10
+
+# the process-wide client and when its pool was last checked, see
+# redis_connect()
+client = None
+checked_time = 0
+
+
 def redis_connect():
     """
-    Create a connection to the redis server using config.
+    Returns the process-wide redis client.
+
+    Create the client on first use with a connection pool built from
+    config, so helpers share connections instead of opening one per
+    call. Ping the server at most once per
+    config.REDIS_HEALTH_CHECK_INTERVAL seconds and drop the pooled
+    connections when it fails, so a restarted server doesn't leave dead
+    sockets in the pool. The pool reconnects after a fork by itself.
     """
-    return redis.StrictRedis(host=config.REDIS_HOST, port=config.REDIS_PORT,
-                             db=config.REDIS_DB)
+    global client, checked_time
+    if not client:
+        pool = redis.ConnectionPool(
+            host=config.REDIS_HOST, port=config.REDIS_PORT,
+            db=config.REDIS_DB,
+            max_connections=config.REDIS_MAX_CONNECTIONS,
+            socket_timeout=config.REDIS_SOCKET_TIMEOUT)
+        client = redis.StrictRedis(connection_pool=pool)
+        checked_time = time.time()
+    elif time.time() - checked_time > config.REDIS_HEALTH_CHECK_INTERVAL:
+        checked_time = time.time()
+        try:
+            client.ping()
+        except redis.ConnectionError:
+            client.connection_pool.disconnect()
+    return client
 
 
-def acquire_lock(lock_name, lock_time):
+class RedisWriter(object):
+    """
+    File-like object storing what is written to it at a redis key.
+
+    Chunks are APPENDed to a temporary key as they are written and
+    close() renames it onto the key, so the value is never held in
+    memory whole and readers never see part of it. discard() drops it.
+    Each write renews PARTIAL_EXPIRE_TIME on the temporary key.
     """
-    Create a lock lock_name.
 
-    SETNX and EXPIRE using lock_name and lock_time.
+    def __init__(self, key, expire_time=None):
+        self.key = key
+        self.expire_time = expire_time
+        self.partial_key = "{0}.partial.{1}".format(key, os.getpid())
+        self.size = 0
+
+    def write(self, data):
+        pipe = redis_connect().pipeline(transaction=False)
+        if not self.size:
+            pipe.delete(self.partial_key)
+        pipe.append(self.partial_key, data)
+        pipe.expire(self.partial_key, PARTIAL_EXPIRE_TIME)
+        pipe.execute()
+        self.size += len(data)
+
+    def close(self):
+        pipe = redis_connect().pipeline(transaction=True)
+        pipe.rename(self.partial_key, self.key)
+        if self.expire_time:
+            pipe.expire(self.key, self.expire_time)
+        else:
+            pipe.persist(self.key)
+        pipe.execute()
+
+    def discard(self):
+        redis_connect().delete(self.partial_key)
+
+
+def set_values(items, expire_time=None, transaction=False):
     """
-    r = redis_connect()
-    if r.setnx(lock_name, 1):
-        r.expire(lock_name, lock_time)
-        return True
-    return False
+    SET each (key, value) pair of items in one round trip.
+
+    Use SETEX when an expire_time is given so no key is ever left
+    without one. With transaction wrap the SETs in MULTI/EXEC so
+    readers see all of them or none, in order.
+    """
+    pipe = redis_connect().pipeline(transaction=transaction)
+    for key, value in items:
+        if expire_time:
+            pipe.setex(key, expire_time, value)
+        else:
+            pipe.set(key, value)
+    pipe.execute()
+
+
+def expire_keys(keys, expire_time):
+    """
+    EXPIRE each of keys in expire_time seconds in one round trip.
+    """
+    pipe = redis_connect().pipeline(transaction=False)
+    for key in keys:
+        pipe.expire(key, expire_time)
+    pipe.execute()
+
+
+def store_routing_result(job, workrange, result_data, seconds, expire_time):
+    """
+    Store the routing results of a workrange unless they already exist.
 
+    Run STORE_ROUTING_RESULT_SCRIPT so setting the results, their
+    expire time and the zinc seconds happen atomically. Returns True if
+    these results were stored and False if another copy of the
+    workrange got there first.
+    """
+    script = redis_connect().register_script(STORE_ROUTING_RESULT_SCRIPT)
+    return bool(script(keys=[routing_results_key(job, workrange),
+                             routing_timing_key(job, workrange)],
+                       args=[result_data, expire_time, seconds]))
+
+
+def start_routing(job, workrange, indices, expire_time):
+    """
+    Returns the results key of the first workrange in indices that is
+    already routed, None if none are.
 
-def release_lock(lock_name):
+    indices are the workrange and those it was split from. Check for
+    their results and record when routing the workrange started, unless
+    a copy of it already started, in one round trip.
     """
-    Release a lock.
+    keys = [routing_results_key(job, (index,)) for index in indices]
+    timing_key = routing_timing_key(job, workrange)
+    pipe = redis_connect().pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+    pipe.hsetnx(timing_key, 'started', time.time())
+    pipe.expire(timing_key, expire_time)
+    replies = pipe.execute()
+    for key, routed in zip(keys, replies):
+        if routed:
+            return key
+    return None
 
-    DELETE a lock lock_name.
+
+def iter_values(keys, batch_size=16):
+    """
+    Yield (key, value) for each key in keys.
+
+    Values are fetched with one MGET per batch_size keys, so only one
+    batch of values is held at a time.
     """
     r = redis_connect()
-    r.delete(lock_name)
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        for key, value in zip(batch, r.mget(batch)):
+            yield key, value
+
+
+def acquire_lock(lock_name, lock_time):
+    """
+    Acquire the lock lock_name for lock_time seconds.
+
+    Run ACQUIRE_LOCK_SCRIPT so the lock is set with its expire time in
+    one SET PX, never leaving a lock that doesn't expire. Returns the
+    lock's fencing token, which is higher for every new holder, or None
+    if the lock is held.
+    """
+    script = redis_connect().register_script(ACQUIRE_LOCK_SCRIPT)
+    fence = script(keys=[lock_name, lock_name + '.fence', LOCK_STATS_KEY],
+                   args=[int(lock_time * 1000), lock_name])
+    return int(fence) if fence else None
+
+
+def renew_lock(lock_name, token, lock_time):
+    """
+    Extend the lock lock_name held with token to expire in lock_time
+    seconds.
+
+    Returns False if the lock expired and may have been taken by
+    another holder, who the caller must now leave to it.
+    """
+    script = redis_connect().register_script(RENEW_LOCK_SCRIPT)
+    return bool(script(keys=[lock_name, LOCK_STATS_KEY],
+                       args=[token, int(lock_time * 1000), lock_name]))
+
+
+def release_lock(lock_name, token):
+    """
+    Release the lock lock_name held with token.
+
+    Compare and delete in RELEASE_LOCK_SCRIPT so a holder whose lock
+    expired doesn't release the lock of the holder after it.
+    """
+    script = redis_connect().register_script(RELEASE_LOCK_SCRIPT)
+    return bool(script(keys=[lock_name, LOCK_STATS_KEY],
+                       args=[token, lock_name]))
+
+
+def lock_stats():
+    """
+    Returns a dict of lock name to its acquired, contended and lost
+    counts.
+
+    A contended count is a scan or queue run skipped because another
+    held the lock, a lost count one that held it too long and had it
+    expire.
+    """
+    stats = {}
+    for field, count in redis_connect().hgetall(LOCK_STATS_KEY).items():
+        lock_name, event = field.rsplit('.', 1)
+        stats.setdefault(lock_name, {"acquired": 0, "contended": 0,
+                                     "lost": 0})[event] = int(count)
+    return stats
+
+
+def design_index_key():
+    """
+    Returns the key of the hash indexing onyx design files by name.
+    """
+    return "designs.index"
+
+
+def design_index_refreshed_key():
+    """
+    Returns the key that exists while the design index is fresh.
+    """
+    return "designs.index.refreshed"
+
+
+def watch_listing_key(watch):
+    """
+    Returns the key of the hash holding the last listing of a watch's
+    measurement location.
+    """
+    return "watch.{0}.listing".format(watch.id)
 
 
 def routing_results_key(job, workrange):
@@ -52,6 +303,36 @@ def routing_results_key(job, workrange):
                                             workrange[0])
 
 
+def routing_timing_key(job, workrange):
+    """
+    Returns the key of the hash holding when routing a workrange
+    started and how many seconds zinc took.
+    """
+    return routing_results_key(job, workrange) + '.timing'
+
+
+def routing_progress(job, workranges):
+    """
+    Returns a (started, seconds, routed) tuple for each workrange.
+
+    started is when the first route task for the workrange began and
+    seconds how long zinc took for the winning one, either None when
+    not known yet. Pipeline one HMGET and EXISTS per workrange.
+    """
+    r = redis_connect()
+    pipe = r.pipeline(transaction=False)
+    for workrange in workranges:
+        pipe.hmget(routing_timing_key(job, workrange), 'started', 'seconds')
+        pipe.exists(routing_results_key(job, workrange))
+    replies = pipe.execute()
+    progress = []
+    for (started, seconds), routed in zip(replies[::2], replies[1::2]):
+        progress.append((float(started) if started else None,
+                         float(seconds) if seconds else None,
+                         bool(routed)))
+    return progress
+
+
 def gds_results_key(job):
     """
     Returns the key value for GDS results.
@@ -63,14 +344,123 @@ def gds_results_key(job):
 
 def measurement_file_data(measurement_file):
     """
-    Get the measurement file data.
+    Get the measurement file data, its serialized Shifts.
 
-    Connect and GET data using the measurement_file_key method
-    to get the key.
+    Connect and GET the digest of the Shifts using the
+    measurement_file_digest_key method to get the key, then get the
+    Shifts stored under it.
     """
-    key = measurement_file_key(measurement_file)
     r = redis_connect()
-    return r.get(key)
+    digest = r.get(measurement_file_digest_key(measurement_file))
+    if not digest:
+        return None
+    return shifts_data(digest)
+
+
+def measurement_file_shifts(measurement_file):
+    """
+    Returns the (digest, unit count) of a measurement file's Shifts.
+
+    MGET both with one round trip. Either is None when it isn't set.
+    """
+    r = redis_connect()
+    digest, count = r.mget([measurement_file_digest_key(measurement_file),
+                            measurement_file_count_key(measurement_file)])
+    return digest, int(count) if count else None
+
+
+def publish_shifts(measurement_file, shifts_data, unit_count, in_spec,
+                   status, expire_time):
+    """
+    Store the serialized Shifts of a measurement file and set its status.
+
+    The Shifts go in a hash under shifts_key, named by their SHA-1
+    digest, with their unit count and in spec unit count, so readers
+    can cache them by digest for good. The measurement file's digest,
+    count and in spec flags keys are set with status in one MULTI
+    transaction, so the status is never seen before the data, and
+    every key expires in expire_time seconds. Returns the digest.
+    """
+    digest = hashlib.sha1(shifts_data).hexdigest()
+    key = shifts_key(digest)
+    pipe = redis_connect().pipeline(transaction=True)
+    pipe.hmset(key, {"data": shifts_data,
+                     "units": unit_count,
+                     "in_spec": in_spec.count("1")})
+    pipe.expire(key, expire_time)
+    pipe.setex(measurement_file_digest_key(measurement_file), expire_time,
+               digest)
+    pipe.setex(measurement_file_count_key(measurement_file), expire_time,
+               unit_count)
+    pipe.setex(measurement_file_in_spec_key(measurement_file), expire_time,
+               in_spec)
+    pipe.setex(measurement_file_status_key(measurement_file), expire_time,
+               status)
+    pipe.execute()
+    return digest
+
+
+def shifts_data(digest):
+    """
+    Returns the serialized Shifts with digest, None if they expired.
+    """
+    return redis_connect().hget(shifts_key(digest), "data")
+
+
+def shifts_key(digest):
+    """
+    Returns the key of the serialized Shifts with digest.
+    """
+    return 'shifts.sha1.' + digest
+
+
+def measurement_file_state(measurement_file):
+    """
+    Returns the (status, count, in spec flags) of a measurement file.
+
+    MGET all three with one round trip. The count is an int and the
+    status NOT_LOADED (0) when they aren't set.
+    """
+    r = redis_connect()
+    status, count, in_spec = r.mget(
+        [measurement_file_status_key(measurement_file),
+         measurement_file_count_key(measurement_file),
+         measurement_file_in_spec_key(measurement_file)])
+    return (int(status) if status else 0,
+            int(count) if count else None,
+            in_spec)
+
+
+def job_file_states(jobs):
+    """
+    Returns the (onyx file status, requires routing, measurement file
+    state) of each of jobs.
+
+    MGET the keys of every job with one round trip. The statuses are
+    NOT_LOADED (0) when they aren't set, requires routing is read as
+    onyx_file_requires_routing does and the measurement file state is
+    as measurement_file_state returns it.
+    """
+    keys = []
+    for job in jobs:
+        keys.extend([onyx_file_status_key(job.onyx_file),
+                     onyx_file_requires_routing_key(job.onyx_file),
+                     measurement_file_status_key(job.measurement_file),
+                     measurement_file_count_key(job.measurement_file),
+                     measurement_file_in_spec_key(job.measurement_file)])
+    if not keys:
+        return []
+    values = redis_connect().mget(keys)
+    states = []
+    for i in range(0, len(values), 5):
+        onyx_status, requires_routing, status, count, in_spec =\
+            values[i:i + 5]
+        states.append((int(onyx_status) if onyx_status else 0,
+                       parse_requires_routing(requires_routing),
+                       (int(status) if status else 0,
+                        int(count) if count else None,
+                        in_spec)))
+    return states
 
 
 def measurement_file_status(measurement_file):
@@ -98,6 +488,13 @@ def measurement_file_count(measurement_file):
     return r.get(measurement_file_count_key(measurement_file))
 
 
+def measurement_file_in_spec_key(measurement_file):
+    """
+    Get the measurement file in spec flags key.
+    """
+    return measurement_file_key(measurement_file) + '.inspec'
+
+
 def measurement_file_count_key(measurement_file):
     """
     Get the measurement file count key.
@@ -112,11 +509,21 @@ def measurement_file_status_key(measurement_file):
     return measurement_file_key(measurement_file) + '.status'
 
 
+def measurement_file_digest_key(measurement_file):
+    """
+    Returns the key value for the digest of a measurement file's Shifts.
+    """
+    return measurement_file_key(measurement_file) + '.sha1'
+
+
 def measurement_file_key(measurement_file):
     """
     Get the measurement file key.
+
+    The prefix changed from 'shifts.' when the text format was stored
+    at this key, so those keys are never read.
     """
-    return 'shifts.' + measurement_file.design_number +\
+    return 'shifts.pb.' + measurement_file.design_number +\
         measurement_file.design_rev + measurement_file.panel_id
 
 
@@ -136,13 +543,27 @@ def onyx_file_status(onyx_file_name):
 
 def onyx_file_requires_routing(onyx_file_name):
     """
-    Returns True if the onyx file status exists, False otherwise.
+    Returns True if the onyx file requires routing, False otherwise.
 
-    Connect and GET the onyx file status and return a bool.
+    Connect and GET the onyx_file_requires_routing_key and parse it with
+    parse_requires_routing.
     """
-    key = onyx_file_status_key(onyx_file_name)
+    key = onyx_file_requires_routing_key(onyx_file_name)
     r = redis_connect()
-    return bool(r.get(key))
+    return parse_requires_routing(r.get(key))
+
+
+def parse_requires_routing(value):
+    """
+    Returns the bool stored at an onyx_file_requires_routing_key.
+
+    The flag is stored as 1 or 0; older controllers stored True or
+    False. A missing flag is read as True, so a design is routed
+    rather than skipped when it isn't known.
+    """
+    if value is None:
+        return True
+    return value in ("1", "True", b"1", b"True")
 
 
 def onyx_file_requires_routing_key(onyx_file_name):
@@ -7,18 +7,29 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 """
 
 
+import atexit
+from contextlib import contextmanager
 import hashlib
 from io import BytesIO
+import Queue
 import re
+import socket
+import threading
+import time
+import zlib
+
+from celery.signals import worker_process_shutdown
 
 from nmb.NetBIOS import NetBIOS
 
+from smb.base import NotConnectedError, SMBTimeout
 from smb.SMBConnection import SMBConnection
 
 import bernhard
 
 import config
 import model
+import redisutil
 
 
 
@@ -27,6 +38,32 @@ SMB_IGNORE_RE = [re.compile("\.\."),
                  re.compile(".*DS_Store")]
 smb_share_format = "//{0}/{1}/{2}"
 
+# seconds a NetBIOS name lookup is reused
+NETBIOS_TTL = 60 * 10
+# seconds an idle pooled connection is kept before it is closed
+IDLE_TIMEOUT = 60 * 5
+# seconds a pooled connection may sit idle before it is echoed to check
+# the server still has it open
+LIVENESS_INTERVAL = 30
+# idle connections kept per server, share and credentials
+MAX_IDLE_CONNECTIONS = 4
+# seconds the design index is trusted before the design locations are
+# listed again
+DESIGN_INDEX_TTL = 60
+# bytes read from a share per request when streaming a file (4M)
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+# largest file read from a share (1G)
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+# errors meaning a connection is dead, rather than an operation failed
+CONNECTION_ERRORS = (NotConnectedError, SMBTimeout, socket.error)
+
+
+# server ip -> (remote name, time looked up)
+netbios_names = {}
+# (server ip, share, username, password) -> [(connection, time idle since)]
+idle_connections = {}
+pool_lock = threading.Lock()
+
 try:
     riemann = bernhard.Client(host=config.RIEMANN_HOST, port=config.RIEMANN_PORT)
 except:
@@ -54,6 +91,13 @@ class SMBFetchFileException(Exception):
     pass
 
 
+class FileTooLargeException(Exception):
+    """
+    A file on a SMB share is larger than the size limit for reading it.
+    """
+    pass
+
+
 class ChecksumFailed(Exception):
     """
     The checksum for the data provided by the model failed.
@@ -61,29 +105,49 @@ class ChecksumFailed(Exception):
     pass
 
 
+def remote_name_for(server_ip):
+    """
+    Returns the NetBIOS name of server_ip.
+
+    Lookups are cached for NETBIOS_TTL seconds. If the server has no
+    name throw a RemoteNameException.
+    """
+    with pool_lock:
+        cached = netbios_names.get(server_ip)
+    if cached and time.time() - cached[1] < NETBIOS_TTL:
+        return cached[0]
+    netbios = NetBIOS()
+    try:
+        remote_name = netbios.queryIPForName(server_ip)
+    finally:
+        netbios.close()
+    if not remote_name:
+        raise RemoteNameException("Unable to get remote name for {0}!".
+                                  format(server_ip))
+    with pool_lock:
+        netbios_names[server_ip] = (remote_name[0], time.time())
+    return remote_name[0]
+
+
 def get_connection(location):
     """
-    Get a SMB connnection using the location and verify the remote
+    Get a new SMB connnection using the location and verify the remote
     location.
 
-    Get the formatted location name, otherwise throw a
+    Get the remote name of the server, otherwise throw a
     RemoteNameException. Create the SMB connection, otherwise throw a
     SMBConnectionException.
     """
     location_name = smb_share_format.format(location.server_ip,
                                             location.share_name,
                                             location.path)
-    netbios = NetBIOS()
-    remote_name = netbios.queryIPForName(location.server_ip)
-    if not remote_name:
-        raise RemoteNameException("Unable to get remote name for {0}!".
-                                  format(location.server_ip))
+    remote_name = remote_name_for(location.server_ip)
     if not location.username:
         location.username=""
     if not location.password:
         location.password=""
     connection = SMBConnection(location.username, location.password, 'ONYX',
-        remote_name[0])
+        remote_name)
     if not connection.connect(location.server_ip):
         riemann.send({"host": config.HOST,
                       "service": "shareutil.get_connection",
@@ -93,58 +157,354 @@ def get_connection(location):
     return connection
 
 
+def pool_key(location):
+    return (location.server_ip, location.share_name,
+            location.username or "", location.password or "")
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def checkout_connection(location):
+    """
+    Take a connection to location from the pool, or open a new one.
+
+    Expire the idle connections first, see expire_idle_connections.
+    Echo pooled connections idle longer than LIVENESS_INTERVAL, closing
+    them if the server dropped them, before reusing the most recently
+    used.
+    """
+    expire_idle_connections()
+    key = pool_key(location)
+    while True:
+        with pool_lock:
+            idle = idle_connections.get(key)
+            if not idle:
+                break
+            connection, idle_since = idle.pop()
+        if time.time() - idle_since > LIVENESS_INTERVAL:
+            try:
+                connection.echo(b"onyx", timeout=5)
+            except Exception:
+                close_quietly(connection)
+                continue
+        return connection
+    return get_connection(location)
+
+
+def checkin_connection(location, connection):
+    """
+    Return a working connection to the pool for location, closing it
+    when MAX_IDLE_CONNECTIONS are already idle after expiring the idle
+    connections, see expire_idle_connections.
+    """
+    expire_idle_connections()
+    key = pool_key(location)
+    with pool_lock:
+        idle = idle_connections.setdefault(key, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append((connection, time.time()))
+            return
+    close_quietly(connection)
+
+
+def expire_idle_connections():
+    """
+    Close the pooled connections of every location that have been idle
+    longer than IDLE_TIMEOUT, so the pool of a location that is no
+    longer used doesn't hold them open.
+    """
+    expired_since = time.time() - IDLE_TIMEOUT
+    expired = []
+    with pool_lock:
+        for idle in idle_connections.values():
+            expired.extend(connection for connection, idle_since in idle
+                           if idle_since < expired_since)
+            idle[:] = [(connection, idle_since)
+                       for connection, idle_since in idle
+                       if idle_since >= expired_since]
+    for connection in expired:
+        close_quietly(connection)
+
+
+def close_idle_connections():
+    """
+    Close every pooled connection. Runs when the process exits, and
+    when a worker pool process shuts down, which skips exit handlers.
+    """
+    with pool_lock:
+        idle = [connection for connections in idle_connections.values()
+                for connection, idle_since in connections]
+        idle_connections.clear()
+    for connection in idle:
+        close_quietly(connection)
+
+
+atexit.register(close_idle_connections)
+
+
+@worker_process_shutdown.connect
+def on_worker_process_shutdown(**kwargs):
+    close_idle_connections()
+
+
+@contextmanager
+def pooled_connection(location):
+    """
+    Use a pooled connection to location in a with statement.
+
+    The connection goes back to the pool afterwards unless the body hit
+    one of CONNECTION_ERRORS, when it is closed instead. Errors from the
+    operation itself, like a missing file, leave it pooled.
+    """
+    connection = checkout_connection(location)
+    try:
+        yield connection
+    except CONNECTION_ERRORS:
+        close_quietly(connection)
+        raise
+    except Exception:
+        checkin_connection(location, connection)
+        raise
+    checkin_connection(location, connection)
+
+
+def on_share(location, operation):
+    """
+    Returns operation(connection) run on a pooled connection to
+    location.
+
+    If the pooled connection turns out to be dead, run operation again
+    once on a new connection. operation must be safe to repeat.
+    """
+    try:
+        with pooled_connection(location) as connection:
+            return operation(connection)
+    except CONNECTION_ERRORS:
+        pass
+    connection = get_connection(location)
+    try:
+        result = operation(connection)
+    except CONNECTION_ERRORS:
+        close_quietly(connection)
+        raise
+    except Exception:
+        checkin_connection(location, connection)
+        raise
+    checkin_connection(location, connection)
+    return result
+
+
 def write_data_to_share(location, file_name, data):
     """
     Write data to a file at a SMB location.
 
-    Get a connection to the location. Create a BytesIO python object using
-    data. Create the new SMB path using location and file_name. Write
-    the data to the file at the SMB location, otherwise throw a
+    Use a pooled connection to the location. Create the new SMB path
+    using location and file_name. Write the data to the file at the SMB
+    location from a new BytesIO on each try, otherwise throw a
     SMBFetchFileException.
     """
-    connection = get_connection(location)
+    path = "\\".join([location.path, file_name])
+    len_written = on_share(location, lambda connection: connection.storeFile(
+        location.share_name, path, BytesIO(data)))
+    if len_written == 0:
+        raise SMBFetchFileException("Unable to write file {0} to {1}".
+                                    format(file_name, location.path))
+
 
-    fileobj = BytesIO(data)
+class DecompressingReader(object):
+    """
+    File-like object that inflates zlib compressed data as it is read.
+
+    Lets storeFile stream a compressed file to a share without the whole
+    decompressed file being held in memory.
+    """
+
+    def __init__(self, data, chunk_size=64 * 1024):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.decompressor = zlib.decompressobj()
+        self.unconsumed = b""
+        self.flushed = b""
+
+    def read(self, size=-1):
+        """
+        Returns up to size decompressed bytes, or the rest if size < 0.
+        """
+        chunks = []
+        needed = size
+        while needed != 0:
+            if self.unconsumed:
+                data = self.unconsumed
+            elif self.offset < len(self.data):
+                data = self.data[self.offset:self.offset + self.chunk_size]
+                self.offset += self.chunk_size
+            else:
+                if self.decompressor:
+                    self.flushed = self.decompressor.flush()
+                    self.decompressor = None
+                if needed < 0:
+                    needed = len(self.flushed)
+                chunks.append(self.flushed[:needed])
+                self.flushed = self.flushed[needed:]
+                break
+            chunk = self.decompressor.decompress(data, max(needed, 0))
+            self.unconsumed = self.decompressor.unconsumed_tail
+            chunks.append(chunk)
+            if needed > 0:
+                needed -= len(chunk)
+        return b"".join(chunks)
+
+
+def store_file(connection, location, file_name, fileobj):
+    """
+    Write fileobj to a file at a SMB location using an open connection.
+
+    Delete any existing file first. Returns the number of bytes written,
+    otherwise throw a SMBFetchFileException.
+    """
     path = "\\".join([location.path, file_name])
-    len_written = connection.storeFile(location.share_name,
-                                       path, fileobj)
+    try:
+        connection.deleteFiles(location.share_name, path)
+    except Exception:
+        pass
+    len_written = connection.storeFile(location.share_name, path, fileobj)
     if len_written == 0:
-        
         raise SMBFetchFileException("Unable to write file {0} to {1}".
-                                    format(file_name, location_name))
+                                    format(file_name, location.path))
+    return len_written
+
+
+def write_files_to_share(location, files, threads=4):
+    """
+    Write files to a SMB location concurrently.
+
+    files is a list of (file name, file-like object) tuples. Up to
+    threads writers each take one pooled connection and take files from
+    a shared queue. Returns a list of (file name, bytes written, seconds)
+    tuples, otherwise re-raise the first error a writer hit.
+    """
+    queue = Queue.Queue()
+    for item in files:
+        queue.put(item)
+    stats = []
+    errors = []
+
+    def writer():
+        try:
+            with pooled_connection(location) as connection:
+                while not errors:
+                    try:
+                        file_name, fileobj = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    start = time.time()
+                    written = store_file(connection, location, file_name,
+                                         fileobj)
+                    stats.append((file_name, written, time.time() - start))
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=writer)
+               for i in range(max(1, min(threads, len(files))))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+    return stats
 
 
 def delete_existing_file(location, file_name):
     """
     Delete a file at a SMB location.
 
-    Get a connection to the location. Delete the file at the SMB
+    Use a pooled connection to the location. Delete the file at the SMB
     location.
     """
-    connection = get_connection(location)
+    path = "\\".join([location.path, file_name])
+    on_share(location, lambda connection: connection.deleteFiles(
+        location.share_name, path))
+
 
+def iter_file_on_share(location, file_name, max_size=MAX_FILE_SIZE,
+                       chunk_size=READ_CHUNK_SIZE):
+    """
+    Yield the data of a file at a SMB location in chunks.
+
+    Check the file size first and throw a FileTooLargeException when it
+    is over max_size. Read chunk_size bytes per request on a pooled
+    connection, so a dropped connection only repeats the current chunk,
+    and stop early if the file grows past max_size while being read. If
+    the file is empty throw a SMBFetchFileException.
+    """
     path = "\\".join([location.path, file_name])
-    connection.deleteFiles(location.share_name, path)
+    attributes = on_share(location, lambda connection:
+                          connection.getAttributes(location.share_name, path))
+    if max_size and attributes.file_size > max_size:
+        raise FileTooLargeException("{0} is {1} bytes, over {2}".format(
+            file_name, attributes.file_size, max_size))
+    offset = 0
+    while True:
+        def read(connection):
+            fileobj = BytesIO()
+            connection.retrieveFileFromOffset(location.share_name, path,
+                                              fileobj, offset, chunk_size)
+            return fileobj.getvalue()
+
+        chunk = on_share(location, read)
+        if not chunk:
+            break
+        offset += len(chunk)
+        if max_size and offset > max_size:
+            raise FileTooLargeException("{0} grew over {1} bytes".format(
+                file_name, max_size))
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+    if offset == 0:
+        raise SMBFetchFileException("Unable to fetch file {0} from {1}".
+                                    format(file_name, location.path))
+
+
+def copy_file_from_share(location, file_name, fileobj,
+                         max_size=MAX_FILE_SIZE):
+    """
+    Write a file at a SMB location to fileobj as it is read.
+
+    Hash the data while it is transferred, so only one chunk is held
+    at a time. Returns the (size, sha1) of the file.
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    for chunk in iter_file_on_share(location, file_name, max_size):
+        sha1.update(chunk)
+        fileobj.write(chunk)
+        size += len(chunk)
+    return size, sha1.hexdigest()
+
+
+class ChunkWriter(list):
+    """
+    File-like object keeping the chunks written to it.
+    """
+    write = list.append
 
 
 def data_for_file_on_share(location, file_name):
     """
     Get data from a file at a SMB location.
 
-    Get a connection to the location. Get the data from the file at
-    the SMB location, otherwise throw a SMBFetchFileException.
-    Returns a str (bytearray).
+    Read the file in chunks and join them, otherwise throw a
+    SMBFetchFileException. Returns a str (bytearray).
     """
-    connection = get_connection(location)
-
-    fileobj = BytesIO()
-    path = "\\".join([location.path, file_name])
-    attr, lenwritten = connection.retrieveFile(location.share_name,
-                                               path, fileobj)
-    if lenwritten == 0:
-        raise SMBFetchFileException("Unable to fetch file {0} from {1}".
-                                    format(file_name, location_name))
-    return fileobj.getvalue()
+    return b"".join(iter_file_on_share(location, file_name))
 
 
 def data_for_measurement_file(measurement_file):
@@ -152,7 +512,9 @@ def data_for_measurement_file(measurement_file):
     Get the SMB Location and file name from the measurement_file and
     call the data_for_file_on_share method.
 
-    Returns a str (bytearray).
+    The file is read whole, up to MAX_FILE_SIZE, because text_format in
+    protobuf 2.5 only parses Shifts from a single string. Returns a str
+    (bytearray).
     """
     location = measurement_file.watch.measurement_location
     return data_for_file_on_share(location, measurement_file.file_name)
@@ -175,15 +537,28 @@ def file_names_in_location(location):
 
     Returns a list of smb.base.SharedFiles.
     """
-    connection = get_connection(location)
-
-    shared_files = connection.listPath(location.share_name,
-                                       location.path)
+    shared_files = on_share(location, lambda connection: connection.listPath(
+        location.share_name, location.path))
     file_names = [f.filename for f in shared_files
                   if not smb_ignored(f.filename)]
     return file_names
 
 
+def listing_in_location(location):
+    """
+    Return the files at a SMB location with their size and modified
+    time.
+
+    Returns a dict of file name to (size, last write time), skipping
+    directories and ignored names.
+    """
+    shared_files = on_share(location, lambda connection: connection.listPath(
+        location.share_name, location.path))
+    return dict((f.filename, (f.file_size, f.last_write_time))
+                for f in shared_files
+                if not f.isDirectory and not smb_ignored(f.filename))
+
+
 class OnyxFileNotFoundException(Exception):
     """
     Onyx file could not be found in SMB locations.
@@ -201,36 +576,176 @@ def get_checksum(data):
 def set_checksum(db, job):
     """
     Set the sha1 checksum of the job design file data.
+
+    Reuse the checksum in the design index when the file at the indexed
+    location still has the indexed size and modified time, as the index
+    may be up to DESIGN_INDEX_TTL seconds old. Otherwise refresh that
+    location's entries and read the file to compute it.
     """
-    data = data_for_design_file(db, job.onyx_file)
-    job.onyx_file_checksum = get_checksum(data)
+    entry = design_index_entry(db, job.onyx_file)
+    sha1 = entry[3]
+    if sha1 and not design_file_unchanged(db, job.onyx_file, entry):
+        refresh_design_index(db, entry[0])
+        sha1 = None
+    if not sha1:
+        sha1 = get_checksum(data_for_design_file(db, job.onyx_file))
+    job.onyx_file_checksum = sha1
 
 
-def data_for_design_file(db, onyx_file_name, checksum=None):
+def design_file_unchanged(db, onyx_file_name, entry):
     """
-    Return data for a Onyx design file.
+    Returns True if the design file still has the size and modified time
+    of its design index entry, False if it changed or can't be read.
+    """
+    location_id, size, mtime, sha1 = entry
+    location = db.query(model.NetworkLocation)\
+                 .filter_by(id=location_id).first()
+    path = "\\".join([location.path, onyx_file_name])
+    try:
+        attributes = on_share(location, lambda connection:
+                              connection.getAttributes(location.share_name,
+                                                       path))
+    except Exception:
+        return False
+    return (attributes.file_size == size and
+            "{0!r}".format(attributes.last_write_time) == mtime)
+
+
+def parse_design_index_entry(entry):
+    """
+    Returns (location id, size, mtime, sha1) from a design index entry,
+    sha1 being "" until it is computed.
+    """
+    location_id, size, mtime, sha1 = (entry.split(" ") + [""])[:4]
+    return (int(location_id), int(size), mtime, sha1)
 
-    Query the database to get design locations. In each directory check
-    for the design file. If it's found then break and use that location
-    to get the data, otherwise throw an OnyxFileNotFoundException. If
-    a checksum is provided then validate using the checksum. Return
-    the data.
-    """
-    design_dirs = db.query(model.DesignLocation).all()
-    design_location = None
-    design = None
-    for dir in design_dirs:
-        location = dir.location
-        if onyx_file_name in file_names_in_location(location):
-            design = dir
-            design_location = location            
-            break
-    if not design_location:
+
+def refresh_design_index(db, location_id=None):
+    """
+    List the design locations and update the design index in redis.
+
+    The index maps each .onyx file name to the id of the first design
+    location holding it and the file's size, modified time and sha1.
+    A file keeps its sha1 while its location, size and modified time
+    are unchanged, so the checksum is computed once per version of the
+    file. Entries of files that are gone are removed. After listing
+    every location the index is trusted for DESIGN_INDEX_TTL seconds.
+
+    With a location_id only that location is listed, updating the
+    entries it holds and adding files no other location is indexed
+    for. If files are gone from it they may have moved to another
+    location, so the index is marked stale for the next lookup.
+    """
+    entries = {}
+    design_dirs = db.query(model.DesignLocation)
+    if location_id is not None:
+        design_dirs = design_dirs.filter_by(location_id=location_id)
+    for dir in design_dirs.order_by(model.DesignLocation.id).all():
+        listing = listing_in_location(dir.location)
+        for file_name, (size, mtime) in listing.items():
+            if file_name.endswith(".onyx") and file_name not in entries:
+                entries[file_name] = "{0} {1} {2!r}".format(
+                    dir.location_id, size, mtime)
+    r = redisutil.redis_connect()
+    key = redisutil.design_index_key()
+    index = r.hgetall(key)
+    updates = {}
+    for file_name, entry in entries.items():
+        old_entry = index.get(file_name)
+        if (location_id is not None and old_entry and
+                parse_design_index_entry(old_entry)[0] != location_id):
+            continue
+        if old_entry != entry and not (old_entry or "").startswith(
+                entry + " "):
+            updates[file_name] = entry
+    removed = [file_name for file_name, entry in index.items()
+               if file_name not in entries and (
+                   location_id is None or
+                   parse_design_index_entry(entry)[0] == location_id)]
+    pipe = r.pipeline()
+    if updates:
+        pipe.hmset(key, updates)
+    if removed:
+        pipe.hdel(key, *removed)
+    if location_id is None:
+        pipe.setex(redisutil.design_index_refreshed_key(), DESIGN_INDEX_TTL,
+                   1)
+    elif removed:
+        pipe.delete(redisutil.design_index_refreshed_key())
+    pipe.execute()
+
+
+def design_index_entry(db, onyx_file_name):
+    """
+    Returns (location id, size, mtime, sha1) of an onyx design file.
+
+    Refresh the design index first if it is stale. If the file isn't in
+    it throw an OnyxFileNotFoundException; a missing design is looked
+    for again only once the index goes stale, so it doesn't cost a
+    listing of every location on each lookup.
+    """
+    r = redisutil.redis_connect()
+    if not r.exists(redisutil.design_index_refreshed_key()):
+        refresh_design_index(db)
+    entry = r.hget(redisutil.design_index_key(), onyx_file_name)
+    if not entry:
         raise OnyxFileNotFoundException(
             "Could not find design {0}"
             " in search locations".format(onyx_file_name))
-    data = data_for_file_on_share(location, onyx_file_name)
-    if checksum and get_checksum(data) != checksum:
+    return parse_design_index_entry(entry)
+
+
+def record_design_checksum(onyx_file_name, entry, sha1):
+    """
+    Save sha1 in the design index entry of onyx_file_name, unless the
+    entry changed since it was read.
+    """
+    location_id, size, mtime, old_sha1 = entry
+    if old_sha1 == sha1:
+        return
+    r = redisutil.redis_connect()
+    key = redisutil.design_index_key()
+    current = r.hget(key, onyx_file_name)
+    if current and parse_design_index_entry(current)[:3] == entry[:3]:
+        r.hset(key, onyx_file_name, "{0} {1} {2} {3}".format(
+            location_id, size, mtime, sha1))
+
+
+def copy_design_file(db, onyx_file_name, fileobj, checksum=None):
+    """
+    Write an Onyx design file to fileobj as it is read.
+
+    Look up the design location holding the file in the design index. If
+    it isn't there any more the index may be out of date, so refresh
+    that location's entries and look once more. Hash the data as it is
+    copied, save the checksum in the index and if a checksum is provided
+    then validate using the checksum. Returns the sha1 of the data.
+    """
+    entry = design_index_entry(db, onyx_file_name)
+    location = db.query(model.NetworkLocation).filter_by(id=entry[0]).first()
+    path = "\\".join([location.path, onyx_file_name])
+    try:
+        on_share(location, lambda connection:
+                 connection.getAttributes(location.share_name, path))
+    except Exception:
+        refresh_design_index(db, entry[0])
+        entry = design_index_entry(db, onyx_file_name)
+        location = db.query(model.NetworkLocation)\
+                     .filter_by(id=entry[0]).first()
+    size, sha1 = copy_file_from_share(location, onyx_file_name, fileobj)
+    record_design_checksum(onyx_file_name, entry, sha1)
+    if checksum and sha1 != checksum:
         raise ChecksumFailed("Checksum failed for %s in %s" % (onyx_file_name,
                                                                location))
-    return data
+    return sha1
+
+
+def data_for_design_file(db, onyx_file_name, checksum=None):
+    """
+    Return data for a Onyx design file.
+
+    Copy the file into chunks with copy_design_file and join them.
+    """
+    chunks = ChunkWriter()
+    copy_design_file(db, onyx_file_name, chunks, checksum)
+    return b"".join(chunks)
@@ -0,0 +1,127 @@
+"""
+tracing.py records how long each stage of a job takes.
+"""
+
+
+from contextlib import contextmanager
+import json
+import math
+import os
+import time
+
+import config
+
+
+# Upper bounds in seconds of the latency histogram buckets, doubling from
+# 1ms to about 36 minutes. Slower spans go in a last, unbounded bucket.
+HISTOGRAM_BUCKETS = [0.001 * 2 ** i for i in range(22)]
+
+
+def record(entry):
+    """
+    Append a span to config.TRACE_PATH as one line of JSON.
+
+    The line goes out in a single O_APPEND write so spans from every
+    worker process on a node can share the file. Tracing is never
+    allowed to fail a task, so errors writing the span are ignored.
+    """
+    if not config.TRACE_PATH:
+        return
+    line = json.dumps(entry, separators=(",", ":")) + "\n"
+    try:
+        fd = os.open(config.TRACE_PATH,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        pass
+
+
+@contextmanager
+def span(stage, job_id=None, workrange=None, **fields):
+    """
+    Time the body of a with statement as a span of stage.
+
+    The span records the job and workrange index it was for, the host
+    and process, when it started, how long it took and the name of the
+    exception if the body raised one. The yielded dict of fields is
+    recorded too, so the body can add to it, e.g. the bytes it read.
+    """
+    start = time.time()
+    error = None
+    try:
+        yield fields
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        entry = {"stage": stage,
+                 "job": job_id,
+                 "workrange": workrange[0] if workrange else None,
+                 "host": config.HOST,
+                 "pid": os.getpid(),
+                 "start": start,
+                 "seconds": time.time() - start}
+        if error:
+            entry["error"] = error
+        entry.update(fields)
+        record(entry)
+
+
+def load_spans(paths):
+    """
+    Yield the spans recorded in each of paths, skipping torn lines.
+    """
+    for path in paths:
+        with open(path, "r") as trace:
+            for line in trace:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def percentile(values, fraction):
+    """
+    Returns the fraction percentile of sorted values, nearest rank.
+    """
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def stage_histograms(spans):
+    """
+    Returns latency summaries of spans by stage.
+
+    Each stage maps to a dict with the span count, errors, total
+    seconds, the p50, p90, p99 and max seconds, and counts of spans in
+    each of HISTOGRAM_BUCKETS plus one for slower spans.
+    """
+    seconds = {}
+    errors = {}
+    for entry in spans:
+        stage = entry["stage"]
+        seconds.setdefault(stage, []).append(entry["seconds"])
+        if entry.get("error"):
+            errors[stage] = errors.get(stage, 0) + 1
+    summaries = {}
+    for stage, values in seconds.items():
+        values.sort()
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        bucket = 0
+        for value in values:
+            while (bucket < len(HISTOGRAM_BUCKETS) and
+                   value > HISTOGRAM_BUCKETS[bucket]):
+                bucket += 1
+            counts[bucket] += 1
+        summaries[stage] = {"count": len(values),
+                            "errors": errors.get(stage, 0),
+                            "total": sum(values),
+                            "p50": percentile(values, 0.5),
+                            "p90": percentile(values, 0.9),
+                            "p99": percentile(values, 0.99),
+                            "max": values[-1],
+                            "histogram": counts}
+    return summaries
@@ -1,2 +1,3 @@
 from measurements import shifts_for_measurement_data
+from measurements import units_for_measurement_source
 from measurements import file_name_for_onyxshifts
@@ -48,6 +48,32 @@ def shifts_for_measurement_data(data, path, onyx_design, panel_id):
     return shifts
 
 
+def units_for_measurement_source(source, path, onyx_design):
+    """
+    Parses a measurements file into units as it is read.
+
+    Like shifts_for_measurement_data, for source a file-like object or
+    an iterable of chunks of the file contents. Yields ("LIVE", unit)
+    and ("REF", unit) pairs of protobuf Unit objects, the live units
+    marked in spec, without holding the whole file or its Shifts. The
+    rows of a unit must be together in the file; otherwise a
+    UnitOrderException is raised partway through, and the units
+    already yielded must be discarded and the file parsed with
+    shifts_for_measurement_data.
+    """
+    format = parser.determine_format_from_path(path)
+    if not format:
+        raise InvalidMeasurementFormat()
+    units = parser.iter_units_from_source(source, onyx_design, format)
+    if units is None:
+        raise InvalidMeasurementData()
+    die_map = create_die_name_map(onyx_design)
+    for kind, unit in units:
+        if kind == "LIVE":
+            mark_unit_spec(unit, die_map)
+        yield kind, unit
+
+
 def create_die_name_map(onyx_design):
     map = {}
     for die in onyx_design.unitDie:
@@ -82,7 +108,11 @@ def die_shift_in_spec(die_shift, die_name_map):
 def mark_shifts_spec(shifts, onyx_design):
     die_map = create_die_name_map(onyx_design)
     for unit in shifts.units:
-        in_spec = True
-        for die in unit.die:
-            in_spec = in_spec and die_shift_in_spec(die, die_map)
-        unit.inSpec = in_spec
+        mark_unit_spec(unit, die_map)
+
+
+def mark_unit_spec(unit, die_map):
+    in_spec = True
+    for die in unit.die:
+        in_spec = in_spec and die_shift_in_spec(die, die_map)
+    unit.inSpec = in_spec
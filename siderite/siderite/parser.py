@@ -25,3 +25,10 @@ def shifts_from_data(data, onyx_design, panel_id, format):
         return viewmetrology.shifts_from_data(data, onyx_design, panel_id)
     else:
         return None
+
+
+def iter_units_from_source(source, onyx_design, format):
+    if format == "ViewMetrology":
+        return viewmetrology.iter_units(source, onyx_design)
+    else:
+        return None
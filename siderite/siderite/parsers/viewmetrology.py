@@ -8,13 +8,39 @@ Copyright Deca Technologies 2014 All Rights Reserved.
 
 
 from painite import zinc_pb2
-import re
+import collections
 import math
+import numpy
+import re
 
 
 CAD_FILENAME_RE = re.compile("(CAD File Name)[\s]*,[\s]*(D[0-9]{6}_[a-zA-Z]+)")
 HEADER_REQS = ["Overall Status", "Type", "XCenter Nom.", "YCenter Nom.",
                "XCenter Devi.", "YCenter Devi.", "Angle Act."]
+# bytes read at a time from a file-like object by iter_lines
+CHUNK_SIZE = 64 * 1024
+# units iter_units keeps open for rows before yielding the oldest; one
+# for files measured a unit at a time
+MAX_OPEN_UNITS = 1
+
+# Protobuf wire format used to fill Shifts in bulk, see units_data.
+WIRETYPE_VARINT = 0
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_FIXED32 = 5
+SHIFTS_UNITS_FIELD = 4
+SHIFTS_REFERENCE_UNITS_FIELD = 5
+UNIT_DIE_FIELD = 3
+# an empty DieShift in a Unit
+EMPTY_DIE = b"\x1a\x00"
+# a Point field with its key, length and the keys of x and y
+POINT_RECORD = numpy.dtype([("key", "S3"), ("x", "<f4"),
+                            ("y_key", "S1"), ("y", "<f4")])
+# the nominalXY, shift and theta fields of a DieShift
+DIE_RECORD = numpy.dtype([("nominal_key", "S3"), ("nominal_x", "<f4"),
+                          ("nominal_y_key", "S1"), ("nominal_y", "<f4"),
+                          ("shift_key", "S3"), ("shift_x", "<f4"),
+                          ("shift_y_key", "S1"), ("shift_y", "<f4"),
+                          ("theta_key", "S1"), ("theta", "<f4")])
 
 
 class DrawingNumberMismatchException(Exception):
@@ -32,6 +58,13 @@ class NoMeasurementDataHeaderException(Exception):
     pass
 
 
+class UnitOrderException(Exception):
+    """
+    A measurement row belongs to a unit iter_units already yielded.
+    """
+    pass
+
+
 def shifts_from_data(raw_data, onyx_design, panel_id):
     """
     Parses shift data from raw DMS output file data.
@@ -57,6 +90,136 @@ def shifts_from_data(raw_data, onyx_design, panel_id):
     return shifts
 
 
+def iter_units(source, onyx_design, max_open_units=MAX_OPEN_UNITS):
+    """
+    Parses the units of raw DMS output as it is read.
+
+    source should be a file-like object or an iterable of chunks of the
+    raw file contents, such as a share read yields, and onyx_design as
+    for shifts_from_data. iter_units yields ("LIVE", unit) and ("REF",
+    unit) pairs of zinc_pb2.Unit objects, numbered and filled as
+    shifts_from_data fills its units and referenceUnits.
+
+    The data is never held whole. By default the rows of one unit are
+    kept, and it is yielded when the rows of the next unit start or the
+    data ends; with max_open_units the last that many units measured
+    are kept and the oldest yielded. Besides the open units a map of
+    the center of each unit seen is kept, to number the units and
+    recognize a unit measured again, so memory grows by a pair of
+    floats per unit rather than with the rows.
+
+    A row for a unit that was already yielded raises a
+    UnitOrderException, and the units yielded before it may be missing
+    dies. Callers must discard everything yielded when that happens
+    and parse the data again with shifts_from_data or a larger
+    max_open_units.
+    """
+    die_type_map = create_die_type_map(onyx_design)
+    die_counts = {"LIVE": len(onyx_design.unitDie),
+                  "REF": len(onyx_design.referenceDie)}
+    lines = iter_lines(source)
+    column_map = read_data_header(
+        lines, onyx_design.designNumber + "_" + onyx_design.designRevision)
+    numbers = {"LIVE": {}, "REF": {}}
+    open_units = collections.OrderedDict()
+    # rows without an OK status repeat the shift of the last OK row
+    die_shift = (0.0, 0.0, 0.0)
+    for line in lines:
+        items = [i.strip(' ') for i in line.split(',')]
+        kind, design_die, die_index = die_type_map[items[column_map["Type"]]]
+        nominal_die_x = float(items[column_map['XCenter Nom.']])
+        nominal_die_y = float(items[column_map['YCenter Nom.']])
+        if items[column_map['Overall Status']] == "OK":
+            die_shift = row_shift(items, column_map)
+        unit_nom = (nominal_die_x - design_die.outline.center.x,
+                    nominal_die_y - design_die.outline.center.y)
+        unit = open_units.get((kind, unit_nom))
+        if unit is None:
+            if unit_nom in numbers[kind]:
+                raise UnitOrderException(
+                    "{0} unit {1} measured again after it was parsed!".format(
+                        kind, numbers[kind][unit_nom]))
+            numbers[kind][unit_nom] = len(numbers[kind]) + 1
+            unit = zinc_pb2.Unit()
+            unit.number = numbers[kind][unit_nom]
+            unit.center.x, unit.center.y = unit_nom
+            for i in range(die_counts[kind]):
+                unit.die.add()
+            open_units[(kind, unit_nom)] = unit
+            if len(open_units) > max_open_units:
+                (oldest_kind, center), oldest = open_units.popitem(last=False)
+                yield oldest_kind, oldest
+        die = unit.die[die_index]
+        die.name = design_die.name
+        die.nominalXY.x, die.nominalXY.y = nominal_die_x, nominal_die_y
+        die.shift.x, die.shift.y, die.theta = die_shift
+    if not numbers["LIVE"] and not numbers["REF"]:
+        raise NoMeasurementDataHeaderException()
+    for (kind, center), unit in open_units.items():
+        yield kind, unit
+
+
+def iter_lines(source, chunk_size=CHUNK_SIZE):
+    """
+    Yields the lines of the raw data in source, a file-like object read
+    chunk_size bytes at a time or an iterable of chunks, without line
+    breaks. Blank lines are skipped, so \\r\\n and \\r line breaks are
+    read as \\n ones.
+    """
+    if hasattr(source, "read"):
+        source = iter_chunks(source, chunk_size)
+    rest = ""
+    for chunk in source:
+        lines = (rest + chunk).replace('\r', '\n').split('\n')
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if rest:
+        yield rest
+
+
+def iter_chunks(fileobj, chunk_size):
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_data_header(lines, drawing_number):
+    """
+    Reads lines up to the measurement data header and returns the
+    column map of the header, see parse_data_header.
+
+    Raises a DrawingNumberMismatchException if the report header before
+    it doesn't name drawing_number, or a NoMeasurementDataHeaderException
+    if lines end before a header.
+    """
+    report_drawing_number = None
+    for line in lines:
+        if is_data_header(line):
+            if report_drawing_number != drawing_number:
+                raise DrawingNumberMismatchException()
+            return data_column_map(line)
+        if report_drawing_number is None:
+            report_drawing_number = parse_report_header(line)
+    raise NoMeasurementDataHeaderException()
+
+
+def row_shift(items, column_map):
+    """
+    Returns the shift x, y and theta in radians of a row's items. A
+    theta that isn't a number is zero.
+    """
+    try:
+        theta = math.radians(float(items[column_map['Angle Act.']]))
+    except ValueError:
+        theta = 0.0
+    return (float(items[column_map['XCenter Devi.']]),
+            float(items[column_map['YCenter Devi.']]), theta)
+
+
 def preprocess_raw_data(data):
     """
     Performs any adjustments necessary to the raw data before it is parsed.
@@ -80,24 +243,29 @@ def parse_report_header(data):
 
 
 def parse_data_header(lines):
-    map = {}
     first_row = None
     header = None
     for i in range(len(lines)):
         line = lines[i]
         if i == len(lines) - 1:
             raise NoMeasurementDataHeaderException()
-        is_header = True
-        for item in HEADER_REQS:
-            is_header = is_header and (item in line)
-        if is_header:
+        if is_data_header(line):
             header = line
             first_row = i + 1
             break
+    return data_column_map(header), first_row
+
+
+def is_data_header(line):
+    return all(item in line for item in HEADER_REQS)
+
+
+def data_column_map(header):
+    map = {}
     header_items = header.split(',')
     for item in HEADER_REQS:
         map[item] = header_items.index(item)
-    return map, first_row
+    return map
 
 
 def create_die_type_map(onyx_design):
@@ -110,49 +278,245 @@ def create_die_type_map(onyx_design):
 
 
 def parse_data(data, shifts, onyx_design):
+    """
+    Parses the measurement rows of data into shifts.
+
+    The needed columns are loaded into NumPy arrays in one pass, see
+    load_columns. Dies are grouped into units by their unit centers
+    with array operations, see group_units, and only then are the
+    units and dies added to the Shifts, see add_units and add_dies.
+    """
     lines = data.split('\n')
     die_type_map = create_die_type_map(onyx_design)
     column_map, first_data_row = parse_data_header(lines)
-    live_units, ref_units = {}, {}
-    for line in lines[first_data_row:]:
-        items = [i.strip(' ') for i in line.split(',')]
-        type = items[column_map["Type"]]
-        status = items[column_map['Overall Status']]
-        nominal_die_x = float(items[column_map['XCenter Nom.']])
-        nominal_die_y = float(items[column_map['YCenter Nom.']])
-        if status == "OK":
-            die_shift_x = float(items[column_map['XCenter Devi.']])
-            die_shift_y = float(items[column_map['YCenter Devi.']])
-            raw_angle = items[column_map['Angle Act.']]
-            try:
-                die_theta = math.radians(float(raw_angle))
-            except:
-                die_theta = 0.0
-        die_offset = die_type_map[type][1].outline.center
-        unit_x = nominal_die_x - die_offset.x
-        unit_y = nominal_die_y - die_offset.y
-        unit_nom = (unit_x, unit_y)
-        if die_type_map[type][0] == "LIVE":
-            if unit_nom not in live_units:
-                live_units[unit_nom] = shifts.units.add()
-                live_units[unit_nom].number = len(live_units)
-                live_units[unit_nom].center.x = unit_x
-                live_units[unit_nom].center.y = unit_y
-                for i in range(len(onyx_design.unitDie)):
-                    live_units[unit_nom].die.add()
-            unit = live_units[unit_nom]
-        elif die_type_map[type][0] == "REF":
-            if unit_nom not in ref_units:
-                ref_units[unit_nom] = shifts.referenceUnits.add()
-                ref_units[unit_nom].number = len(ref_units)
-                ref_units[unit_nom].center.x = unit_x
-                ref_units[unit_nom].center.y = unit_y
-                for i in range(len(onyx_design.referenceDie)):
-                    ref_units[unit_nom].die.add()
-            unit = ref_units[unit_nom]
-        die_index = die_type_map[type][2]
-        die = unit.die[die_index]
-        die.name = die_type_map[type][1].name
-        die.nominalXY.x, die.nominalXY.y = nominal_die_x, nominal_die_y
-        die.shift.x, die.shift.y = die_shift_x, die_shift_y
-        die.theta = die_theta
+    columns = load_columns(lines[first_data_row:], column_map)
+    del lines
+    if not len(columns["type"]):
+        return
+    type_names, type_index = numpy.unique(columns["type"],
+                                          return_inverse=True)
+    die_types = [die_type_map[name] for name in type_names]
+    offset_x = numpy.array([die.outline.center.x
+                            for kind, die, index in die_types])
+    offset_y = numpy.array([die.outline.center.y
+                            for kind, die, index in die_types])
+    unit_x = columns["nominal_x"] - offset_x[type_index]
+    unit_y = columns["nominal_y"] - offset_y[type_index]
+    die_names = numpy.array([die.name for kind, die, index in die_types])
+    die_index = numpy.array([index for kind, die, index in die_types])
+    die_prefixes = [die_prefix(die.name) for kind, die, index in die_types]
+    for kind, field_number, die_count in (
+            ("LIVE", SHIFTS_UNITS_FIELD, len(onyx_design.unitDie)),
+            ("REF", SHIFTS_REFERENCE_UNITS_FIELD,
+             len(onyx_design.referenceDie))):
+        kinds = numpy.array([die_type[0] == kind for die_type in die_types])
+        rows = numpy.flatnonzero(kinds[type_index])
+        if not len(rows):
+            continue
+        unit_numbers, first_rows = group_units(unit_x[rows], unit_y[rows])
+        slots = unit_numbers * die_count + die_index[type_index[rows]]
+        # a die measured more than once keeps its last measurement
+        slots, last = numpy.unique(slots[::-1], return_index=True)
+        die_rows = rows[::-1][last]
+        shifts.MergeFromString(units_data(
+            field_number, unit_x[rows][first_rows],
+            unit_y[rows][first_rows], die_count, slots,
+            [die_prefixes[i] for i in type_index[die_rows].tolist()],
+            die_records(columns, die_rows)))
+
+
+def split_rows(lines):
+    """
+    Returns the comma separated fields of lines as one list and the
+    number of fields in a row.
+
+    When every row has as many fields as the first, the lines are
+    joined and split in one go and column i is fields[i::row_length].
+    Otherwise the rows are split one at a time and padded to the
+    longest, so a short row only fails when a needed field is missing.
+    """
+    row_length = lines[0].count(',') + 1
+    fields = ','.join(lines).split(',')
+    if len(fields) == row_length * len(lines):
+        return fields, row_length
+    rows = [line.split(',') for line in lines]
+    row_length = max(len(row) for row in rows)
+    fields = []
+    for row in rows:
+        fields.extend(row)
+        fields.extend([None] * (row_length - len(row)))
+    return fields, row_length
+
+
+def load_columns(lines, column_map):
+    """
+    Returns a dict of the measurement columns of lines as NumPy arrays.
+
+    The die type is a stripped string, the nominal centers, shifts and
+    theta floats, theta in radians. Shifts and theta are only read from
+    rows with an OK status; other rows repeat those of the last OK row
+    before them, or zero before the first. A theta that isn't a number
+    is zero.
+    """
+    if not lines:
+        return {"type": numpy.array([])}
+    fields, row_length = split_rows(lines)
+
+    def column(name):
+        values = fields[column_map[name]::row_length]
+        if None in values:
+            raise IndexError("Measurement row is missing {0}!".format(name))
+        return values
+
+    def stripped_column(name):
+        values, index = numpy.unique(column(name), return_inverse=True)
+        return numpy.char.strip(values, ' ')[index]
+
+    ok = stripped_column('Overall Status') == "OK"
+    ok_rows = numpy.flatnonzero(ok)
+    last_ok = numpy.maximum.accumulate(
+        numpy.where(ok, numpy.arange(len(lines)), -1))
+
+    def ok_column(name, default=None):
+        values = numpy.zeros(len(lines))
+        if len(ok_rows):
+            all_values = column(name)
+            values[ok_rows] = float_column(
+                [all_values[row] for row in ok_rows.tolist()], default)
+        return numpy.where(last_ok >= 0, values[last_ok], 0.0)
+
+    return {"type": stripped_column("Type"),
+            "nominal_x": float_column(column('XCenter Nom.')),
+            "nominal_y": float_column(column('YCenter Nom.')),
+            "shift_x": ok_column('XCenter Devi.'),
+            "shift_y": ok_column('YCenter Devi.'),
+            "theta": numpy.radians(ok_column('Angle Act.', 0.0))}
+
+
+def float_column(values, default=None):
+    """
+    Returns an array of a list of strings converted to floats.
+
+    Raise a ValueError for a value that isn't a number, unless there is
+    a default to use for it instead.
+    """
+    try:
+        return numpy.array(values, dtype=float)
+    except ValueError:
+        if default is None:
+            raise
+    floats = []
+    for value in values:
+        try:
+            floats.append(float(value))
+        except ValueError:
+            floats.append(default)
+    return numpy.array(floats)
+
+
+def group_units(unit_x, unit_y):
+    """
+    Returns the unit of each die and the first die of each unit.
+
+    Dies with the same unit center are one unit. Units are numbered
+    from 0 in the order their first die appears.
+    """
+    order = numpy.lexsort((unit_y, unit_x))
+    sorted_x, sorted_y = unit_x[order], unit_y[order]
+    starts = numpy.ones(len(order), dtype=bool)
+    starts[1:] = ((sorted_x[1:] != sorted_x[:-1]) |
+                  (sorted_y[1:] != sorted_y[:-1]))
+    # lexsort is stable, so each group starts with its first die
+    first_rows = order[starts]
+    numbers = numpy.empty(len(first_rows), dtype=int)
+    numbers[numpy.argsort(first_rows)] = numpy.arange(len(first_rows))
+    unit_numbers = numpy.empty(len(order), dtype=int)
+    unit_numbers[order] = numbers[numpy.cumsum(starts) - 1]
+    return unit_numbers, numpy.sort(first_rows)
+
+
+def die_records(columns, rows):
+    """
+    Returns the serialized nominalXY, shift and theta fields of the
+    DieShift measured in each of rows, DIE_RECORD.itemsize bytes each.
+    """
+    records = numpy.zeros(len(rows), dtype=DIE_RECORD)
+    records["nominal_key"] = field_key(2, WIRETYPE_LENGTH_DELIMITED) +\
+        b"\x0a" + field_key(1, WIRETYPE_FIXED32)
+    records["nominal_x"] = columns["nominal_x"][rows]
+    records["nominal_y_key"] = field_key(2, WIRETYPE_FIXED32)
+    records["nominal_y"] = columns["nominal_y"][rows]
+    records["shift_key"] = field_key(3, WIRETYPE_LENGTH_DELIMITED) + b"\x0a" +\
+        field_key(1, WIRETYPE_FIXED32)
+    records["shift_x"] = columns["shift_x"][rows]
+    records["shift_y_key"] = field_key(2, WIRETYPE_FIXED32)
+    records["shift_y"] = columns["shift_y"][rows]
+    records["theta_key"] = field_key(4, WIRETYPE_FIXED32)
+    records["theta"] = columns["theta"][rows]
+    return records.tobytes()
+
+
+def die_prefix(name):
+    """
+    Returns the serialized key and length of a Unit's DieShift field and
+    the DieShift's name field, which die_records completes.
+    """
+    name_field = length_delimited_field(1, name.encode("utf-8"))
+    return field_key(UNIT_DIE_FIELD, WIRETYPE_LENGTH_DELIMITED) +\
+        encode_varint(len(name_field) + DIE_RECORD.itemsize) + name_field
+
+
+def units_data(field_number, unit_x, unit_y, die_count, slots, prefixes,
+               records):
+    """
+    Returns serialized Shifts holding a unit at each center in the
+    field_number units field, numbered from 1, with die_count dies.
+
+    slots are the dies that were measured, a unit's number times
+    die_count plus the die index, with the die_prefix and record of
+    each; the other dies are left empty. Merging the data into a Shifts
+    fills it as setting each field would, without a protobuf call per
+    field. The die records are built as arrays, but the dies and units
+    are still joined one at a time in Python.
+    """
+    record_size = DIE_RECORD.itemsize
+    dies = [EMPTY_DIE] * (len(unit_x) * die_count)
+    for i, (slot, prefix) in enumerate(zip(slots.tolist(), prefixes)):
+        dies[slot] = prefix + records[i * record_size:(i + 1) * record_size]
+    centers = numpy.zeros(len(unit_x), dtype=POINT_RECORD)
+    centers["key"] = field_key(2, WIRETYPE_LENGTH_DELIMITED) + b"\x0a" +\
+        field_key(1, WIRETYPE_FIXED32)
+    centers["x"] = unit_x
+    centers["y_key"] = field_key(2, WIRETYPE_FIXED32)
+    centers["y"] = unit_y
+    centers = centers.tobytes()
+    center_size = POINT_RECORD.itemsize
+    unit_key = field_key(field_number, WIRETYPE_LENGTH_DELIMITED)
+    number_key = field_key(1, WIRETYPE_VARINT)
+    units = []
+    for unit in range(len(unit_x)):
+        body = b"".join(
+            [number_key, encode_varint(unit + 1),
+             centers[unit * center_size:(unit + 1) * center_size]] +
+            dies[unit * die_count:(unit + 1) * die_count])
+        units.extend([unit_key, encode_varint(len(body)), body])
+    return b"".join(units)
+
+
+def field_key(field_number, wire_type):
+    return encode_varint((field_number << 3) | wire_type)
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def length_delimited_field(field_number, value):
+    return field_key(field_number, WIRETYPE_LENGTH_DELIMITED) +\
+        encode_varint(len(value)) + value
+
@@ -0,0 +1,121 @@
+# test_ViewMetrology.py
+#
+# siderite
+#
+
+import os.path
+import unittest
+from painite import zinc_pb2
+from siderite.parsers import viewmetrology
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class DesignObject(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def design_die(name, index, x, y):
+    return DesignObject(name=name, index=index, outline=DesignObject(
+        center=DesignObject(x=x, y=y)))
+
+
+def test_design():
+    """
+    The design the measurement files in DATA_DIR were written for.
+    """
+    return DesignObject(
+        designNumber="D000123", designRevision="B",
+        unitDie=[design_die("U0", 0, 0.5, 0.25),
+                 design_die("U1", 1, -1.5, 2.0),
+                 design_die("U2", 2, 0.0, 0.0)],
+        referenceDie=[design_die("R0", 0, 0.1, 0.1),
+                      design_die("R1", 1, 0.2, -0.3)])
+
+
+def read_data(name):
+    with open(os.path.join(DATA_DIR, name), 'rb') as file:
+        return file.read()
+
+
+def expected_shifts(name):
+    """
+    Returns the Shifts the parser before NumPy made of the measurement
+    file name.csv, saved as name.shifts.
+    """
+    shifts = zinc_pb2.Shifts()
+    shifts.ParseFromString(read_data(name + ".shifts"))
+    return shifts
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestShiftsFromData(unittest.TestCase):
+    def setUp(self):
+        self.design = test_design()
+
+    def checkShifts(self, name, data):
+        shifts = viewmetrology.shifts_from_data(data, self.design, "P0042")
+        self.assertEqual(shifts.SerializePartialToString(),
+                         read_data(name + ".shifts"),
+                         "{0} shifts differ from the old parser's".format(
+                             name))
+
+    def testOrderedRows(self):
+        self.checkShifts("viewmetrology_ordered",
+                         read_data("viewmetrology_ordered.csv"))
+
+    def testShuffledRows(self):
+        self.checkShifts("viewmetrology_shuffled",
+                         read_data("viewmetrology_shuffled.csv"))
+
+    def testCarriageReturns(self):
+        data = read_data("viewmetrology_ordered.csv")
+        self.checkShifts("viewmetrology_ordered", data.replace("\n", "\r"))
+
+    def testDrawingNumberMismatch(self):
+        self.design.designRevision = "C"
+        self.assertRaises(viewmetrology.DrawingNumberMismatchException,
+                          viewmetrology.shifts_from_data,
+                          read_data("viewmetrology_ordered.csv"),
+                          self.design, "P0042")
+
+
+class TestIterUnits(unittest.TestCase):
+    def setUp(self):
+        self.design = test_design()
+
+    def checkUnits(self, name, source, max_open_units):
+        expected = expected_shifts(name)
+        units = {"LIVE": [], "REF": []}
+        for kind, unit in viewmetrology.iter_units(source, self.design,
+                                                   max_open_units):
+            units[kind].append(unit.SerializePartialToString())
+        for kind, expected_units in (("LIVE", expected.units),
+                                     ("REF", expected.referenceUnits)):
+            self.assertEqual(
+                sorted(units[kind]),
+                sorted(unit.SerializePartialToString()
+                       for unit in expected_units),
+                "{0} {1} units differ from shifts_from_data's".format(
+                    name, kind))
+
+    def testOrderedRows(self):
+        data = read_data("viewmetrology_ordered.csv")
+        self.checkUnits("viewmetrology_ordered", chunks(data, 37), 1)
+
+    def testCarriageReturns(self):
+        data = read_data("viewmetrology_ordered.csv").replace("\n", "\r")
+        self.checkUnits("viewmetrology_ordered", chunks(data, 37), 1)
+
+    def testShuffledRows(self):
+        data = read_data("viewmetrology_shuffled.csv")
+        self.checkUnits("viewmetrology_shuffled", chunks(data, 37), 100)
+
+    def testUnitOrder(self):
+        data = read_data("viewmetrology_shuffled.csv")
+        units = viewmetrology.iter_units(chunks(data, 37), self.design, 1)
+        self.assertRaises(viewmetrology.UnitOrderException, list, units)
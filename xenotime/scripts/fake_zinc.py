@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Stand-in for the zinc binary when testing xenotime without it.
+
+Accepts the same -i/-o and --serve options as zinc and answers every
+WorkItem with a successful, empty WorkResult of the same work type. Set
+FAKE_ZINC_DELAY to sleep that many seconds per item and
+FAKE_ZINC_CRASH_AFTER to exit after that many items, e.g.
+
+    zinc_worker.ZINC_PATH = "xenotime/scripts/fake_zinc.py"
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+
+FRAME_HEADER = struct.Struct(">I")
+
+
+def work_result_for(work_item):
+    """
+    Returns a serialized successful WorkResult for a serialized WorkItem.
+
+    WorkItem.workType is field 1, so its value is the byte after the
+    first key.
+    """
+    work_type = work_item[1:2] if work_item[:1] == b"\x08" else b"\x00"
+    return b"\x08\x01\x18" + work_type
+
+
+def read_exactly(stream, length):
+    data = stream.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
+def serve(crash_after, delay):
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    count = 0
+    while True:
+        header = read_exactly(stdin, FRAME_HEADER.size)
+        if header is None:
+            return 0
+        work_item = read_exactly(stdin, FRAME_HEADER.unpack(header)[0])
+        if work_item is None:
+            return 1
+        count += 1
+        if crash_after and count > crash_after:
+            os._exit(2)
+        time.sleep(delay)
+        result = work_result_for(work_item)
+        stdout.write(FRAME_HEADER.pack(len(result)) + result)
+        stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake zinc")
+    parser.add_argument("-i", "--input")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-w", "--serve", action="store_true")
+    args = parser.parse_args()
+    crash_after = int(os.environ.get("FAKE_ZINC_CRASH_AFTER", 0))
+    delay = float(os.environ.get("FAKE_ZINC_DELAY", 0))
+    if args.serve:
+        return serve(crash_after, delay)
+    if crash_after:
+        return 2
+    with open(args.input, 'rb') as file:
+        work_item = file.read()
+    time.sleep(delay)
+    with open(args.output, 'wb') as file:
+        file.write(work_result_for(work_item))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Replay a recorded job trace against the design cache eviction policies.
+
+The trace has one job per line: the onyx file name and its size in
+bytes separated by whitespace, in job launch order. Record one from the
+jobs database on the controller with:
+
+    python replay_design_cache.py --record trace.txt
+
+and replay it with:
+
+    python replay_design_cache.py trace.txt --cache-size 512
+
+Each policy replays the trace against a scratch cache directory, so the
+hit rate, bytes fetched from redis and time per request include the
+real journal and file writes.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from xenotime import design_cache
+from xenotime import cache_policies
+
+
+def record_trace(path):
+    """
+    Write the onyx files of every job in the jobs database to path.
+    """
+    from purpurite import dbutil
+    from purpurite import model
+    from purpurite import redisutil
+    db = dbutil.create_db_session()
+    r = redisutil.redis_connect()
+    sizes = {}
+    with open(path, 'w') as trace:
+        for job in db.query(model.Job).order_by(model.Job.launched_time):
+            if job.onyx_file not in sizes:
+                sizes[job.onyx_file] = r.strlen(
+                    redisutil.onyx_file_key(job.onyx_file))
+            if sizes[job.onyx_file]:
+                trace.write("{0} {1}\n".format(job.onyx_file,
+                                               sizes[job.onyx_file]))
+    db.close()
+
+
+def load_trace(path):
+    with open(path, 'r') as trace:
+        return [(fields[0], int(fields[1])) for fields in
+                (line.split() for line in trace) if fields]
+
+
+def replay(trace, policy, cache_size, max_admit_fraction):
+    cache_dir = tempfile.mkdtemp(prefix="onyx_designs")
+    sizes = dict(trace)
+    fetched = {"count": 0, "bytes": 0}
+
+    def fetch(onyx_file_name):
+        fetched["count"] += 1
+        fetched["bytes"] += sizes[onyx_file_name]
+        return "\0" * sizes[onyx_file_name]
+
+    cache = design_cache.DesignCache(cache_dir, cache_size, policy,
+                                     max_admit_fraction)
+    start = time.time()
+    try:
+        for onyx_file_name, size in trace:
+            cache.get(onyx_file_name, fetch)
+        elapsed = time.time() - start
+        disk = sum(os.path.getsize(os.path.join(cache_dir, name))
+                   for name in os.listdir(cache_dir)
+                   if not name.startswith("."))
+    finally:
+        shutil.rmtree(cache_dir)
+    return {
+        "policy": policy,
+        "hit_rate": 1.0 - float(fetched["count"]) / len(trace),
+        "fetched_mb": fetched["bytes"] / float(1024 * 1024),
+        "disk_mb": disk / float(1024 * 1024),
+        "ms_per_request": elapsed * 1000.0 / len(trace)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("trace")
+    parser.add_argument("--record", action="store_true",
+                        help="record the trace from the jobs database")
+    parser.add_argument("--cache-size", type=int,
+                        default=design_cache.MAX_CACHE_SIZE / (1024 * 1024),
+                        help="cache size in MB")
+    parser.add_argument("--max-admit-fraction", type=float,
+                        default=design_cache.MAX_ADMIT_FRACTION)
+    args = parser.parse_args()
+    if args.record:
+        record_trace(args.trace)
+        return
+    trace = load_trace(args.trace)
+    print("{0} requests, {1} designs".format(len(trace),
+                                             len(set(dict(trace)))))
+    print("{0:>6} {1:>9} {2:>11} {3:>9} {4:>8}".format(
+        "policy", "hit rate", "fetched MB", "disk MB", "ms/req"))
+    for policy in sorted(cache_policies.POLICIES):
+        result = replay(trace, policy, args.cache_size * 1024 * 1024,
+                        args.max_admit_fraction)
+        print("{policy:>6} {hit_rate:>9.3f} {fetched_mb:>11.1f} "
+              "{disk_mb:>9.1f} {ms_per_request:>8.3f}".format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# test_DesignCache.py
+#
+# xenotime
+#
+
+import multiprocessing
+import os
+import os.path
+import pickle
+import shutil
+import tempfile
+import unittest
+from xenotime import design_cache
+
+
+# small enough that the inserting processes have to evict
+MAX_SIZE = 500
+
+
+def fetch(file_name):
+    return file_name * 10
+
+
+def insert_designs(cache_dir, file_names):
+    cache = design_cache.DesignCache(cache_dir, MAX_SIZE, "gdsf")
+    for file_name in file_names:
+        cache.get(file_name, fetch)
+
+
+class TestDesignCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def cache(self):
+        return design_cache.DesignCache(self.cache_dir, MAX_SIZE, "gdsf")
+
+    def journal(self):
+        return os.path.join(self.cache_dir, design_cache.CACHE_JOURNAL_FILE)
+
+    def design_files(self):
+        return sorted(file_name for file_name in os.listdir(self.cache_dir)
+                      if not file_name.startswith("."))
+
+    def testPartialJournal(self):
+        cache = self.cache()
+        cache.get("d1", fetch)
+        cache.get("d2", fetch)
+        # a process crashed while appending a record
+        with open(self.journal(), 'ab') as journal:
+            journal.write("A\td3\t2")
+        other = self.cache()
+        with other.locked():
+            pass
+        self.assertEqual(sorted(other.sizes), ["d1", "d2"],
+                         "partial record replayed")
+        with other.locked():
+            other.insert("d4", fetch("d4"))
+        with cache.locked():
+            pass
+        self.assertEqual(sorted(cache.sizes), ["d1", "d2", "d4"],
+                         "record after a partial one not replayed")
+        self.assertEqual(cache.size, other.size, "cache sizes differ")
+
+    def testCompactReplay(self):
+        cache = self.cache()
+        for file_name in ["d1", "d2", "d3"]:
+            cache.get(file_name, fetch)
+        other = self.cache()
+        with other.locked():
+            pass
+        for i in range(3):
+            cache.get("d2", fetch)
+        with cache.locked():
+            cache.compact()
+        with open(self.journal(), 'rb') as journal:
+            self.assertEqual(len(journal.readlines()), 3,
+                             "journal not compacted to a snapshot")
+        fresh = self.cache()
+        for replayed in (fresh, other):
+            with replayed.locked():
+                pass
+            self.assertEqual(replayed.sizes, cache.sizes,
+                             "sizes differ after replaying a snapshot")
+            self.assertEqual(list(replayed.policy.snapshot()),
+                             list(cache.policy.snapshot()),
+                             "policy differs after replaying a snapshot")
+
+    def testConcurrentInserts(self):
+        names = [["a{0}".format(i) for i in range(20)],
+                 ["b{0}".format(i) for i in range(20)]]
+        processes = [multiprocessing.Process(
+            target=insert_designs, args=(self.cache_dir, file_names))
+            for file_names in names]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0, "inserting process failed")
+        cache = self.cache()
+        with cache.locked():
+            pass
+        self.assertEqual(sorted(cache.sizes), self.design_files(),
+                         "index doesn't match the cached files")
+        self.assertEqual(cache.size, sum(
+            os.path.getsize(os.path.join(self.cache_dir, file_name))
+            for file_name in self.design_files()), "wrong cache size")
+        self.assertTrue(cache.size <= cache.max_size, "cache not pruned")
+
+    def testLegacyIndex(self):
+        for file_name in ["old1", "old2", "stray"]:
+            with open(os.path.join(self.cache_dir, file_name), 'wb') as file:
+                file.write(fetch(file_name))
+        legacy_path = os.path.join(self.cache_dir,
+                                   design_cache.LEGACY_META_FILE)
+        with open(legacy_path, 'wb') as file:
+            pickle.dump([80, ["old2", "old1", "gone"]], file)
+        cache = self.cache()
+        with cache.locked():
+            cache.reconcile()
+        self.assertEqual(sorted(cache.sizes), ["old1", "old2"],
+                         "legacy designs not imported")
+        self.assertEqual(self.design_files(), ["old1", "old2"],
+                         "unknown design not deleted")
+        self.assertFalse(os.path.exists(legacy_path),
+                         "legacy index not deleted")
+        fresh = self.cache()
+        with fresh.locked():
+            pass
+        self.assertEqual(fresh.sizes, cache.sizes,
+                         "imported designs not journaled")
@@ -0,0 +1,127 @@
+# test_GDSFPolicy.py
+#
+# xenotime
+#
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from xenotime import cache_policies
+from xenotime import design_cache
+
+
+def fetch(file_name):
+    return file_name * 10
+
+
+class TestGDSFPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = cache_policies.create_policy("gdsf")
+
+    def evictAll(self):
+        order = []
+        while True:
+            file_name = self.policy.victim()
+            if file_name is None:
+                return order
+            self.policy.remove(file_name, evicted=True)
+            order.append(file_name)
+
+    def testSizeOrder(self):
+        self.policy.add("big", 1000)
+        self.policy.add("small", 10)
+        self.policy.add("medium", 100)
+        self.assertEqual(self.evictAll(), ["big", "medium", "small"],
+                         "bigger designs not evicted first")
+
+    def testHitOrder(self):
+        self.policy.add("a", 100)
+        self.policy.add("b", 100)
+        self.policy.add("c", 100)
+        self.policy.hit("a")
+        self.policy.hit("a")
+        self.policy.hit("c")
+        self.assertEqual(self.evictAll(), ["b", "c", "a"],
+                         "less used designs not evicted first")
+
+    def testBigDesignNeedsMoreHits(self):
+        self.policy.add("big", 1000)
+        self.policy.add("small", 100)
+        for i in range(5):
+            self.policy.hit("big")
+        self.assertEqual(self.policy.victim(), "big",
+                         "big design kept with fewer hits per byte")
+        for i in range(10):
+            self.policy.hit("big")
+        self.assertEqual(self.policy.victim(), "small",
+                         "big design evicted with more hits per byte")
+
+    def testAging(self):
+        self.policy.add("stale", 10, hits=3)
+        for file_name in ["a", "b"]:
+            self.policy.add(file_name, 10)
+            self.assertEqual(self.policy.victim(), file_name,
+                             "new design not evicted first")
+            self.policy.remove(file_name, evicted=True)
+        self.policy.add("c", 10)
+        self.assertEqual(self.policy.victim(), "stale",
+                         "evictions didn't age the stale design out")
+
+    def testSnapshot(self):
+        self.policy.add("a", 100, hits=3)
+        self.policy.add("b", 10)
+        self.policy.add("c", 100)
+        self.policy.hit("c")
+        self.assertEqual(self.policy.snapshot(),
+                         [("c", 2), ("a", 3), ("b", 1)],
+                         "snapshot not in eviction order")
+
+
+class TestGDSFDesignCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = design_cache.DesignCache(self.cache_dir, 100, "gdsf",
+                                              max_admit_fraction=0.25)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testAdmission(self):
+        data = self.cache.get("toobig", fetch)
+        self.assertEqual(data, fetch("toobig"), "wrong design data")
+        self.assertFalse("toobig" in self.cache.sizes,
+                         "design over the admit fraction cached")
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                     "toobig")),
+                         "design over the admit fraction written")
+        self.cache.get("ok", fetch)
+        self.assertTrue("ok" in self.cache.sizes,
+                        "design under the admit fraction not cached")
+
+    def testHitsCountedOnce(self):
+        self.cache.get("d1", fetch)
+        self.cache.get("d1", fetch)
+        self.cache.get("d1", fetch)
+        self.assertEqual(self.cache.policy.hits("d1"), 3,
+                         "warm hits not counted")
+        with self.cache.locked():
+            pass
+        with self.cache.locked():
+            pass
+        self.assertEqual(self.cache.policy.hits("d1"), 3,
+                         "journaled hits counted again")
+        other = design_cache.DesignCache(self.cache_dir, 100, "gdsf")
+        with other.locked():
+            other.compact()
+        self.cache.get("d1", fetch)
+        with self.cache.locked():
+            pass
+        self.assertEqual(self.cache.policy.hits("d1"), 4,
+                         "hits counted again after a compaction")
+        fresh = design_cache.DesignCache(self.cache_dir, 100, "gdsf")
+        with fresh.locked():
+            pass
+        self.assertEqual(fresh.policy.hits("d1"), 4,
+                         "hits not journaled once")
@@ -0,0 +1,68 @@
+# test_ZincWorker.py
+#
+# xenotime
+#
+
+import os
+import os.path
+import sys
+import unittest
+from xenotime import zinc_worker
+
+FAKE_ZINC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "..", "scripts", "fake_zinc.py")
+
+# a WorkItem with workType 5 and the WorkResult fake_zinc answers with
+WORK_ITEM = [b"\x08\x05"]
+WORK_RESULT = b"\x08\x01\x18\x05"
+
+
+class TestZincWorker(unittest.TestCase):
+    def setUp(self):
+        os.environ.pop("FAKE_ZINC_CRASH_AFTER", None)
+        os.environ.pop("FAKE_ZINC_DELAY", None)
+        self.worker = zinc_worker.ZincWorker(
+            [sys.executable, FAKE_ZINC, "--serve"], timeout=5)
+
+    def tearDown(self):
+        self.worker.stop()
+        os.environ.pop("FAKE_ZINC_CRASH_AFTER", None)
+        os.environ.pop("FAKE_ZINC_DELAY", None)
+
+    def testRun(self):
+        self.assertEqual(self.worker.run(WORK_ITEM), WORK_RESULT,
+                         "wrong work result")
+        process = self.worker.process
+        self.assertEqual(self.worker.run([b"\x08", b"\x05"]), WORK_RESULT,
+                         "wrong work result for a chunked item")
+        self.assertTrue(self.worker.process is process,
+                        "zinc restarted between items")
+
+    def testCrashRestart(self):
+        os.environ["FAKE_ZINC_CRASH_AFTER"] = "1"
+        self.assertEqual(self.worker.run(WORK_ITEM), WORK_RESULT,
+                         "wrong work result")
+        self.assertRaises(zinc_worker.ZincProcessException,
+                          self.worker.run, WORK_ITEM)
+        self.assertFalse(self.worker.alive(), "crashed zinc still alive")
+        self.assertEqual(self.worker.run(WORK_ITEM), WORK_RESULT,
+                         "zinc not restarted after crashing")
+
+    def testItemTimeout(self):
+        os.environ["FAKE_ZINC_DELAY"] = "2"
+        self.worker.timeout = 0.5
+        self.assertRaises(zinc_worker.ZincTimeoutException,
+                          self.worker.run, WORK_ITEM)
+        self.assertFalse(self.worker.alive(), "timed out zinc still alive")
+        os.environ.pop("FAKE_ZINC_DELAY")
+        self.assertEqual(self.worker.run(WORK_ITEM), WORK_RESULT,
+                         "zinc not restarted after timing out")
+
+    def testWriteTimeout(self):
+        # a child that never reads its stdin fills the pipe buffer
+        self.worker.command = [sys.executable, "-c",
+                               "import time; time.sleep(30)"]
+        self.worker.timeout = 0.5
+        self.assertRaises(zinc_worker.ZincTimeoutException,
+                          self.worker.run, [b"\x00" * 4 * 1024 * 1024])
+        self.assertFalse(self.worker.alive(), "stuck zinc still alive")
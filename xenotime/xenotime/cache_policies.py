@@ -0,0 +1,145 @@
+"""
+cache_policies.py provides eviction policies for the design cache.
+"""
+
+
+from collections import OrderedDict
+import heapq
+import itertools
+
+
+class LRUPolicy(object):
+    """
+    Least recently used eviction, ignoring file size.
+
+    Entries are kept in an OrderedDict with the LRU file at the front so
+    every operation is O(1).
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def __contains__(self, file_name):
+        return file_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, file_name, size, hits=1):
+        self.entries.pop(file_name, None)
+        self.entries[file_name] = hits
+
+    def hit(self, file_name):
+        if file_name in self.entries:
+            self.entries[file_name] = self.entries.pop(file_name) + 1
+
+    def hits(self, file_name):
+        return self.entries.get(file_name, 1)
+
+    def remove(self, file_name, evicted=False):
+        self.entries.pop(file_name, None)
+
+    def victim(self):
+        """
+        Returns the file name that should be evicted next.
+        """
+        return next(iter(self.entries), None)
+
+    def snapshot(self):
+        """
+        Returns (file_name, hits) pairs in eviction order.
+        """
+        return list(self.entries.items())
+
+
+class GDSFPolicy(object):
+    """
+    Greedy-Dual-Size-Frequency eviction.
+
+    Each file gets the priority L + hits / size and the file with the
+    lowest priority is evicted first. L is raised to the priority of
+    every evicted file, so files that stop being used age out. Large
+    designs need proportionally more hits to stay cached, which stops
+    one huge .onyx file from flushing many small ones.
+
+    Priorities live in a heap with lazy deletion; stale heap entries are
+    skipped by victim() and the heap is rebuilt when they dominate.
+    """
+
+    def __init__(self):
+        self.inflation = 0.0
+        self.entries = {}
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __contains__(self, file_name):
+        return file_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def priority(self, hits, size):
+        return self.inflation + float(hits) / max(size, 1)
+
+    def push(self, file_name, entry):
+        heapq.heappush(self.heap, (entry[0], next(self.counter), file_name))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.rebuild()
+
+    def rebuild(self):
+        self.heap = [(entry[0], next(self.counter), file_name)
+                     for file_name, entry in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, file_name, size, hits=1):
+        entry = [self.priority(hits, size), hits, size]
+        self.entries[file_name] = entry
+        self.push(file_name, entry)
+
+    def hit(self, file_name):
+        entry = self.entries.get(file_name)
+        if entry:
+            entry[1] += 1
+            entry[0] = self.priority(entry[1], entry[2])
+            self.push(file_name, entry)
+
+    def hits(self, file_name):
+        entry = self.entries.get(file_name)
+        return entry[1] if entry else 1
+
+    def remove(self, file_name, evicted=False):
+        entry = self.entries.pop(file_name, None)
+        if entry and evicted:
+            self.inflation = max(self.inflation, entry[0])
+
+    def victim(self):
+        """
+        Returns the file name that should be evicted next.
+        """
+        while self.heap:
+            priority, count, file_name = self.heap[0]
+            entry = self.entries.get(file_name)
+            if entry and entry[0] == priority:
+                return file_name
+            heapq.heappop(self.heap)
+        return None
+
+    def snapshot(self):
+        """
+        Returns (file_name, hits) pairs in eviction order.
+        """
+        ordered = sorted(self.entries.items(), key=lambda item: item[1][0])
+        return [(file_name, entry[1]) for file_name, entry in ordered]
+
+
+POLICIES = {
+    "lru": LRUPolicy,
+    "gdsf": GDSFPolicy
+}
+
+
+def create_policy(name):
+    """
+    Returns a new eviction policy object given its name in POLICIES.
+    """
+    return POLICIES[name]()
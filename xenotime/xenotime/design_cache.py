@@ -7,25 +7,44 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 """
 
 
-import pickle
+import atexit
+from contextlib import contextmanager
+import errno
+import fcntl
 import os
 import os.path
+import pickle
+import tempfile
 
 from purpurite import redisutil
 from purpurite import shareutil
+import cache_policies
 
 
 # max size of cache in bytes (512M)
 MAX_CACHE_SIZE = 512 * (1024 * 1024)
 CACHE_DIR = "/var/data/onyx_designs"
-CACHE_META_FILE = ".onyxlru"
+CACHE_JOURNAL_FILE = ".onyxjournal"
+CACHE_LOCK_FILE = ".onyxlock"
+# pickled [size, file names LRU first] index of the cache before the journal
+LEGACY_META_FILE = ".onyxlru"
+# eviction policy from cache_policies.POLICIES, "lru" or "gdsf"
+CACHE_POLICY = "gdsf"
+# designs bigger than this fraction of MAX_CACHE_SIZE are never cached
+MAX_ADMIT_FRACTION = 0.25
+# warm hits buffered in memory before they are written to the journal
+JOURNAL_FLUSH_HITS = 64
+# journal records written before the journal is compacted to a snapshot
+JOURNAL_COMPACT_RECORDS = 4096
 
+JOURNAL_ADD = "A"
+JOURNAL_HIT = "H"
+JOURNAL_REMOVE = "R"
+JOURNAL_EVICT = "E"
 
-# size, list of filenames with LRU files at front
-cache_data = [0, []]
-if os.path.exists(os.path.join(CACHE_DIR, CACHE_META_FILE)):
-    with open(os.path.join(CACHE_DIR, CACHE_META_FILE), 'rb') as file:
-        cache_data = pickle.load(file)
+
+# the cache shared by everything in this process, see get_cache()
+design_cache = None
 
 
 class DesignCacheFetchException(Exception):
@@ -42,107 +61,453 @@ class DesignCacheAccessException(Exception):
     pass
 
 
-def write_back(cache_data):
+class DesignCache(object):
+    """
+    Cache of design files shared by all worker processes on a node.
+
+    Eviction order is kept by a policy from cache_policies so hits and
+    evictions are cheap. Every change is appended to a journal in the
+    cache directory while holding an flock on the lock file. A process
+    replays the journal records written by other processes each time it
+    takes the lock, so the size accounting is always done against the
+    same state. Warm hits only update the in-memory policy and are
+    journaled in batches of JOURNAL_FLUSH_HITS.
+
+    Designs bigger than max_admit_fraction of max_size are served
+    without being cached.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE,
+                 policy=CACHE_POLICY, max_admit_fraction=MAX_ADMIT_FRACTION):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.policy_name = policy
+        self.max_admit_fraction = max_admit_fraction
+        self.policy = cache_policies.create_policy(policy)
+        self.sizes = {}
+        self.size = 0
+        self.pending_hits = []
+        self.journal_inode = None
+        self.journal_offset = 0
+        self.journal_records = 0
+
+    def file_path(self, file_name):
+        return os.path.join(self.cache_dir, file_name)
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the cross-process cache lock and bring the index up to date.
+
+        Replay any journal records written by other processes, then
+        journal the buffered hits of this process before running the
+        body.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(self.file_path(CACHE_LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.sync()
+                self.flush_hits()
+                yield
+                if self.journal_records > JOURNAL_COMPACT_RECORDS:
+                    self.compact()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reset(self):
+        self.policy = cache_policies.create_policy(self.policy_name)
+        self.sizes = {}
+        self.size = 0
+        self.journal_inode = None
+        self.journal_offset = 0
+        self.journal_records = 0
+
+    def sync(self):
+        """
+        Replay the journal records appended since the last sync.
+
+        A journal with a new inode has been compacted by another process
+        and is replayed from the start, and then this process's hits that
+        aren't journaled yet are applied again on top; touch() already
+        applied them to the policy otherwise. A partial record at the end
+        was left by a process that crashed while appending, and is cut
+        off so the next record starts on its own line.
+        """
+        journal_path = self.file_path(CACHE_JOURNAL_FILE)
+        try:
+            stat = os.stat(journal_path)
+        except OSError:
+            self.reset()
+            return
+        if stat.st_ino != self.journal_inode:
+            self.reset()
+            self.journal_inode = stat.st_ino
+            replayed = True
+        else:
+            replayed = False
+        partial = False
+        with open(journal_path, 'rb') as journal:
+            journal.seek(self.journal_offset)
+            for record in journal:
+                if not record.endswith('\n'):
+                    partial = True
+                    break
+                self.journal_offset += len(record)
+                self.replay(record)
+        if partial:
+            with open(journal_path, 'r+b') as journal:
+                journal.truncate(self.journal_offset)
+        if replayed:
+            for file_name in self.pending_hits:
+                self.policy.hit(file_name)
+
+    def replay(self, record):
+        fields = record.rstrip('\n').split('\t')
+        action, file_name = fields[0], fields[1]
+        if action == JOURNAL_ADD:
+            hits = int(fields[3]) if len(fields) > 3 else 1
+            self.add(file_name, int(fields[2]), hits)
+        elif action == JOURNAL_HIT:
+            self.policy.hit(file_name)
+        elif action == JOURNAL_REMOVE:
+            self.discard(file_name)
+        elif action == JOURNAL_EVICT:
+            self.discard(file_name, evicted=True)
+        self.journal_records += 1
+
+    def append(self, records):
+        """
+        Append records to the journal. Must be called while locked.
+        """
+        if not records:
+            return
+        journal_path = self.file_path(CACHE_JOURNAL_FILE)
+        with open(journal_path, 'ab') as journal:
+            journal.write(''.join(records))
+        stat = os.stat(journal_path)
+        self.journal_inode = stat.st_ino
+        self.journal_offset = stat.st_size
+        self.journal_records += len(records)
+
+    def compact(self):
+        """
+        Replace the journal with a snapshot of the index in eviction
+        order.
+        """
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            prefix=CACHE_JOURNAL_FILE)
+        with os.fdopen(handle, 'wb') as snapshot:
+            for file_name, hits in self.policy.snapshot():
+                snapshot.write(add_record(file_name, self.sizes[file_name],
+                                          hits))
+        journal_path = self.file_path(CACHE_JOURNAL_FILE)
+        os.rename(tmp_path, journal_path)
+        stat = os.stat(journal_path)
+        self.journal_inode = stat.st_ino
+        self.journal_offset = stat.st_size
+        self.journal_records = len(self.sizes)
+
+    def flush_hits(self):
+        """
+        Journal the buffered hits. Must be called while locked.
+        """
+        records = [hit_record(file_name) for file_name in self.pending_hits
+                   if file_name in self.sizes]
+        self.pending_hits = []
+        self.append(records)
+
+    def add(self, file_name, size, hits=1):
+        self.discard(file_name)
+        self.sizes[file_name] = size
+        self.size += size
+        self.policy.add(file_name, size, hits)
+
+    def discard(self, file_name, evicted=False):
+        if file_name in self.sizes:
+            self.size -= self.sizes.pop(file_name)
+            self.policy.remove(file_name, evicted)
+
+    def admits(self, size):
+        """
+        Returns True if a design of size bytes may be cached.
+        """
+        return size <= self.max_size * self.max_admit_fraction
+
+    def touch(self, file_name):
+        """
+        Record a hit on file_name.
+
+        Only the in-memory policy is updated; the hit reaches the journal
+        with the next batch.
+        """
+        self.policy.hit(file_name)
+        self.pending_hits.append(file_name)
+        if len(self.pending_hits) >= JOURNAL_FLUSH_HITS:
+            with self.locked():
+                pass
+
+    def read(self, file_name):
+        """
+        Returns the cached data for file_name or None if it isn't cached.
+        """
+        if file_name not in self.sizes:
+            return None
+        try:
+            with open(self.file_path(file_name), 'rb') as file:
+                return file.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise DesignCacheAccessException(
+                    "Could not read cache file {0}!".format(file_name))
+            # evicted by another process since the last sync
+            return None
+
+    def insert(self, file_name, data):
+        """
+        Write data into the cache and prune. Must be called while locked.
+
+        The file is written to a temporary name and renamed into place so
+        readers in other processes never see a partial design.
+        """
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                            prefix="." + file_name)
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.rename(tmp_path, self.file_path(file_name))
+        self.add(file_name, len(data))
+        records = [add_record(file_name, len(data))]
+        records.extend(self.prune(keep=file_name))
+        self.append(records)
+
+    def prune(self, keep=None):
+        """
+        Evict designs chosen by the policy until the cache fits in
+        max_size, deleting every evicted file.
+
+        Returns the journal records for the evictions. Must be called
+        while locked.
+        """
+        records = []
+        kept = []
+        while self.size > self.max_size:
+            file_name = self.policy.victim()
+            if file_name is None:
+                break
+            if file_name == keep:
+                # never evict the design that is being served
+                kept.append((keep, self.policy.hits(keep)))
+                self.policy.remove(keep)
+                continue
+            self.discard(file_name, evicted=True)
+            remove_file(self.file_path(file_name))
+            records.append(evict_record(file_name))
+        for file_name, hits in kept:
+            self.policy.add(file_name, self.sizes[file_name], hits)
+        return records
+
+    def remove(self, file_name):
+        """
+        Drop file_name from the cache. Must be called while locked.
+        """
+        if file_name in self.sizes:
+            self.discard(file_name)
+            remove_file(self.file_path(file_name))
+            self.append([remove_record(file_name)])
+
+    def reconcile(self):
+        """
+        Make the index agree with the files in the cache directory.
+
+        Designs in the index of the cache before the journal are imported
+        first, see import_legacy_index. Entries whose file is missing are
+        dropped, entries whose size changed are re-added with the real
+        size, and design files that the index doesn't know about (left
+        behind by crashed workers) are deleted. Must be called while
+        locked.
+        """
+        records = self.import_legacy_index()
+        on_disk = {}
+        for file_name in os.listdir(self.cache_dir):
+            path = self.file_path(file_name)
+            if file_name.startswith(".") or not os.path.isfile(path):
+                continue
+            on_disk[file_name] = os.path.getsize(path)
+        for file_name in list(self.sizes):
+            if file_name not in on_disk:
+                self.discard(file_name)
+                records.append(remove_record(file_name))
+            elif on_disk[file_name] != self.sizes[file_name]:
+                self.add(file_name, on_disk[file_name])
+                records.append(add_record(file_name, on_disk[file_name]))
+        for file_name in on_disk:
+            if file_name not in self.sizes:
+                remove_file(self.file_path(file_name))
+        records.extend(self.prune())
+        self.append(records)
+
+    def import_legacy_index(self):
+        """
+        Add the designs listed in LEGACY_META_FILE, least recently used
+        first, and delete it.
+
+        The designs cached before the journal existed are kept rather
+        than fetched from redis again. Returns the journal records for
+        the designs added. Must be called while locked.
+        """
+        path = self.file_path(LEGACY_META_FILE)
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'rb') as file:
+                file_names = pickle.load(file)[1]
+        except (EnvironmentError, EOFError, IndexError, TypeError,
+                pickle.UnpicklingError):
+            file_names = []
+        records = []
+        for file_name in file_names:
+            design_path = self.file_path(file_name)
+            if file_name in self.sizes or not os.path.isfile(design_path):
+                continue
+            size = os.path.getsize(design_path)
+            self.add(file_name, size)
+            records.append(add_record(file_name, size))
+        remove_file(path)
+        return records
+
+    def get(self, file_name, fetch):
+        """
+        Returns the data for file_name, calling fetch(file_name) on a miss.
+
+        A warm hit reads the file without taking the lock or writing to
+        the journal.
+        """
+        data = self.read(file_name)
+        if data is not None:
+            self.touch(file_name)
+            return data
+        with self.locked():
+            # another worker may have fetched it while we waited
+            data = self.read(file_name)
+            if data is None:
+                data = fetch(file_name)
+                if self.admits(len(data)):
+                    self.insert(file_name, data)
+            else:
+                self.policy.hit(file_name)
+                self.append([hit_record(file_name)])
+        return data
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise DesignCacheAccessException(
+                "Could not remove cache file {0}!".format(path))
+
+
+def add_record(file_name, size, hits=1):
+    return "{0}\t{1}\t{2}\t{3}\n".format(JOURNAL_ADD, file_name, size, hits)
+
+
+def hit_record(file_name):
+    return "{0}\t{1}\n".format(JOURNAL_HIT, file_name)
+
+
+def remove_record(file_name):
+    return "{0}\t{1}\n".format(JOURNAL_REMOVE, file_name)
+
+
+def evict_record(file_name):
+    return "{0}\t{1}\n".format(JOURNAL_EVICT, file_name)
+
+
+def get_cache():
     """
-    Write the cache data to disk.
+    Returns the DesignCache for this process, loading and reconciling it
+    with the cache directory on first use.
+    """
+    global design_cache
+    if not design_cache:
+        design_cache = DesignCache(CACHE_DIR, MAX_CACHE_SIZE, CACHE_POLICY,
+                                   MAX_ADMIT_FRACTION)
+        with design_cache.locked():
+            design_cache.reconcile()
+        atexit.register(flush_cache)
+    return design_cache
+
 
-    Using CACHE_DIR and CACHE_META_FILE create a file. Serialize the
-    data and write it to the file.
+def flush_cache():
     """
-    with open(os.path.join(CACHE_DIR, CACHE_META_FILE), 'wb') as file:
-        pickle.dump(cache_data, file)
+    Journal any warm hits still buffered in this process.
+    """
+    if design_cache and design_cache.pending_hits:
+        with design_cache.locked():
+            pass
 
 
 def prune_cache():
     """
     Prune the cache.
 
-    While the cache size is greater than MAX_CACHE_SIZE remove designs
-    from the cache directory. Delete the meta cache file and write
-    it again.
-    """
-    global cache_data
-    file_name = None
-    while cache_data[0] > MAX_CACHE_SIZE:
-        file_name = cache_data[1][0]
-        filepath = os.path.join(CACHE_DIR, file_name)
-        size = os.path.getsize(filepath)
-        cache_data[0] -= size
-        cache_data[1].remove(file_name)
-    try:
-        if os.path.exists(filepath) and os.path.isfile(filepath):
-            os.remove(filepath)
-    except:
-        raise DesignCacheAccessException(
-            "Could not remove cache file {0}!".format(file_name))
-    write_back(cache_data)
+    While the cache size is greater than MAX_CACHE_SIZE remove the
+    designs chosen by the eviction policy from the cache directory and
+    journal the evictions.
+    """
+    cache = get_cache()
+    with cache.locked():
+        cache.append(cache.prune())
 
 
-def fetch_from_redis(onyx_file_name):
+def invalidate(onyx_file_name):
     """
-    Fetch a cached design file.
+    Remove a stale design file from the cache so the next access fetches
+    it from redis again.
+    """
+    cache = get_cache()
+    with cache.locked():
+        cache.remove(onyx_file_name)
+
 
+def fetch_from_redis(onyx_file_name):
+    """
+    Fetch a design file from redis.
 
-    Fetch a cached design file from redis, write it to disk as a new
-    file and update the cache meta file.
+    Returns the design file data, otherwise raise a
+    DesignCacheFetchException.
     """
-    global cache_data
     r = redisutil.redis_connect()
     data = r.get(redisutil.onyx_file_key(onyx_file_name))
     if not data:
         raise DesignCacheFetchException("Could not fetch {0} into cache!".
                                         format(onyx_file_name))
-    filepath = os.path.join(CACHE_DIR, onyx_file_name)
-    with open(filepath, 'wb') as file:
-        file.write(data)
-    cache_data[1].append(onyx_file_name)
-    cache_data[0] += os.path.getsize(filepath)
-    prune_cache()
-    return True
+    return data
 
 
 def cache_size():
     """
     Gets the size in bytes of all cached design files.
     """
-    return cache_data[0]
+    return get_cache().size
 
 
 def set_mru(onyx_file_name):
     """
-    Update the cache meta design file to reverse MRU order.
-
-    Pop and append the design file name and write it to disk.
+    Mark the design file as the most recently used one.
     """
-    global cache_data
-    i = cache_data[1].index(onyx_file_name)
-    cache_data[1].pop(i)
-    cache_data[1].append(onyx_file_name)
-    write_back(cache_data)
+    get_cache().touch(onyx_file_name)
 
 
 def get_onyx_design_data(onyx_file_name):
     """
     Get design data.
 
-    If the design data is already cached then open the file, update
-    the cache order and return the data. If the file is not in the
-    cache then fetch it from redis. If it's not in redis or the design
-    file doesn't exist then raise a DesignCacheAccessException.
+    If the design data is already cached then read the file and update
+    the in-memory eviction policy. If the file is not in the cache then
+    fetch it from redis under the cache lock and cache it if the policy
+    admits it. If it's not in redis raise a DesignCacheFetchException.
     """
-    if onyx_file_name not in cache_data[1]:
-        if not fetch_from_redis(onyx_file_name):
-            return None
-    if not onyx_file_name in cache_data[1]:
-        raise DesignCacheAccessException(
-            "Could not find {0} in cache when it should be!".format(
-                onyx_file_name))
-    filepath = os.path.join(CACHE_DIR, onyx_file_name)
-    if not os.path.exists(filepath):
-        raise DesignCacheAccessException(
-            "File {0} is missing from the cache".format(
-                onyx_file_name))
-    with open(filepath, 'rb') as file:
-        data = file.read()
-    set_mru(onyx_file_name)
-    return data
+    return get_cache().get(onyx_file_name, fetch_from_redis)
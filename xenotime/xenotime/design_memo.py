@@ -0,0 +1,111 @@
+"""
+design_memo.py keeps designs in memory between tasks, parsing them only
+for callers that need the Design.
+"""
+
+
+from collections import OrderedDict
+import hashlib
+
+from purpurite import onyxutil
+import design_cache
+
+
+# max serialized size of the designs kept parsed in memory (128M). Parsed
+# protobuf messages take a few times this in the worker.
+MAX_MEMO_SIZE = 128 * (1024 * 1024)
+
+
+# (onyx file name, checksum) -> [Design or None until parsed, design data],
+# LRU first
+memo = OrderedDict()
+memo_size = 0
+
+
+def clear_memo():
+    """
+    Drop every memoized design.
+    """
+    global memo, memo_size
+    memo = OrderedDict()
+    memo_size = 0
+
+
+def remember(key, design, design_data):
+    """
+    Memoize a design, parsed or None, and evict LRU designs over
+    MAX_MEMO_SIZE.
+
+    A design bigger than MAX_MEMO_SIZE on its own is not memoized.
+    """
+    global memo_size
+    if len(design_data) > MAX_MEMO_SIZE:
+        return
+    memo[key] = [design, design_data]
+    memo_size += len(design_data)
+    while memo_size > MAX_MEMO_SIZE:
+        old_key, (old_design, old_data) = memo.popitem(last=False)
+        memo_size -= len(old_data)
+
+
+def load_design_data(onyx_file_name, checksum):
+    """
+    Read a design's data from the design cache.
+
+    If the data doesn't match checksum the cached design file is stale,
+    so drop it from the design cache and read it again. If it still
+    doesn't match, redis holds another version of the design; raise a
+    DesignCacheFetchException so the task retries.
+    """
+    design_data = design_cache.get_onyx_design_data(onyx_file_name)
+    if checksum and hashlib.sha1(design_data).hexdigest() != checksum:
+        design_cache.invalidate(onyx_file_name)
+        design_data = design_cache.get_onyx_design_data(onyx_file_name)
+        if hashlib.sha1(design_data).hexdigest() != checksum:
+            design_cache.invalidate(onyx_file_name)
+            raise design_cache.DesignCacheFetchException(
+                "{0} doesn't match checksum {1}!".format(onyx_file_name,
+                                                         checksum))
+    return design_data
+
+
+def get_entry(onyx_file_name, checksum):
+    """
+    Returns the memo entry for the onyx file, loading its data on a
+    miss. Without a checksum a memoized design could never be found
+    stale, so the entry is loaded every time and not memoized.
+    """
+    key = (onyx_file_name, checksum)
+    if key in memo:
+        entry = memo.pop(key)
+        memo[key] = entry
+        return entry
+    entry = [None, load_design_data(onyx_file_name, checksum)]
+    if checksum:
+        remember(key, *entry)
+    return memo.get(key, entry)
+
+
+def get_design_data(onyx_file_name, checksum):
+    """
+    Returns the serialized Design of the onyx file without parsing it.
+
+    Designs are memoized by onyx file name and checksum, so a hit skips
+    the design cache read and checksum.
+    """
+    return get_entry(onyx_file_name, checksum)[1]
+
+
+def get_design(onyx_file_name, checksum, design_number, design_rev):
+    """
+    Returns a (Design, design data) tuple for the onyx file.
+
+    Like get_design_data, and the Design is parsed once and memoized
+    with the data. Callers must treat the returned Design as read only
+    because it is shared between tasks.
+    """
+    entry = get_entry(onyx_file_name, checksum)
+    if entry[0] is None:
+        entry[0] = onyxutil.design_from_data(design_number, design_rev,
+                                             entry[1])
+    return (entry[0], entry[1])
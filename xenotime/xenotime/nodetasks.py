@@ -10,10 +10,9 @@ Copyright Deca Technologies 2013 All Rights Reserved.
 
 from datetime import datetime
 import logging
-import os
-import subprocess
-import tempfile
-import zlib
+import time
+
+from sqlalchemy import func
 
 from purpurite.celeryapp import celery
 from purpurite import model
@@ -22,11 +21,21 @@ from purpurite import redisutil
 from purpurite import onyxutil
 from purpurite import redisutil
 from purpurite import shareutil
+from purpurite import tracing
 import design_cache
+import design_memo
+import shifts_cache
+import zinc_worker
 
 
 RESULTS_EXPIRE_TIME = 60 * 50
 GDS_EXPIRE_TIME = 60 * 50
+# routing results fetched per MGET when aggregating for create_gds
+RESULTS_BATCH_SIZE = 8
+# GDS files written to the share at the same time
+OUTPUT_THREADS = 4
+# send zinc only the units of a routing task's workrange
+SLICE_SHIFTS = True
 
 
 class RoutingException(Exception):
@@ -45,28 +54,18 @@ class GDSGenerationException(Exception):
     pass
 
 
-def route_command(work_item):
+def route_command(work_item_data):
     """
-    Call the zinc command with arguments to route.
+    Run a serialized routing WorkItem through zinc.
 
-    Create a temporary file containing the data from WorkItem. Create
-    another temporary file for zinc's route output. Build the command
-    and create a subprocess. Block until it's complete. Read the output
-    temporary file. Return the data and delete the temporary files.
+    Hand the WorkItem to the zinc worker process and return the
+    serialized WorkResult. If zinc crashes or times out raise a
+    RoutingException; zinc is restarted for the next item.
     """
-    result_data = None
-    inpath = onyxutil.tmpfile_for_workitem(work_item)
-    h, outpath = tempfile.mkstemp()
-    print("Input file: {0}\nOutput file: {1}\n".format(inpath, outpath))
-    cmd = ["/usr/bin/zinc", "-i", inpath, "-o", outpath, "-d"]
-    p = subprocess.Popen(cmd)
-    p.wait()
-    # read results
-    with open(outpath, 'rb') as file:
-        result_data = file.read()
-    os.remove(inpath)
-    os.remove(outpath)
-    return result_data
+    try:
+        return zinc_worker.run_work_item(work_item_data)
+    except zinc_worker.ZincProcessException as e:
+        raise RoutingException("zinc failed to route: {0}".format(e))
 
 
 @celery.task(name="xenotime.route",
@@ -75,13 +74,46 @@ def route(job_id, workrange):
     """
     Create route data and put it in redis.
 
+    Route the workrange with route_workrange, retrying the task when
+    zinc fails. Returns the workrange's results key.
+    """
+    return route_workrange(job_id, workrange, route.retry)
+
+
+@celery.task(name="xenotime.route_batch",
+             priority=9, acks_late=True, max_retries=3)
+def route_batch(items):
+    """
+    Create route data for workranges of several panels of one design.
+
+    items are (job_id, workrange) pairs whose jobs share an onyx file.
+    Route them one after another with route_workrange, so the design is
+    read once for the whole batch and held in design_memo.
+    When zinc fails retry the batch; workranges it already routed are
+    skipped the next time. Returns the results key of each item.
+    """
+    return [route_workrange(job_id, workrange, route_batch.retry)
+            for job_id, workrange in items]
+
+
+def route_workrange(job_id, workrange, retry):
+    """
+    Create route data for one workrange and put it in redis.
+
     Create a database session. Get the first Job filtered by the job_id.
-    If no job is found raise a RoutingException. Set the started_time if
-    it's not already set. Set the job status to RUNNING. Get the design
-    data and create a Design. Get the measurement file data and create
-    Shifts. Create a WorkItem using the Design and Shifts. Call the
-    route zinc command to get data. Put the data in redis. Close the
-    database session.
+    If no job is found raise a RoutingException. If the workrange or a
+    workrange it was split from is already routed, by a speculative copy
+    or the original, return its key. Record when routing the workrange
+    started. Set the started_time if it's not already set. Set the job
+    status to RUNNING. Get the design data, raising retry(exc=exc) if it
+    can't be fetched. Get the serialized Shifts of the measurement file.
+    Build the serialized WorkItem from the design data and Shifts
+    without copying or parsing either, sliced to the workrange's units
+    with SLICE_SHIFTS. Call the route zinc command to get data. Put the
+    data in redis unless another copy got there first, then the first
+    result wins and this one is dropped. Add the zinc time to the job's
+    routing_time. Close the database session. When zinc fails raise
+    retry(exc=exc), the calling task's retry.
     """
     db, job = dbutil.get_db_job(job_id,
                                 model.Job.STATUS_STARTED,
@@ -91,80 +123,122 @@ def route(job_id, workrange):
                                          workrange[2]))
     if not job:
         raise RoutingException("Could not load job from database!")
+    results_key = redisutil.routing_results_key(job, workrange)
+    routed_key = redisutil.start_routing(
+        job, workrange,
+        onyxutil.workrange_ancestors(workrange) + [workrange[0]],
+        RESULTS_EXPIRE_TIME)
+    if routed_key:
+        print("{0}) Already routed".format(workrange[0]))
+        db.close()
+        return routed_key
     if not job.started_time:
         job.started_time = datetime.now()
     db.commit()
 
-    design, design_data = get_design(job)
+    with tracing.span("design", job_id, workrange):
+        try:
+            design_data = get_design_data(job)
+        except design_cache.DesignCacheFetchException as exc:
+            db.close()
+            raise retry(exc=exc)
 
-    shifts, shift_data = get_shifts(job)
+    with tracing.span("shifts", job_id, workrange):
+        shift_data, panel_id, unit_count = get_shifts(job)
 
-    work_item = onyxutil.zinc_routing_work_item(design,
-                                                shifts,
-                                                workrange[1],
-                                                workrange[2])
+    with tracing.span("work_item", job_id, workrange):
+        work_item_data = onyxutil.zinc_routing_work_item_data(
+            design_data, shift_data, panel_id, workrange[1], workrange[2],
+            slice_shifts=SLICE_SHIFTS)
 
     if not shift_data:
         logging.debug("shift_data is None.")
         logging.debug("job = %s" % str(job.measurement_file))
         logging.debug("job = %s" % str(job))
 
-    result_data = route_command(work_item)
+    try:
+        start = time.time()
+        with tracing.span("zinc_route", job_id, workrange):
+            result_data = route_command(work_item_data)
+        routing_time = time.time() - start
+    except RoutingException as exc:
+        raise retry(exc=exc)
     if not result_data:
         print("COULD NOT READ RESULTS")
         exc = RoutingException("Coud not read results from file!")
-        raise route.retry(exc=exc)
-    results_key = redisutil.routing_results_key(job, workrange)
-    r = redisutil.redis_connect()
-    r.set(results_key, result_data)
-    r.expire(results_key, RESULTS_EXPIRE_TIME)
-    job.work_items_done += 1
+        raise retry(exc=exc)
+    with tracing.span("redis_write", job_id, workrange,
+                      bytes=len(result_data)) as fields:
+        fields["won"] = redisutil.store_routing_result(
+            job, workrange, result_data, routing_time, RESULTS_EXPIRE_TIME)
+    if not fields["won"]:
+        print("{0}) Routed by another worker first".format(workrange[0]))
+        db.close()
+        return results_key
+    # split workranges are counted when the controller gathers them
+    if not onyxutil.workrange_ancestors(workrange):
+        job.work_items_done += 1
+    # add in SQL so concurrent workranges don't overwrite each other
+    job.routing_time = func.coalesce(model.Job.routing_time, 0) + routing_time
     db.commit()
     db.close()
     return results_key
 
 
-def create_gds_command(work_item):
+def create_gds_command(work_item_data):
     """
-    Call the zinc command with arguments to create_gds.
+    Run a serialized Create GDS WorkItem through zinc.
 
-    Create a temporary file containing the data from WorkItem. Create
-    another temporary file for zinc's create_gds output. Build the
-    command and create a subprocess. Block until it's complete. Read
-    the output temporary file. If there is no data create a
-    RoutingException. Otherwise return the data and delete the temporary
-    files.
+    Hand the WorkItem to the zinc worker process and return the
+    serialized WorkResult. If zinc fails or returns no data raise a
+    RoutingException.
     """
-    inpath = onyxutil.tmpfile_for_workitem(work_item)
-    h, outpath = tempfile.mkstemp()
-    cmd = ["/usr/bin/zinc", "-i", inpath, "-o", outpath, "-d"]
-    p = subprocess.Popen(cmd)
-    p.wait()
-    # read results
-    with open(outpath, 'rb') as file:
-        result_data = file.read()
+    try:
+        result_data = zinc_worker.run_work_item(work_item_data)
+    except zinc_worker.ZincProcessException as e:
+        raise RoutingException("zinc failed to create GDS: {0}".format(e))
     if not result_data:
         raise RoutingException("Coud not parse results from file!")
-    os.remove(inpath)
-    os.remove(outpath)
     return result_data
 
 
-def get_design(job):
-    design_data = design_cache.get_onyx_design_data(job.onyx_file)
-    design = onyxutil.design_from_data(job.measurement_file.design_number,
-                                       job.measurement_file.design_rev,
-                                       design_data)
-    return (design, design_data)
+def get_design_data(job):
+    """
+    Returns the serialized Design for the job, unparsed.
+
+    The data is shared with other tasks in this worker process through
+    design_memo.
+    """
+    return design_memo.get_design_data(job.onyx_file,
+                                       job.onyx_file_checksum)
 
 
 def get_shifts(job):
-    shift_data = redisutil.measurement_file_data(job.measurement_file)
-    shifts = onyxutil.shifts_from_data(job.measurement_file.design_number,
-                                       job.measurement_file.design_rev,
-                                       job.measurement_file.panel_id,
-                                       shift_data)
-    return (shifts, shift_data)
+    """
+    Returns the (serialized Shifts, panel ID, unit count) tuple for the
+    job.
+
+    The Shifts are read by digest through shifts_cache, so they come
+    from redis once per node, and are not parsed; only their panel ID
+    is, to check it matches the job's measurement file. If the count
+    key has expired the units are counted in the Shifts.
+    """
+    digest, unit_count = redisutil.measurement_file_shifts(
+        job.measurement_file)
+    if not digest:
+        raise RoutingException("Shifts for job {0} are not loaded!".format(
+            job.id))
+    shift_data = shifts_cache.get_shifts_data(digest, redisutil.shifts_data)
+    if not shift_data:
+        raise RoutingException("Shifts for job {0} expired!".format(job.id))
+    panel_id = onyxutil.shifts_data_panel_id(shift_data)
+    onyxutil.check_shifts_panel_id(job.measurement_file.design_number,
+                                   job.measurement_file.design_rev,
+                                   job.measurement_file.panel_id,
+                                   panel_id)
+    if unit_count is None:
+        unit_count = onyxutil.shifts_data_unit_count(shift_data)
+    return (shift_data, panel_id, unit_count)
 
 
 @celery.task(name="xenotime.create_gds",
@@ -175,14 +249,16 @@ def create_gds(result_keys=[], job_id=None,
     Create GDS data and put it in redis.
 
     If there is no job_id raise a RoutingException. Create a database
-    session. Get the first Job filtered by job_id. Get the design data
-    from the design_cache and create a Design. Get the measurement file
-    data and create Shifts. Create a WorkItem using the Design and
-    Shifts. If gds_only is False then get all the routed units and add
-    them to the WorkItem. If there is no data raise a
-    GDSGenerationException. Call the create_gds zinc command to get the
-    data. Put the data in redis. Close the database session and delay
-    a task to save the output files.
+    session. Get the first Job filtered by job_id. Get the design data,
+    retrying if it can't be fetched. Get the serialized Shifts of the
+    measurement file. If gds_only is False then fetch the routing
+    results in batches and collect their serialized routed units without
+    parsing them, counting the good units from the routingGood field. If
+    a result is missing raise a GDSGenerationException. Splice the
+    design, shifts and routed units into a WorkItem and call the
+    create_gds zinc command to get the data. Put the data in redis.
+    Close the database session and delay a task to save the output
+    files.
     """
     if not job_id:
         raise RoutingException("No job id provided!")
@@ -191,40 +267,53 @@ def create_gds(result_keys=[], job_id=None,
 
     print("Create GDS")
 
-    design, design_data = get_design(job)
-
-    shifts, shift_data = get_shifts(job)
+    with tracing.span("design", job_id):
+        try:
+            design_data = get_design_data(job)
+        except design_cache.DesignCacheFetchException as exc:
+            db.close()
+            raise create_gds.retry(exc=exc)
 
-    work_item = onyxutil.zinc_create_gds_work_item(design, shifts)
+    with tracing.span("shifts", job_id):
+        shift_data, panel_id, num_units = get_shifts(job)
 
     print("Creating Work Item")
+    routed_units_data = []
+    good_units = 0
     if not gds_only:
         # aggregate all results
-        r = redisutil.redis_connect()
-        for result_key in result_keys:
-            print("Loading result data")
-            result_data = r.get(result_key)
-            print("Aggregating routes")
-            if not result_data:
-                print("Result data is None!")
-                raise GDSGenerationException("Result for {0} is missing!".
-                                             format(result_key))
-            routed_units = onyxutil.zinc_routed_units_from_result_data(
-                result_data)
-            work_item.createGDSWorkItem.routedUnits.extend(routed_units)
-
-    num_units = len(shifts.units)
-    good_units = len([unit for unit in work_item.createGDSWorkItem.routedUnits
-        if unit.routingGood])
+        print("Aggregating routes")
+        with tracing.span("aggregate", job_id,
+                          results=len(result_keys)) as fields:
+            for result_key, result_data in redisutil.iter_values(
+                    result_keys, RESULTS_BATCH_SIZE):
+                if not result_data:
+                    print("Result data is None!")
+                    raise GDSGenerationException(
+                        "Result for {0} is missing!".format(result_key))
+                for routed_unit_data in\
+                        onyxutil.zinc_routed_units_data_from_result_data(
+                            result_data):
+                    routed_units_data.append(routed_unit_data)
+                    good_units += onyxutil.routed_unit_good(
+                        routed_unit_data)
+            fields["units"] = len(routed_units_data)
+
     job.unit_count = num_units
-    job.good_units = good_units
+    job.units_good = good_units
     job.final_yield = float(good_units) / float(num_units)
     db.commit()
 
-    result_data = create_gds_command(work_item)
+    with tracing.span("work_item", job_id):
+        work_item_data = onyxutil.zinc_create_gds_work_item_data(
+            design_data, shift_data, panel_id, routed_units_data)
+    del routed_units_data
+    with tracing.span("zinc_create_gds", job_id):
+        result_data = create_gds_command(work_item_data)
+    del work_item_data
     results_key = redisutil.gds_results_key(job)
-    r.set(results_key, result_data)
-    r.expire(results_key, GDS_EXPIRE_TIME)
+    with tracing.span("redis_write", job_id, bytes=len(result_data)):
+        redisutil.set_values([(results_key, result_data)], GDS_EXPIRE_TIME)
 
     job.work_items_done += 1
     db.commit()
@@ -270,21 +359,26 @@ def output_files(job_id, result_key):
     Create a database session. Get the first Job object filtered by
     job_id. Create a redis connection. Get the results data from redis.
     Create a WorkResult object from the data. Get the GDS location from
-    the Job. Delete any pre-existing result files. Write and decompress
-    the data to the GDS location. Set the job status to COMPLETE and
+    the Job. Write the files to the GDS location with OUTPUT_THREADS
+    writers, each reusing one connection and decompressing the data as
+    it is stored, replacing any pre-existing result files. Report the
+    throughput of each file. Set the job status to COMPLETE and
     finshed_time to now. Commit and close the database session.
     """
     print("Outputting GDS files to share...")
-    results, results_data = get_results(result_key)
+    with tracing.span("redis_read", job_id):
+        results, results_data = get_results(result_key)
     store_location, prefix = get_job_details(job_id)
 
-    for file in results.createGDSWorkResults.files:
-        try:
-            shareutil.delete_existing_file(store_location,
-                                           prefix + file.fileName)
-        except:
-            pass
-        shareutil.write_data_to_share(store_location, prefix + file.fileName,
-                                      zlib.decompress(file.data))
-    
+    files = [(prefix + file.fileName, shareutil.DecompressingReader(file.data))
+             for file in results.createGDSWorkResults.files]
+    with tracing.span("share_write", job_id, files=len(files)) as fields:
+        stats = shareutil.write_files_to_share(store_location, files,
+                                               OUTPUT_THREADS)
+        fields["bytes"] = sum(written for name, written, seconds in stats)
+    for file_name, written, seconds in stats:
+        print("Wrote {0}: {1:.1f} MB in {2:.1f}s ({3:.1f} MB/s)".format(
+            file_name, written / 1048576.0, seconds,
+            written / 1048576.0 / max(seconds, 0.001)))
+
     set_job_details(job_id)
@@ -0,0 +1,104 @@
+"""
+shifts_cache.py keeps serialized shifts on the node between tasks.
+"""
+
+
+import errno
+import os
+import os.path
+import tempfile
+
+
+# tmpfs directory the worker processes on a node share shifts through
+CACHE_DIR = "/dev/shm/archerite_shifts"
+# max size of the cached shifts in bytes (256M)
+MAX_CACHE_SIZE = 256 * (1024 * 1024)
+
+
+def cache_dir():
+    """
+    Returns CACHE_DIR, creating it if needed, or None if it can't be
+    written.
+    """
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return None
+    if not os.access(CACHE_DIR, os.W_OK):
+        return None
+    return CACHE_DIR
+
+
+def get_shifts_data(digest, fetch):
+    """
+    Returns the serialized Shifts with digest, calling fetch(digest) on a
+    miss.
+
+    Shifts are named by the SHA-1 digest of their data so a cached file
+    never goes stale and needs no locking; it is written to a temporary
+    name and renamed into place so readers never see part of one. A
+    hit touches the file so prune() evicts the least recently used
+    first. Without a writable CACHE_DIR every call fetches, and fetched
+    data that can't be written, e.g. with the tmpfs full, is returned
+    uncached.
+    """
+    directory = cache_dir()
+    if not directory:
+        return fetch(digest)
+    path = os.path.join(directory, digest)
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+        os.utime(path, None)
+        return data
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+    data = fetch(digest)
+    if data is None:
+        return None
+    tmp_path = None
+    try:
+        handle, tmp_path = tempfile.mkstemp(dir=directory,
+                                            prefix="." + digest)
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.rename(tmp_path, path)
+        prune(directory)
+    except (IOError, OSError) as e:
+        print("Could not cache shifts {0}: {1}".format(digest, e))
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return data
+
+
+def prune(directory, max_size=MAX_CACHE_SIZE):
+    """
+    Delete the least recently used shifts until the cache fits in
+    max_size. Temporary files are left to the process writing them.
+    """
+    entries = []
+    size = 0
+    for file_name in os.listdir(directory):
+        if file_name.startswith("."):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, file_name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_name))
+        size += stat.st_size
+    entries.sort()
+    for mtime, file_size, file_name in entries:
+        if size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, file_name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        size -= file_size
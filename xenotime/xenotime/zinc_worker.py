@@ -0,0 +1,236 @@
+"""
+zinc_worker.py runs zinc work items for the worker node tasks.
+"""
+
+
+import atexit
+import errno
+import fcntl
+import os
+import os.path
+import select
+import struct
+import subprocess
+import tempfile
+import time
+
+
+ZINC_PATH = "/usr/bin/zinc"
+# keep one zinc process per worker and feed it work items over pipes
+ZINC_PERSISTENT = True
+# seconds a single work item may run before zinc is killed
+ITEM_TIMEOUT = 60 * 30
+# tmpfs directory for one-shot zinc input and output files
+ZINC_TMP_DIR = "/dev/shm"
+
+# work items and results are framed by a 4-byte big-endian length
+FRAME_HEADER = struct.Struct(">I")
+# largest single read from or write to the zinc pipes
+PIPE_CHUNK_SIZE = 1024 * 1024
+
+
+# the persistent zinc process for this worker, see get_worker()
+worker = None
+
+
+class ZincProcessException(Exception):
+    """
+    zinc exited or could not be started.
+    """
+    pass
+
+
+class ZincTimeoutException(ZincProcessException):
+    """
+    zinc did not finish a work item in time.
+    """
+    pass
+
+
+class ZincWorker(object):
+    """
+    A long-lived zinc child process running in --serve mode.
+
+    Work items are written to its stdin and work results read back from
+    its stdout, each framed by FRAME_HEADER. The child is started on
+    first use and again after it crashes or is killed for taking longer
+    than the item timeout.
+    """
+
+    def __init__(self, command=None, timeout=ITEM_TIMEOUT):
+        self.command = command or [ZINC_PATH, "--serve"]
+        self.timeout = timeout
+        self.process = None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(self.command,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            close_fds=True)
+        except OSError as e:
+            raise ZincProcessException("Could not start {0}: {1}".format(
+                self.command[0], e))
+        # writes must not block past the item deadline when zinc stops
+        # reading, so feed stdin through select() and partial writes
+        fd = self.process.stdin.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def stop(self):
+        """
+        Close zinc's stdin so it exits, killing it if it doesn't.
+        """
+        if not self.process:
+            return
+        process, self.process = self.process, None
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + 5
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+    def kill(self):
+        if self.process:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+        self.stop()
+
+    def read_exactly(self, length, deadline):
+        fd = self.process.stdout.fileno()
+        chunks = []
+        while length > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ZincTimeoutException("zinc timed out!")
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, min(length, PIPE_CHUNK_SIZE))
+            if not chunk:
+                raise ZincProcessException(
+                    "zinc exited with {0}!".format(self.process.wait()))
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+    def write_all(self, data, deadline):
+        fd = self.process.stdin.fileno()
+        offset = 0
+        while offset < len(data):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ZincTimeoutException("zinc timed out!")
+            _, writable, _ = select.select([], [fd], [], remaining)
+            if not writable:
+                continue
+            try:
+                offset += os.write(
+                    fd, data[offset:offset + PIPE_CHUNK_SIZE])
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def run(self, work_item_data, timeout=None):
+        """
+        Returns the serialized WorkResult for a serialized work item.
+
+        work_item_data is a list of byte strings whose concatenation is
+        the serialized WorkItem. Raise a ZincTimeoutException when zinc
+        takes longer than timeout seconds and a ZincProcessException
+        when it crashes; either way the child is restarted for the next
+        item.
+        """
+        if not self.alive():
+            self.stop()
+            self.start()
+        deadline = time.time() + (timeout or self.timeout)
+        try:
+            length = sum(len(chunk) for chunk in work_item_data)
+            self.write_all(FRAME_HEADER.pack(length), deadline)
+            for chunk in work_item_data:
+                self.write_all(chunk, deadline)
+            header = self.read_exactly(FRAME_HEADER.size, deadline)
+            return self.read_exactly(FRAME_HEADER.unpack(header)[0],
+                                     deadline)
+        except (IOError, OSError) as e:
+            self.kill()
+            if e.errno == errno.EPIPE:
+                raise ZincProcessException("zinc exited!")
+            raise
+        except ZincProcessException:
+            self.kill()
+            raise
+
+
+def get_worker():
+    """
+    Returns the persistent ZincWorker for this process.
+    """
+    global worker
+    if not worker:
+        worker = ZincWorker()
+        atexit.register(worker.stop)
+    return worker
+
+
+def tmp_dir():
+    if os.path.isdir(ZINC_TMP_DIR) and os.access(ZINC_TMP_DIR, os.W_OK):
+        return ZINC_TMP_DIR
+    return None
+
+
+def run_zinc_once(work_item_data, timeout=ITEM_TIMEOUT):
+    """
+    Run one work item in a new zinc process and return the serialized
+    WorkResult.
+
+    Input and output go through files in ZINC_TMP_DIR when it is a
+    writable tmpfs, otherwise in the default temp directory. Raise a
+    ZincTimeoutException and kill zinc when it runs longer than timeout
+    seconds.
+    """
+    in_handle, inpath = tempfile.mkstemp(dir=tmp_dir())
+    out_handle, outpath = tempfile.mkstemp(dir=tmp_dir())
+    os.close(out_handle)
+    try:
+        with os.fdopen(in_handle, 'wb') as file:
+            for chunk in work_item_data:
+                file.write(chunk)
+        p = subprocess.Popen([ZINC_PATH, "-i", inpath, "-o", outpath, "-d"],
+                             close_fds=True)
+        deadline = time.time() + timeout
+        while p.poll() is None:
+            if time.time() > deadline:
+                p.kill()
+                p.wait()
+                raise ZincTimeoutException("zinc timed out!")
+            time.sleep(0.05)
+        with open(outpath, 'rb') as file:
+            return file.read()
+    finally:
+        os.remove(inpath)
+        os.remove(outpath)
+
+
+def run_work_item(work_item_data, timeout=ITEM_TIMEOUT):
+    """
+    Run a serialized work item through zinc and return the serialized
+    WorkResult.
+
+    Use the persistent zinc process when ZINC_PERSISTENT is set,
+    otherwise start zinc for this item only.
+    """
+    if ZINC_PERSISTENT:
+        return get_worker().run(work_item_data, timeout)
+    return run_zinc_once(work_item_data, timeout)